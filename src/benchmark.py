@@ -0,0 +1,1015 @@
+"""
+Benchmarks of the scraping pipeline stages.
+
+Each stage has its own subcommand, run them from the src folder:
+    python benchmark.py gray AWF_scrap/dl_frames
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+
+def list_frames(folder, limit=None):
+    """
+    List the JPEG frames below a folder.
+
+    Args:
+        folder (str): The folder holding the frames, searched recursively.
+        limit (int, optional): The maximum number of frames to return.
+
+    Returns:
+        list: The sorted frame paths.
+    """
+    files = sorted(glob.glob(os.path.join(folder, "**/*.jpg"), recursive=True))
+    return files[:limit] if limit else files
+
+
+def reference_is_gray(file):
+    """
+    The original gray criterion: a full decode from disk and identical blue and
+    green channels on the bottom half of the image.
+
+    Args:
+        file (str): The path to the image file.
+
+    Returns:
+        bool: True if the frame is gray, unreadable frames count as gray.
+    """
+    im = cv2.imread(file)
+    if im is None:
+        return True
+    h = im.shape[0]
+    im_half = im[h // 2 :, :, :]
+    d = np.max(im_half[:, :, 0] - im_half[:, :, 1])
+    return d == 0
+
+
+def bench_gray(args):
+    """
+    Compare the in-memory gray check with the original criterion on a set of frames, both for
+    agreement and for speed.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    from dl_images import check_frame
+
+    files = list_frames(args.folder, args.limit)
+    frames = []
+    for file in files:
+        with open(file, "rb") as f:
+            frames.append(f.read())
+
+    start = time.perf_counter()
+    reference = [reference_is_gray(file) for file in files]
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fast = [not check_frame(frame)[0] for frame in frames]
+    fast_time = time.perf_counter() - start
+
+    mismatches = [file for file, r, g in zip(files, reference, fast) if r != g]
+    print(f"Frames: {len(files)}, gray: {sum(reference)}")
+    print(f"Reference: {len(files) / reference_time:.1f} frames/s")
+    print(f"Inline check: {len(files) / fast_time:.1f} frames/s")
+    print(f"Mismatches: {len(mismatches)}")
+    for file in mismatches:
+        print(f"  {file}")
+
+
+def bench_detect(args):
+    """
+    Compare the throughput of the in-process ONNX detector with the `yolo predict` subprocess on
+    a folder of frames.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    import process_awf
+
+    files = sorted(glob.glob(os.path.join(args.folder, "*.jpg")))
+    name = "benchmark"
+
+    start = time.perf_counter()
+    yolo = process_awf.predict_with_yolo(args.folder, args.weight, args.conf, name)
+    yolo_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    detector = process_awf.Detector(
+        args.weight, conf=args.conf, imgsz=process_awf.IMGSZ, batch_size=args.batch
+    )
+    load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    onnx = detector.predict(files)
+    onnx_time = time.perf_counter() - start
+
+    print(f"Frames: {len(files)}")
+    print(
+        f"yolo subprocess: {len(files) / yolo_time:.1f} images/s, "
+        f"{len(yolo)} frames with detections"
+    )
+    print(
+        f"onnxruntime: {len(files) / onnx_time:.1f} images/s "
+        f"(+{load_time:.2f}s model load), {len(onnx)} frames with detections"
+    )
+    print(f"Frames with detections in both: {len(set(yolo) & set(onnx))}")
+
+
+def bench_windows(args):
+    """
+    Time filter_by_windows on random camera days. Its output is checked against the original
+    implementation by tests/test_windows.py.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    from process_awf import filter_by_windows
+
+    rng = random.Random(args.seed)
+    elapsed = 0.0
+    with tempfile.TemporaryDirectory() as cam_folder:
+        for _ in range(args.runs):
+            for file in glob.glob(cam_folder + "/*"):
+                os.remove(file)
+            start = datetime(2024, 7, 1)
+            offsets = sorted(rng.sample(range(24 * 3600), args.frames))
+            imgs = []
+            for offset in offsets:
+                name = (start + timedelta(seconds=offset)).strftime("%Y_%m_%dT%H_%M_%S")
+                imgs.append(os.path.join(cam_folder, f"{name}.jpg"))
+                open(imgs[-1], "w").close()
+            labels = rng.sample(imgs, int(len(imgs) * args.detection_rate))
+
+            t0 = time.perf_counter()
+            filter_by_windows(cam_folder, labels)
+            elapsed += time.perf_counter() - t0
+
+    print(f"{args.runs} runs of {args.frames} frames")
+    print(f"Sorted sweep: {elapsed / args.runs * 1000:.1f} ms/run")
+
+
+def bench_ocr(args):
+    """
+    Compare per-page and batched OCR throughput on a set of frames.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    import split_cams
+
+    files = list_frames(args.folder, args.limit)
+    model = split_cams.get_model(args.device)
+    # Warm up so that the first timing does not include lazy initializations
+    split_cams.run_ocr(files[:1], model, batch_size=1)
+
+    start = time.perf_counter()
+    single = split_cams.run_ocr(files, model, batch_size=1)
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = split_cams.run_ocr(files, model, batch_size=args.batch)
+    batched_time = time.perf_counter() - start
+
+    agree = sum(a == b for a, b in zip(single, batched))
+    print(f"Frames: {len(files)} on {args.device}, crop {split_cams.OCR_CROP}")
+    print(f"Per page: {len(files) / single_time:.2f} frames/s")
+    print(f"Batches of {args.batch}: {len(files) / batched_time:.2f} frames/s")
+    print(f"Identical x values: {agree}/{len(files)}")
+
+
+def rand_index(labels_a, labels_b):
+    """
+    Compute the Rand index of two partitions of the same items: the fraction of item pairs on
+    which they agree, together or apart.
+
+    Args:
+        labels_a (list): The group of each item in the first partition.
+        labels_b (list): The group of each item in the second partition.
+
+    Returns:
+        float: The Rand index, 1 for identical partitions.
+    """
+    n = len(labels_a)
+    if n < 2:
+        return 1.0
+    _, a = np.unique(labels_a, return_inverse=True)
+    _, b = np.unique(labels_b, return_inverse=True)
+    contingency = np.zeros((a.max() + 1, b.max() + 1), np.int64)
+    np.add.at(contingency, (a, b), 1)
+
+    def pairs(counts):
+        return (counts * (counts - 1) // 2).sum()
+
+    total = n * (n - 1) // 2
+    both = pairs(contingency)
+    return (
+        total + 2 * both - pairs(contingency.sum(1)) - pairs(contingency.sum(0))
+    ) / total
+
+
+def bench_split(args):
+    """
+    Measure the agreement of the signature split with the OCR split on camera folders, and the
+    time both take.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    import split_cams
+
+    # Both splits must pay for their own OCR calls
+    split_cams.OCR_CACHE_SIZE = 0
+    folders = sorted({os.path.dirname(file) for file in list_frames(args.folder)})[
+        : args.limit
+    ]
+    ocr_time, signature_time, frames = 0.0, 0.0, 0
+    for folder in folders:
+        files = sorted(glob.glob(os.path.join(folder, "*.jpg")))
+        frames += len(files)
+
+        start = time.perf_counter()
+        by_ocr = split_cams.group_frames_by_ocr(files)
+        ocr_time += time.perf_counter() - start
+        start = time.perf_counter()
+        by_signature = split_cams.group_frames_by_signature(files)
+        signature_time += time.perf_counter() - start
+
+        ocr_labels = {f: g for g, items in by_ocr.items() for f, _ in items}
+        signature_labels = {f: g for g, items in by_signature.items() for f, _ in items}
+        index = rand_index(
+            [ocr_labels[f] for f in files], [signature_labels[f] for f in files]
+        )
+        print(
+            f"{folder}: {len(files)} frames, {len(by_ocr)} OCR groups, "
+            f"{len(by_signature)} signature groups, Rand index {index:.3f}"
+        )
+
+    print(f"OCR split: {frames / ocr_time:.2f} frames/s")
+    print(f"Signature split: {frames / signature_time:.2f} frames/s")
+
+
+def bench_dedup(args):
+    """
+    Measure the share of frames the near duplicate suppression flags on camera folders, for a
+    range of Hamming distances, and the cost of the gray check with the hash.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    import dl_images
+
+    folders = sorted({os.path.dirname(file) for file in list_frames(args.folder)})
+    phashes, frames = [], 0
+    start = time.perf_counter()
+    for folder in folders[: args.limit]:
+        hashes = []
+        for file in sorted(glob.glob(os.path.join(folder, "*.jpg"))):
+            with open(file, "rb") as f:
+                keep, phash = dl_images.check_frame(f.read())
+            frames += 1
+            if keep:
+                hashes.append(phash)
+        phashes.append(hashes)
+    check_time = time.perf_counter() - start
+    print(f"Frames: {frames}, gray check and hash: {frames / check_time:.1f} frames/s")
+
+    color = sum(len(hashes) for hashes in phashes)
+    for distance in args.distances:
+        dl_images.DEDUP_DISTANCE = distance
+        duplicates = 0
+        for hashes in phashes:
+            recent = []
+            duplicates += sum(dl_images.is_duplicate(h, recent) for h in hashes)
+        print(
+            f"Distance {distance}: {duplicates}/{color} color frames flagged "
+            f"({duplicates / max(color, 1):.1%}), "
+            f"keeping at least 1 in {dl_images.DEDUP_KEEP_EVERY}"
+        )
+
+
+def bench_archive(args):
+    """
+    Compare the copy and zip archive of the kept frames with the tar shard, in time and size, and
+    time the random reads of the shard.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    from process_awf import archive_tar, archive_zip
+    from shards import ShardReader
+
+    files = list_frames(args.folder, args.limit)
+    # Every 10th frame gets a label, like a folder with a few detections
+    detections = {file: "0 0.5 0.5 0.1 0.1 0.9\n" for file in files[::10]}
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for fmt, archive in (("zip", archive_zip), ("tar", archive_tar)):
+            save_folder = os.path.join(tmp, fmt, "camera_day")
+            start = time.perf_counter()
+            archive(save_folder, set(files), set(detections), detections)
+            elapsed = time.perf_counter() - start
+            results[fmt] = elapsed, os.path.getsize(f"{save_folder}.{fmt}")
+            print(
+                f"{fmt}: {len(files) / elapsed:.1f} frames/s, "
+                f"{results[fmt][1] / 2**20:.1f} MiB"
+            )
+
+        with ShardReader(os.path.join(tmp, "tar", "camera_day.tar")) as reader:
+            names = reader.names()
+            start = time.perf_counter()
+            for name in random.sample(names, min(len(names), 1000)):
+                reader.read(name)
+            elapsed = time.perf_counter() - start
+            print(f"Shard random reads: {min(len(names), 1000) / elapsed:.0f} files/s")
+
+
+def synthetic_frames(count, size, gray_rate, seed=0):
+    """
+    Encode distinct JPEG frames looking like smooth outdoor scenes, a share of them gray like
+    the night frames of the cameras.
+
+    Args:
+        count (int): The number of frames.
+        size (tuple): The (width, height) of the frames.
+        gray_rate (float): The share of gray frames.
+        seed (int): The random seed.
+
+    Returns:
+        list: The JPEG frames.
+    """
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i in range(count):
+        small = rng.integers(0, 256, (size[1] // 16, size[0] // 16, 3), dtype=np.uint8)
+        im = cv2.resize(small, size, interpolation=cv2.INTER_CUBIC)
+        if rng.random() < gray_rate:
+            im = cv2.cvtColor(cv2.cvtColor(im, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
+        _, jpeg = cv2.imencode(".jpg", im, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        frames.append(jpeg.tobytes())
+    return frames
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the AlertWildfire endpoints: the camera list and the multipart timelapse
+    streams, with a latency before each response, a bandwidth cap per connection and a share of
+    503 errors.
+
+    Args:
+        cameras (int): The number of cameras listed.
+        frames (int): The number of frames per timelapse.
+        latency (float): The seconds before each response.
+        bandwidth (float): The bytes per second of each connection, 0 for no cap.
+        error_rate (float): The share of timelapse requests answered with a 503.
+        frame_pool (list): The JPEG frames the timelapses are made of.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, cameras, frames, latency, bandwidth, error_rate, frame_pool):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.cameras = cameras
+        self.frames = frames
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.frame_pool = frame_pool
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def count(self, sent=0, error=False):
+        with self.lock:
+            self.bytes_sent += sent
+            self.requests += 1
+            self.errors += int(error)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        url = urlparse(self.path)
+        if url.path.endswith("all_cameras-v2.json"):
+            features = [
+                {"properties": {"id": f"Bench-{i:03d}", "state": "AZ"}}
+                for i in range(server.cameras)
+            ]
+            body = json.dumps({"features": features}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            server.count(len(body))
+            return
+
+        if random.random() < server.error_rate:
+            self.send_error(503)
+            server.count(error=True)
+            return
+
+        source = parse_qs(url.query).get("source", [""])[0]
+        offset = sum(source.encode())
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+        self.end_headers()
+        sent = 0
+        try:
+            for i in range(server.frames):
+                frame = server.frame_pool[(offset + i) % len(server.frame_pool)]
+                part = (
+                    b"--frame\r\nContent-Type: image/jpeg\r\n"
+                    + f"Content-Length: {len(frame)}\r\n\r\n".encode()
+                    + frame
+                    + b"\r\n"
+                )
+                for j in range(0, len(part), 64 * 1024):
+                    piece = part[j : j + 64 * 1024]
+                    self.wfile.write(piece)
+                    sent += len(piece)
+                    if server.bandwidth:
+                        time.sleep(len(piece) / server.bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        server.count(sent)
+
+
+def start_stand_in(args):
+    """
+    Start a stand-in server and point the scraper endpoints to it.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+
+    Returns:
+        StandInServer: The running server.
+    """
+    frame_pool = synthetic_frames(
+        args.pool, (args.width, args.height), args.gray_rate, args.seed
+    )
+    server = StandInServer(
+        args.cameras,
+        args.frames,
+        args.latency,
+        args.bandwidth * 2**20,
+        args.error_rate,
+        frame_pool,
+    )
+    server.start()
+    os.environ["CAMERAS_URL"] = f"{server.url}/all_cameras-v2.json"
+    os.environ["TIMELAPSE_URL"] = (
+        f"{server.url}/timelapse/?source={{source}}&preset={{duration}}"
+    )
+    return server
+
+
+def bench_scrape(args):
+    """
+    Scrape a local stand-in server end to end in a temporary output folder: download with the
+    inline gray filter, then move the camera folders into the split tree. Reports the throughput,
+    the wall time of each stage and the peak memory.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    server = start_stand_in(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        # The scraper modules read their settings when they are imported
+        os.environ["OUTPUT_PATH"] = tmp
+        # Every stand-in camera is downloaded, whatever its local time
+        os.environ["CAMERA_SCHEDULING"] = "0"
+        import asyncio
+
+        import dl_images
+        from moves import move_batch
+        from split_cams import catalog_moves, manifest_path
+
+        features = dl_images.get_session().get(dl_images.CAMERAS_URL).json()["features"]
+        start = time.perf_counter()
+        if args.engine == "async":
+            asyncio.run(dl_images.download_and_process_images_async(features))
+        else:
+            dl_images.download_and_process_images(features)
+        download_time = time.perf_counter() - start
+        dl_images.get_gray_pool().shutdown()
+
+        catalog = dl_images.get_catalog()
+        counts = dict(
+            catalog.execute("SELECT stage, COUNT(*) FROM frames GROUP BY stage")
+        )
+        start = time.perf_counter()
+        for folder in catalog.pending_folders("downloaded", dl_images.FRAMES_PATH):
+            new_folder = os.path.join(
+                folder.replace("dl_frames", "dl_frames_splited"), "cam_00"
+            )
+            move_batch(
+                manifest_path(folder),
+                [["dir", folder, new_folder]],
+                lambda operations: catalog_moves(catalog, operations),
+            )
+        move_time = time.perf_counter() - start
+
+    frames = counts.get("downloaded", 0) + counts.get("rejected", 0)
+    report = {
+        "engine": args.engine,
+        "cameras": args.cameras,
+        "frames": frames,
+        "frames_written": counts.get("downloaded", 0),
+        "frames_rejected": counts.get("rejected", 0),
+        "requests": server.requests,
+        "errors": server.errors,
+        "bytes": server.bytes_sent,
+        "download_s": round(download_time, 3),
+        "move_s": round(move_time, 3),
+        "frames_per_s": round(frames / download_time, 1),
+        "mib_per_s": round(server.bytes_sent / 2**20 / download_time, 2),
+        # ru_maxrss is in KiB on Linux, the server frames are part of the main process
+        "peak_rss_mib": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        ),
+        "peak_child_rss_mib": round(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        ),
+    }
+    server.shutdown()
+    if args.json:
+        print(json.dumps(report))
+        return
+    print(
+        f"{report['frames']} frames ({report['frames_rejected']} gray) from "
+        f"{args.cameras} cameras, {server.errors}/{server.requests} requests failed"
+    )
+    print(
+        f"Download: {report['download_s']} s, {report['frames_per_s']} frames/s, "
+        f"{report['mib_per_s']} MiB/s"
+    )
+    print(f"Move: {report['move_s']} s")
+    print(
+        f"Peak RSS: {report['peak_rss_mib']} MiB, "
+        f"gray workers {report['peak_child_rss_mib']} MiB"
+    )
+
+
+def bench_serve(args):
+    """
+    Run a stand-in server in the foreground, for the scripts to scrape it.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    server = start_stand_in(args)
+    print(f"CAMERAS_URL={os.environ['CAMERAS_URL']}")
+    print(f"TIMELAPSE_URL='{os.environ['TIMELAPSE_URL']}'")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+def skewed_folders(root, count, mean_frames, skew, seed=0):
+    """
+    Write camera folders of synthetic frames whose sizes follow a lognormal distribution, like
+    the folders of a day where a few turning cameras hold most of the frames.
+
+    Args:
+        root (str): The dl_frames folder to fill.
+        count (int): The number of folders.
+        mean_frames (int): The median number of frames per folder.
+        skew (float): The sigma of the lognormal distribution of the folder sizes.
+        seed (int): The random seed.
+
+    Returns:
+        list: The records of the frames, for the catalog.
+    """
+    rng = np.random.default_rng(seed)
+    sizes = np.clip(rng.lognormal(np.log(mean_frames), skew, count), 1, 8000)
+    frame_pool = synthetic_frames(16, (640, 360), 0, seed)
+    start = datetime(2024, 1, 1)
+    frames = []
+    for i, size in enumerate(sizes.astype(int)):
+        camera = f"cam_{i:03d}"
+        folder = os.path.join(root, "2024_01_01", camera)
+        os.makedirs(folder)
+        for j in range(size):
+            name = (start + timedelta(seconds=10 * j)).strftime("%Y_%m_%dT%H_%M_%S")
+            path = os.path.join(folder, f"{name}.jpg")
+            with open(path, "wb") as f:
+                f.write(frame_pool[(i + j) % len(frame_pool)])
+            frames.append(
+                dict(path=path, camera=camera, day="2024_01_01", stage="downloaded")
+            )
+    return frames
+
+
+def bench_batching(args):
+    """
+    Compare the detection of skewed folders one folder per pool task with the batched detection
+    sharing a frame queue between the workers: folder latency percentiles, wall time and worker
+    utilization, the share of the wall time the workers spent in inference.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    from functools import partial
+    from multiprocessing import Pool
+
+    import metrics
+    import process_awf
+    from catalog import FrameCatalog
+
+    reports = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("folder", "batched"):
+            root = os.path.join(tmp, mode, "dl_frames")
+            frames = skewed_folders(
+                root, args.folders, args.frames, args.skew, args.seed
+            )
+            catalog_path = os.path.join(tmp, mode, "catalog.sqlite")
+            catalog = FrameCatalog(catalog_path)
+            catalog.add_frames(frames)
+            folders = catalog.pending_folders("downloaded")
+            done_folder = os.path.join(tmp, mode, "done")
+
+            if mode == "folder":
+                pool = Pool(
+                    args.workers,
+                    initializer=process_awf.init_worker,
+                    initargs=(catalog_path,),
+                )
+            else:
+                pool = process_awf.BatchedDetection(
+                    args.workers, args.weight, args.conf, done_folder, catalog
+                )
+            # The workers are timed from their first folder, not from their start
+            time.sleep(args.warmup)
+            metrics.reset()
+            latencies = []
+            finished = threading.Semaphore(0)
+            start = time.perf_counter()
+
+            def done(result, error=None):
+                latencies.append(time.perf_counter() - start)
+                if error is not None:
+                    print(f"Folder failed: {error}")
+                if result:
+                    metrics.merge(result)
+                finished.release()
+
+            if mode == "folder":
+                for folder in folders:
+                    pool.apply_async(
+                        process_awf.process_camera_folder,
+                        (folder, args.weight, args.conf, done_folder),
+                        callback=done,
+                        error_callback=partial(done, None),
+                    )
+            else:
+                for folder in folders:
+                    pool.submit(folder, "downloaded", done, partial(done, None))
+            for _ in folders:
+                finished.acquire()
+            wall = time.perf_counter() - start
+            pool.close()
+            if mode == "folder":
+                pool.join()
+
+            busy = sum(
+                histogram["sum"]
+                for name, _, histogram in metrics.snapshot()["histograms"]
+                if name == "inference_batch_seconds"
+            )
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            reports[mode] = {
+                "wall": round(wall, 3),
+                "latency_p50": round(float(p50), 3),
+                "latency_p95": round(float(p95), 3),
+                "latency_p99": round(float(p99), 3),
+                "latency_max": round(max(latencies), 3),
+                "utilization": round(busy / (args.workers * wall), 3),
+            }
+
+    print(f"{args.folders} folders, {len(frames)} frames, {args.workers} workers")
+    for mode, report in reports.items():
+        print(
+            f"{mode}: {report['wall']:.2f} s, folder latency p50 "
+            f"{report['latency_p50']:.2f} s, p95 {report['latency_p95']:.2f} s, "
+            f"p99 {report['latency_p99']:.2f} s, max {report['latency_max']:.2f} s, "
+            f"utilization {report['utilization']:.0%}"
+        )
+    if args.json:
+        print(json.dumps(reports))
+
+
+def reference_letterbox(im, imgsz, color=(114, 114, 114)):
+    """Letterbox an image into new arrays, as the detector did before its buffers were pooled."""
+    h, w = im.shape[:2]
+    ratio = min(imgsz[0] / h, imgsz[1] / w)
+    new_w, new_h = int(round(w * ratio)), int(round(h * ratio))
+    pad_w, pad_h = (imgsz[1] - new_w) / 2, (imgsz[0] - new_h) / 2
+    if (w, h) != (new_w, new_h):
+        im = cv2.resize(im, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(pad_h - 0.1)), int(round(pad_h + 0.1))
+    left, right = int(round(pad_w - 0.1)), int(round(pad_w + 0.1))
+    im = cv2.copyMakeBorder(
+        im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color
+    )
+    return im, ratio, (left, top)
+
+
+def reference_detect_inputs(files, imgsz=(384, 640), batch_size=8):
+    """Read and letterbox frames into input tensors, as the detector did with cv2.imread."""
+    for i in range(0, len(files), batch_size):
+        images = [cv2.imread(file) for file in files[i : i + batch_size]]
+        batch = np.full((len(images), 3, *imgsz), 114 / 255, np.float32)
+        for j, im in enumerate(images):
+            im, _, _ = reference_letterbox(im, imgsz)
+            batch[j] = im[:, :, ::-1].transpose(2, 0, 1) / 255
+
+
+def detect_inputs(files, imgsz=(384, 640), batch_size=8):
+    """Read and letterbox frames into input tensors with the frame access layer and pools."""
+    from detector import Detector, iter_decoded
+    from frames import BufferPool
+
+    # The input preparation of the detector, without a model to load
+    detector = Detector.__new__(Detector)
+    detector.imgsz, detector.batch_size, detector.static_batch = (
+        imgsz,
+        batch_size,
+        False,
+    )
+    detector.batches = BufferPool((batch_size, 3, *imgsz), np.float32, "bench")
+    detector.canvases = BufferPool((*imgsz, 3), np.uint8, "bench")
+    for i in range(0, len(files), batch_size):
+        tensor = detector.batches.take()
+        detector.preprocess(iter_decoded(files[i : i + batch_size], []), tensor)
+        detector.batches.give(tensor)
+
+
+def reference_ocr_pages(files):
+    """Load the overlays of frames as doctr's DocumentFile.from_images and a crop view did."""
+    from split_cams import crop_overlay
+
+    pages = [cv2.cvtColor(cv2.imread(file), cv2.COLOR_BGR2RGB) for file in files]
+    return [crop_overlay(page) for page in pages]
+
+
+def ocr_pages(files):
+    """Load the overlays of frames with the frame access layer."""
+    from split_cams import load_overlay
+
+    return [load_overlay(file) for file in files]
+
+
+def reference_archive_zip(files):
+    """Archive frames by copying them to a folder and zipping it, as the detect stage did."""
+    import shutil
+
+    with tempfile.TemporaryDirectory() as tmp:
+        save_folder = os.path.join(tmp, "camera_day")
+        os.makedirs(os.path.join(save_folder, "images"))
+        for file in files:
+            shutil.copy(file, os.path.join(save_folder, "images"))
+        shutil.make_archive(save_folder, "zip", save_folder)
+
+
+def archive_frames(files):
+    """Archive frames streamed from their files into a zip."""
+    from process_awf import archive_zip
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archive_zip(os.path.join(tmp, "camera_day"), set(files), set(), {})
+
+
+def measure_frames(func, files, traced):
+    """
+    Run a way of handling frames in a forked process, so that its memory is measured alone.
+
+    Args:
+        func (callable): Called with the frames.
+        files (list): The frames.
+        traced (bool): Whether to trace the Python and numpy allocations, which slows the run.
+
+    Returns:
+        dict: The "seconds" of the run, the "rss" increase of the process at its peak, and the
+            "traced" peak of the allocations.
+    """
+    import multiprocessing
+
+    def run(results):
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * resource.getpagesize()
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        func(files)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if traced else 0
+        # ru_maxrss is in KiB on Linux, and starts from the RSS of the parent at the fork
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        results.put({"seconds": seconds, "rss": maxrss - rss, "traced": peak})
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    process = context.Process(target=run, args=(results,))
+    process.start()
+    report = results.get()
+    process.join()
+    return report
+
+
+def bench_frames(args):
+    """
+    Compare the frame access layer, mapped files decoded once into pooled buffers, with the
+    previous reads and copies, for the detector inputs, the OCR overlays and the zip archive. The
+    copies are the peak of the traced allocations in decoded frames: the buffers alive at once.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    files = list_frames(args.folder, args.limit)
+    im = cv2.imread(files[0])
+    frame_size = im.nbytes
+    print(f"{len(files)} frames of {im.shape[1]}x{im.shape[0]}")
+    reports = {}
+    scenarios = {
+        "detect": (reference_detect_inputs, detect_inputs),
+        "ocr": (reference_ocr_pages, ocr_pages),
+        "archive": (reference_archive_zip, archive_frames),
+    }
+    for scenario, funcs in scenarios.items():
+        for version, func in zip(("reference", "frames"), funcs):
+            report = measure_frames(func, files, traced=False)
+            report["traced"] = measure_frames(func, files, traced=True)["traced"]
+            report["copies"] = report["traced"] / frame_size
+            reports[f"{scenario}_{version}"] = report
+            print(
+                f"{scenario} {version}: {len(files) / report['seconds']:.1f} frames/s, "
+                f"peak RSS +{report['rss'] / 2**20:.0f} MiB, "
+                f"peak allocations {report['traced'] / 2**20:.0f} MiB "
+                f"({report['copies']:.1f} frames)"
+            )
+    if args.json:
+        print(json.dumps(reports))
+
+
+def add_stand_in_arguments(parser):
+    """
+    Add the settings of the stand-in server to a subcommand.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser of the subcommand.
+    """
+    parser.add_argument("--cameras", type=int, default=50)
+    parser.add_argument("--frames", type=int, default=60, help="Frames per timelapse")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds")
+    parser.add_argument(
+        "--bandwidth", type=float, default=0, help="MiB/s per connection, 0 for no cap"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--gray-rate", type=float, default=0.2)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--pool", type=int, default=32, help="Distinct frames served")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+# Main Script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    gray_parser = subparsers.add_parser(
+        "gray", help="Gray check agreement and throughput on a fixture set"
+    )
+    gray_parser.add_argument("folder", help="Folder of JPEG frames")
+    gray_parser.add_argument("--limit", type=int, default=None)
+    gray_parser.set_defaults(func=bench_gray)
+
+    detect_parser = subparsers.add_parser(
+        "detect", help="In-process ONNX inference against the yolo subprocess"
+    )
+    detect_parser.add_argument("folder", help="Folder of JPEG frames, not recursive")
+    detect_parser.add_argument("weight", help="Path to the ONNX model")
+    detect_parser.add_argument("--conf", type=float, default=0.2)
+    detect_parser.add_argument("--batch", type=int, default=8)
+    detect_parser.set_defaults(func=bench_detect)
+
+    windows_parser = subparsers.add_parser(
+        "windows", help="Detection window filtering speed"
+    )
+    windows_parser.add_argument("--frames", type=int, default=3000)
+    windows_parser.add_argument("--detection-rate", type=float, default=0.05)
+    windows_parser.add_argument("--runs", type=int, default=20)
+    windows_parser.add_argument("--seed", type=int, default=0)
+    windows_parser.set_defaults(func=bench_windows)
+
+    ocr_parser = subparsers.add_parser(
+        "ocr", help="Per-page against batched OCR throughput"
+    )
+    ocr_parser.add_argument("folder", help="Folder of JPEG frames")
+    ocr_parser.add_argument("--device", default="cpu")
+    ocr_parser.add_argument("--batch", type=int, default=16)
+    ocr_parser.add_argument("--limit", type=int, default=64)
+    ocr_parser.set_defaults(func=bench_ocr)
+
+    split_parser = subparsers.add_parser(
+        "split", help="Signature split against OCR split on camera folders"
+    )
+    split_parser.add_argument("folder", help="Tree of camera folders")
+    split_parser.add_argument("--limit", type=int, default=None)
+    split_parser.set_defaults(func=bench_split)
+
+    dedup_parser = subparsers.add_parser(
+        "dedup", help="Near duplicate suppression rate on camera folders"
+    )
+    dedup_parser.add_argument("folder", help="Tree of camera folders")
+    dedup_parser.add_argument("--distances", type=int, nargs="+", default=[2, 4, 6, 8])
+    dedup_parser.add_argument("--limit", type=int, default=None)
+    dedup_parser.set_defaults(func=bench_dedup)
+
+    archive_parser = subparsers.add_parser(
+        "archive", help="Copy and zip archive against tar shard"
+    )
+    archive_parser.add_argument("folder", help="Folder of JPEG frames")
+    archive_parser.add_argument("--limit", type=int, default=None)
+    archive_parser.set_defaults(func=bench_archive)
+
+    scrape_parser = subparsers.add_parser(
+        "scrape", help="End to end scrape of a local stand-in server"
+    )
+    add_stand_in_arguments(scrape_parser)
+    scrape_parser.add_argument(
+        "--engine", choices=["threads", "async"], default="threads"
+    )
+    scrape_parser.add_argument(
+        "--json", action="store_true", help="Print a JSON report"
+    )
+    scrape_parser.set_defaults(func=bench_scrape)
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="Run a local stand-in server for the scripts to scrape"
+    )
+    add_stand_in_arguments(serve_parser)
+    serve_parser.set_defaults(func=bench_serve)
+
+    batching_parser = subparsers.add_parser(
+        "batching", help="Per folder against batched detection of skewed folders"
+    )
+    batching_parser.add_argument("weight", help="Path to the ONNX model")
+    batching_parser.add_argument("--folders", type=int, default=40)
+    batching_parser.add_argument(
+        "--frames", type=int, default=60, help="Median frames per folder"
+    )
+    batching_parser.add_argument(
+        "--skew", type=float, default=1.2, help="Sigma of the lognormal folder sizes"
+    )
+    batching_parser.add_argument("--workers", type=int, default=4)
+    batching_parser.add_argument("--conf", type=float, default=0.2)
+    batching_parser.add_argument("--seed", type=int, default=0)
+    batching_parser.add_argument(
+        "--warmup", type=float, default=5, help="Seconds left to the workers to start"
+    )
+    batching_parser.add_argument(
+        "--json", action="store_true", help="Print a JSON report"
+    )
+    batching_parser.set_defaults(func=bench_batching)
+
+    frames_parser = subparsers.add_parser(
+        "frames", help="Memory and copies of the frame access layer against plain reads"
+    )
+    frames_parser.add_argument("folder", help="Folder of JPEG frames")
+    frames_parser.add_argument("--limit", type=int, default=50)
+    frames_parser.add_argument(
+        "--json", action="store_true", help="Print a JSON report"
+    )
+    frames_parser.set_defaults(func=bench_frames)
+
+    args = parser.parse_args()
+    args.func(args)
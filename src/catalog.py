@@ -0,0 +1,388 @@
+import glob
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+from dotenv import load_dotenv
+
+from timestamps import FRAME_TIME_PATTERN, parse_frame_times
+
+load_dotenv()
+OUTPUT_BASE_PATH = os.getenv("OUTPUT_PATH", "AWF_scrap")
+CATALOG_PATH = os.getenv(
+    "CATALOG_PATH", os.path.join(OUTPUT_BASE_PATH, "catalog.sqlite")
+)
+# Present in a camera folder while dl_images.py is writing frames to it
+INCOMPLETE_MARKER = ".incomplete"
+# Present in a camera folder while the detection is working on it, which keeps it from eviction
+PROCESSING_MARKER = ".processing"
+
+# Stages of a frame, in pipeline order. Gray frames are recorded as rejected without a path,
+# frames removed by the storage governor before their detection as evicted.
+STAGES = ("rejected", "downloaded", "split", "archived", "removed", "evicted")
+# Stages of the frames waiting on disk for their detection
+PENDING_STAGES = ("downloaded", "split")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    folder TEXT,
+    camera TEXT NOT NULL,
+    day TEXT NOT NULL,
+    preset TEXT,
+    timestamp INTEGER,
+    size INTEGER,
+    hash TEXT,
+    phash TEXT,
+    stage TEXT NOT NULL,
+    gray INTEGER NOT NULL DEFAULT 0,
+    duplicate INTEGER NOT NULL DEFAULT 0,
+    ocr_x REAL,
+    detections TEXT
+);
+CREATE INDEX IF NOT EXISTS frames_stage_folder ON frames (stage, folder);
+CREATE INDEX IF NOT EXISTS frames_camera_day ON frames (camera, day);
+CREATE TABLE IF NOT EXISTS cameras (
+    camera TEXT PRIMARY KEY,
+    downloads INTEGER NOT NULL DEFAULT 0,
+    failure_rate REAL NOT NULL DEFAULT 0,
+    latency REAL,
+    last_download REAL
+);
+"""
+
+# Weight of the last download in the moving averages of the camera stats
+STATS_DECAY = 0.2
+
+# Flag columns, unset in a record means 0
+FLAGS = {"gray": 0, "duplicate": 0}
+
+# Columns added after the first version of the schema, created on older catalogs
+MIGRATIONS = {
+    "phash": "TEXT",
+    "duplicate": "INTEGER NOT NULL DEFAULT 0",
+}
+
+FIELDS = (
+    "camera",
+    "day",
+    "preset",
+    "timestamp",
+    "size",
+    "hash",
+    "phash",
+    "stage",
+    "gray",
+    "duplicate",
+)
+
+
+def frame_timestamp(path):
+    """
+    Get the timestamp of a frame from its name.
+
+    Args:
+        path (str): The frame path.
+
+    Returns:
+        int: The epoch seconds of the frame, or None if the name holds no timestamp.
+    """
+    if path is None or not FRAME_TIME_PATTERN.search(path):
+        return None
+    return int(parse_frame_times([path])[0])
+
+
+class FrameCatalog:
+    """
+    SQLite index of the frames shared by the pipeline stages. Each stage records what it does to
+    the frames and queries the catalog for its pending work instead of walking the frame tree.
+    Paths are stored absolute so that all the stages agree on them.
+
+    Args:
+        path (str): The path to the database.
+    """
+
+    def __init__(self, path=CATALOG_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(frames)")}
+        with self.conn:
+            for column, definition in MIGRATIONS.items():
+                if column not in columns:
+                    self.conn.execute(
+                        f"ALTER TABLE frames ADD COLUMN {column} {definition}"
+                    )
+        self.lock = threading.Lock()
+
+    def execute(self, query, params=()):
+        """
+        Run a query and commit it.
+
+        Args:
+            query (str): The SQL query.
+            params (tuple): The query parameters.
+
+        Returns:
+            list: The rows returned by the query.
+        """
+        with self.lock, self.conn:
+            return self.conn.execute(query, params).fetchall()
+
+    def add_frames(self, frames):
+        """
+        Record frames, replacing the previous record of the same path.
+
+        Args:
+            frames (list): The frames as dicts with a "path" (None for rejected frames) and any of
+                the FIELDS.
+        """
+        rows = []
+        for frame in frames:
+            path = frame.get("path")
+            path = os.path.abspath(path) if path is not None else None
+            values = dict(FLAGS, **frame)
+            values.setdefault("timestamp", frame_timestamp(path))
+            rows.append(
+                (path, os.path.dirname(path) if path else None)
+                + tuple(values.get(field) for field in FIELDS)
+            )
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO frames (path, folder, {', '.join(FIELDS)}) "
+                f"VALUES ({', '.join('?' * (len(FIELDS) + 2))})",
+                rows,
+            )
+
+    def update_frames(self, updates):
+        """
+        Update fields of recorded frames.
+
+        Args:
+            updates (dict): The fields to set for each frame path, as dicts. A "new_path" field
+                moves the frame.
+        """
+        with self.lock, self.conn:
+            for path, fields in updates.items():
+                fields = dict(fields)
+                if "new_path" in fields:
+                    new_path = os.path.abspath(fields.pop("new_path"))
+                    fields["path"] = new_path
+                    fields["folder"] = os.path.dirname(new_path)
+                if not fields:
+                    continue
+                self.conn.execute(
+                    f"UPDATE frames SET {', '.join(f'{k} = ?' for k in fields)} "
+                    "WHERE path = ?",
+                    tuple(fields.values()) + (os.path.abspath(path),),
+                )
+
+    def set_folder_stage(self, folder, stage, from_stage=None):
+        """
+        Move all the frames of a folder to a stage.
+
+        Args:
+            folder (str): The folder of the frames.
+            stage (str): The new stage.
+            from_stage (str, optional): Only update the frames in this stage.
+        """
+        query = "UPDATE frames SET stage = ? WHERE folder = ?"
+        params = (stage, os.path.abspath(folder))
+        if from_stage is not None:
+            query += " AND stage = ?"
+            params += (from_stage,)
+        self.execute(query, params)
+
+    def move_folder(self, folder, new_folder, **fields):
+        """
+        Record the move of all the frames of a folder.
+
+        Args:
+            folder (str): The former folder of the frames.
+            new_folder (str): The new folder of the frames.
+            **fields: Other fields to set on the moved frames.
+        """
+        folder, new_folder = os.path.abspath(folder), os.path.abspath(new_folder)
+        assignments = "".join(f", {k} = ?" for k in fields)
+        self.execute(
+            "UPDATE frames SET path = ? || substr(path, ?), folder = ?"
+            f"{assignments} WHERE folder = ?",
+            (new_folder, len(folder) + 1, new_folder, *fields.values(), folder),
+        )
+
+    def pending_folders(self, stage, root=None):
+        """
+        List the folders holding frames in a stage.
+
+        Args:
+            stage (str): The stage of the frames.
+            root (str, optional): Only list the folders below this one.
+
+        Returns:
+            list: The sorted folders.
+        """
+        query = "SELECT DISTINCT folder FROM frames WHERE stage = ?"
+        params = (stage,)
+        if root is not None:
+            query += " AND folder LIKE ?"
+            params += (os.path.join(os.path.abspath(root), "%"),)
+        return sorted(row[0] for row in self.execute(query, params))
+
+    def folder_frames(self, folder, stage=None, duplicate=None):
+        """
+        List the frames of a folder.
+
+        Args:
+            folder (str): The folder of the frames.
+            stage (str, optional): Only list the frames in this stage.
+            duplicate (bool, optional): Only list the near duplicate frames if True, or the
+                other ones if False.
+
+        Returns:
+            list: The sorted frame paths.
+        """
+        query = "SELECT path FROM frames WHERE folder = ?"
+        params = (os.path.abspath(folder),)
+        if stage is not None:
+            query += " AND stage = ?"
+            params += (stage,)
+        if duplicate is not None:
+            query += " AND duplicate = ?"
+            params += (int(duplicate),)
+        return sorted(row[0] for row in self.execute(query, params))
+
+    def folder_sizes(self, stages=PENDING_STAGES, root=None):
+        """
+        Sum the size of the frames of each folder, as the storage governor tracks the frame tree
+        without walking it.
+
+        Args:
+            stages (tuple): Only count the frames in these stages.
+            root (str, optional): Only list the folders below this one.
+
+        Returns:
+            list: The (folder, camera, day, bytes, frames) rows of the folders.
+        """
+        query = (
+            "SELECT folder, camera, day, COALESCE(SUM(size), 0), COUNT(*) FROM frames "
+            f"WHERE folder IS NOT NULL AND stage IN ({', '.join('?' * len(stages))})"
+        )
+        params = tuple(stages)
+        if root is not None:
+            query += " AND folder LIKE ?"
+            params += (os.path.join(os.path.abspath(root), "%"),)
+        return self.execute(query + " GROUP BY folder", params)
+
+    def record_download(self, camera, failed, seconds, when):
+        """
+        Update the download stats of a camera: its failure rate and latency are moving averages
+        weighing the last download by STATS_DECAY.
+
+        Args:
+            camera (str): The camera source identifier.
+            failed (bool): Whether the download failed.
+            seconds (float): The wall time of the download, retries included.
+            when (float): The epoch seconds of the download.
+        """
+        self.execute(
+            "INSERT INTO cameras (camera, downloads, failure_rate, latency, last_download) "
+            "VALUES (?1, 1, ?2, ?3, ?4) ON CONFLICT (camera) DO UPDATE SET "
+            "downloads = downloads + 1, "
+            "failure_rate = failure_rate + ?5 * (?2 - failure_rate), "
+            "latency = COALESCE(latency + ?5 * (?3 - latency), ?3), "
+            "last_download = ?4",
+            (camera, float(failed), seconds, when, STATS_DECAY),
+        )
+
+    def camera_stats(self, since_day):
+        """
+        Gather the stats of each camera: its download stats and what became of its frames since
+        a given day.
+
+        Args:
+            since_day (str): The first day counted, as "YYYY_MM_DD".
+
+        Returns:
+            dict: For each camera, its "downloads", "failure_rate", "latency" and "last_download",
+                and the numbers of downloaded "frames", "gray" frames, frames through the
+                "detected" stage and "kept" frames with detections.
+        """
+        stats = {
+            row[0]: dict(
+                downloads=row[1],
+                failure_rate=row[2],
+                latency=row[3],
+                last_download=row[4],
+                frames=0,
+                gray=0,
+                detected=0,
+                kept=0,
+            )
+            for row in self.execute("SELECT * FROM cameras")
+        }
+        rows = self.execute(
+            "SELECT camera, COUNT(*), SUM(gray), "
+            "SUM(stage IN ('archived', 'removed')), "
+            "SUM(stage = 'archived' AND detections IS NOT NULL) "
+            "FROM frames WHERE day >= ? GROUP BY camera",
+            (since_day,),
+        )
+        for camera, frames, gray, detected, kept in rows:
+            stats.setdefault(
+                camera,
+                dict(downloads=0, failure_rate=0, latency=None, last_download=None),
+            )
+            stats[camera].update(frames=frames, gray=gray, detected=detected, kept=kept)
+        return stats
+
+    def rebuild(self, root=OUTPUT_BASE_PATH):
+        """
+        Rebuild the catalog from the frames on disk: dl_frames/<day>/<camera> folders are
+        downloaded, dl_frames_splited/<day>/<camera>/<preset> folders are split. Rejected frames and
+        the OCR and detection results are lost.
+
+        Args:
+            root (str): The folder holding dl_frames and dl_frames_splited.
+
+        Returns:
+            int: The number of frames recorded.
+        """
+        frames = []
+        for folder in glob.glob(os.path.join(root, "dl_frames", "*", "*")):
+            if os.path.exists(os.path.join(folder, INCOMPLETE_MARKER)):
+                continue
+            day, camera = folder.split(os.sep)[-2:]
+            for path in glob.glob(os.path.join(folder, "*.jpg")):
+                frames.append(
+                    dict(path=path, camera=camera, day=day, stage="downloaded")
+                )
+        splited = os.path.join(root, "dl_frames_splited")
+        for folder in glob.glob(os.path.join(splited, "*", "*", "*")):
+            day, camera, preset = folder.split(os.sep)[-3:]
+            for path in glob.glob(os.path.join(folder, "*.jpg")):
+                frames.append(
+                    dict(
+                        path=path, camera=camera, day=day, preset=preset, stage="split"
+                    )
+                )
+        for frame in frames:
+            frame["size"] = os.path.getsize(frame["path"])
+
+        self.execute("DELETE FROM frames")
+        self.add_frames(frames)
+        return len(frames)
+
+
+# Main Script
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != "rebuild":
+        sys.exit("Usage: python catalog.py rebuild [root folder]")
+    root = sys.argv[2] if len(sys.argv) == 3 else OUTPUT_BASE_PATH
+    count = FrameCatalog().rebuild(root)
+    logging.info(f"Catalog rebuilt with {count} frames from {root}")
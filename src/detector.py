@@ -0,0 +1,245 @@
+import cv2
+import numpy as np
+import onnxruntime
+
+import metrics
+from frames import BufferPool, decode_frame
+
+# Offset separating the boxes of different classes so that NMS runs per class in a single call
+MAX_WH = 7680
+MAX_DET = 300
+
+
+def letterbox(im, imgsz, color=(114, 114, 114), out=None):
+    """
+    Resize an image to fit in the model input size while keeping its aspect ratio, and pad the
+    borders evenly as ultralytics does.
+
+    Args:
+        im (np.ndarray): The BGR image.
+        imgsz (tuple): The model input size as (height, width).
+        color (tuple): The padding color.
+        out (np.ndarray, optional): The (height, width, 3) array the image is resized into, which
+            saves the copy of the padding, allocated if not given.
+
+    Returns:
+        tuple: The letterboxed image, the resize ratio and the (left, top) padding.
+    """
+    h, w = im.shape[:2]
+    ratio = min(imgsz[0] / h, imgsz[1] / w)
+    new_w, new_h = int(round(w * ratio)), int(round(h * ratio))
+    pad_w, pad_h = (imgsz[1] - new_w) / 2, (imgsz[0] - new_h) / 2
+    top, left = int(round(pad_h - 0.1)), int(round(pad_w - 0.1))
+    if out is None:
+        out = np.empty((imgsz[0], imgsz[1], 3), np.uint8)
+    out[:] = color
+    inner = out[top : top + new_h, left : left + new_w]
+    if (w, h) != (new_w, new_h):
+        cv2.resize(im, (new_w, new_h), dst=inner, interpolation=cv2.INTER_LINEAR)
+    else:
+        inner[:] = im
+    return out, ratio, (left, top)
+
+
+def format_labels(boxes):
+    """
+    Format detections like the label files written by `yolo predict save_txt save_conf`.
+
+    Args:
+        boxes (np.ndarray): The detections as rows of (class, x, y, w, h, confidence), normalized.
+
+    Returns:
+        str: One line per detection.
+    """
+    lines = []
+    for cls, x, y, w, h, conf in boxes:
+        line = (int(cls), x, y, w, h, conf)
+        lines.append(("%g " * len(line)).rstrip() % line)
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def iter_decoded(files, readable):
+    """
+    Decode frames one at a time, skipping those that cannot be read.
+
+    Args:
+        files (list): The image paths.
+        readable (list): Receives the paths of the decoded frames, in order.
+
+    Yields:
+        np.ndarray: The BGR images.
+    """
+    for file in files:
+        im = decode_frame(file)
+        if im is not None:
+            readable.append(file)
+            yield im
+
+
+class Detector:
+    """
+    YOLOv8 detector running in process with onnxruntime on CPU. The model is loaded once and
+    frames are letterboxed and inferred in batches.
+
+    Args:
+        weight (str): The path to the ONNX model.
+        conf (float): The confidence threshold.
+        iou (float): The IoU threshold of the non maximum suppression.
+        imgsz (tuple): The model input size as (height, width).
+        batch_size (int): The number of frames per inference call, forced to the batch size of
+            the model when it is static.
+    """
+
+    def __init__(self, weight, conf=0.2, iou=0.7, imgsz=(384, 640), batch_size=8):
+        self.session = onnxruntime.InferenceSession(
+            weight, providers=["CPUExecutionProvider"]
+        )
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.conf = conf
+        self.iou = iou
+        self.imgsz = imgsz
+        self.static_batch = isinstance(model_input.shape[0], int)
+        self.batch_size = model_input.shape[0] if self.static_batch else batch_size
+        # Input tensors and letterbox canvases reused from one batch to the next
+        self.batches = BufferPool(
+            (self.batch_size, 3, imgsz[0], imgsz[1]), np.float32, "detect_batch"
+        )
+        self.canvases = BufferPool((imgsz[0], imgsz[1], 3), np.uint8, "detect_canvas")
+
+    def preprocess(self, images, batch=None):
+        """
+        Letterbox a batch of images into the model input tensor.
+
+        Args:
+            images (iterable): The BGR images, at most batch_size. Each image is done with once
+                it is in the tensor, so a generator decoding them keeps a single one in memory.
+            batch (np.ndarray, optional): The tensor of batch_size images to fill, taken from
+                the pool of the detector if not given.
+
+        Returns:
+            tuple: The NCHW float32 tensor and the (shape, ratio, padding) of each image.
+        """
+        batch = self.batches.take() if batch is None else batch
+        canvas = self.canvases.take()
+        transforms = []
+        for i, im in enumerate(images):
+            boxed, ratio, pad = letterbox(im, self.imgsz, out=canvas)
+            # Converted straight into the tensor, without a float64 copy of the image
+            np.divide(boxed[:, :, ::-1].transpose(2, 0, 1), 255, out=batch[i])
+            transforms.append((im.shape, ratio, pad))
+        self.canvases.give(canvas)
+        # A static batch model must be fed full batches, padding images are ignored
+        size = self.batch_size if self.static_batch else len(transforms)
+        batch[len(transforms) : size] = 114 / 255
+        return batch[:size], transforms
+
+    def postprocess(self, pred, shape, ratio, pad):
+        """
+        Filter the raw predictions of an image and map them back to normalized image coordinates.
+
+        Args:
+            pred (np.ndarray): The raw predictions of shape (4 + classes, anchors).
+            shape (tuple): The shape of the original image.
+            ratio (float): The letterbox resize ratio.
+            pad (tuple): The letterbox (left, top) padding.
+
+        Returns:
+            np.ndarray: The detections as rows of (class, x, y, w, h, confidence).
+        """
+        pred = pred.T
+        scores = pred[:, 4:]
+        cls = scores.argmax(1)
+        conf = scores[np.arange(len(scores)), cls]
+        keep = conf > self.conf
+        boxes, cls, conf = pred[keep, :4], cls[keep], conf[keep]
+        if not len(boxes):
+            return np.zeros((0, 6), np.float32)
+
+        # xywh center boxes to xyxy, offset by class for a per class NMS
+        xyxy = np.concatenate(
+            [boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2], 1
+        )
+        offset = xyxy + cls[:, None] * MAX_WH
+        idx = cv2.dnn.NMSBoxes(
+            np.concatenate([offset[:, :2], offset[:, 2:] - offset[:, :2]], 1).tolist(),
+            conf.tolist(),
+            self.conf,
+            self.iou,
+        )
+        idx = np.array(idx, dtype=int).reshape(-1)[:MAX_DET]
+        xyxy, cls, conf = xyxy[idx], cls[idx], conf[idx]
+
+        h, w = shape[:2]
+        xyxy[:, [0, 2]] = ((xyxy[:, [0, 2]] - pad[0]) / ratio).clip(0, w)
+        xyxy[:, [1, 3]] = ((xyxy[:, [1, 3]] - pad[1]) / ratio).clip(0, h)
+        xywh = np.stack(
+            [
+                (xyxy[:, 0] + xyxy[:, 2]) / 2 / w,
+                (xyxy[:, 1] + xyxy[:, 3]) / 2 / h,
+                (xyxy[:, 2] - xyxy[:, 0]) / w,
+                (xyxy[:, 3] - xyxy[:, 1]) / h,
+            ],
+            1,
+        )
+        return np.column_stack([cls, xywh, conf])
+
+    def infer_batch(self, images):
+        """
+        Run the detection on a batch of images.
+
+        Args:
+            images (iterable): The BGR images, at most batch_size, see preprocess.
+
+        Returns:
+            list: The detections of each image, see postprocess.
+        """
+        tensor = self.batches.take()
+        batch, transforms = self.preprocess(images, tensor)
+        if not transforms:
+            self.batches.give(tensor)
+            return []
+        with metrics.timer("inference_batch_seconds"):
+            pred = self.session.run(None, {self.input_name: batch})[0]
+        self.batches.give(tensor)
+        metrics.inc("inference_batches_total")
+        metrics.inc("inference_frames_total", len(transforms))
+        return [
+            self.postprocess(p, *transform) for p, transform in zip(pred, transforms)
+        ]
+
+    def predict_images(self, images):
+        """
+        Run the detection on decoded images.
+
+        Args:
+            images (list): The BGR images.
+
+        Returns:
+            list: The detections of each image, see postprocess.
+        """
+        results = []
+        for i in range(0, len(images), self.batch_size):
+            results.extend(self.infer_batch(images[i : i + self.batch_size]))
+        return results
+
+    def predict(self, files):
+        """
+        Run the detection on image files, decoding each frame as its batch is filled.
+
+        Args:
+            files (list): The image paths.
+
+        Returns:
+            dict: The detections of each file that has at least one.
+        """
+        detections = {}
+        for i in range(0, len(files), self.batch_size):
+            readable = []
+            boxes = self.infer_batch(
+                iter_decoded(files[i : i + self.batch_size], readable)
+            )
+            for file, b in zip(readable, boxes):
+                if len(b):
+                    detections[file] = b
+        return detections
@@ -1,11 +1,20 @@
+import asyncio
+import calendar
 import glob
+import hashlib
+import json
 import logging
 import multiprocessing
 import os
-import shutil
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from urllib.parse import urlparse
 
+import aiohttp
 import cv2
 import numpy as np
 import pytz
@@ -13,6 +22,17 @@ import requests
 from dotenv import load_dotenv
 from tqdm import tqdm
 
+import metrics
+from catalog import CATALOG_PATH, FrameCatalog
+from priorities import CAMERA_SCHEDULING, CameraScheduler
+from storage import StorageGovernor
+from timestamps import (
+    FRAME_TIME_FORMAT,
+    interpolate_times,
+    jpeg_capture_time,
+    part_header_time,
+)
+
 # Load configurations from .env file
 load_dotenv()
 OUTPUT_BASE_PATH = os.getenv("OUTPUT_PATH", "AWF_scrap")
@@ -22,8 +42,27 @@ logging.basicConfig(level=logging.INFO)
 
 # Constants
 DURATION = "6h"
-CAMERAS_URL = (
-    "https://s3-us-west-2.amazonaws.com/alertwildfire-data-public/all_cameras-v2.json"
+# Timelapse presets available on AlertWildfire, incremental runs pick the shortest one covering
+# the time elapsed since the last successful scrape of the camera
+PRESETS = os.getenv("PRESETS", "1h,3h,6h,12h").split(",")
+PRESET_MARGIN = 5 * 60
+STATE_PATH = os.path.join(OUTPUT_BASE_PATH, "state")
+FRAMES_PATH = os.path.join(OUTPUT_BASE_PATH, "dl_frames")
+# Present in a camera folder while frames are being written to it
+INCOMPLETE_MARKER = ".incomplete"
+RECENT_HASHES = 512
+# Capture times read from the frames further than this outside of their timelapse are ignored
+CAPTURE_MARGIN = timedelta(minutes=30)
+# Origin of the epoch seconds counted in the local time of the cameras
+LOCAL_EPOCH = datetime(1970, 1, 1)
+# Overridable to scrape a stand-in server, see `benchmark.py serve`
+TIMELAPSE_URL = os.getenv(
+    "TIMELAPSE_URL",
+    "https://ts1.alertwildfire.org/text/timelapse/?source={source}&preset={duration}",
+)
+CAMERAS_URL = os.getenv(
+    "CAMERAS_URL",
+    "https://s3-us-west-2.amazonaws.com/alertwildfire-data-public/all_cameras-v2.json",
 )
 HEADERS = {
     "Connection": "keep-alive",
@@ -43,10 +82,56 @@ STATE_TIMEZONES = {
     "NV": "America/Los_Angeles",  # Nevada
     "Nevada": "America/Los_Angeles",  # Alternate name for Nevada
     "OR": "America/Los_Angeles",  # Oregon
-    "WA": "America/Los_Angeles"  # Washington
+    "WA": "America/Los_Angeles",  # Washington
     # Add other states and their timezones here
 }
+DEFAULT_TIMEZONE = "America/Phoenix"
 MAX_TIME = 100
+CHUNK_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 8 * 1024 * 1024
+FRAME_BOUNDARY = b"--frame\r\n"
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+
+# Download engine: "threads" (requests) or "async" (aiohttp)
+DOWNLOAD_ENGINE = os.getenv("DOWNLOAD_ENGINE", "threads")
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", 16))
+CAMERA_DEADLINE = float(os.getenv("CAMERA_DEADLINE", 300))
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", 3))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+HOST_MAX_IN_FLIGHT = {
+    "ts1.alertwildfire.org": int(os.getenv("TS1_MAX_IN_FLIGHT", 32)),
+    "s3-us-west-2.amazonaws.com": int(os.getenv("S3_MAX_IN_FLIGHT", 8)),
+}
+DEFAULT_HOST_MAX_IN_FLIGHT = 8
+
+# Gray frames are rejected in a process pool before being written
+GRAY_WORKERS = int(os.getenv("GRAY_WORKERS", os.cpu_count()))
+MAX_PENDING_FRAMES = 16
+# A reduced decode showing a blue/green difference above this margin proves the full frame is
+# not gray, so the full decode is only paid for frames that look gray
+GRAY_FAST_MARGIN = 8
+
+# Near duplicate suppression: "off", "drop" to not write the frames within DEDUP_DISTANCE bits of
+# the perceptual hash of a recently kept frame, or "flag" to write them and only infer those near
+# a detection
+DEDUP_MODE = os.getenv("DEDUP_MODE", "off")
+DEDUP_DISTANCE = int(os.getenv("DEDUP_DISTANCE", 4))
+# At least one frame out of DEDUP_KEEP_EVERY is kept in a run of duplicates
+DEDUP_KEEP_EVERY = int(os.getenv("DEDUP_KEEP_EVERY", 10))
+# Number of recently kept hashes compared, enough to cover all the presets of a turning camera
+DEDUP_HISTORY = 8
+# The hash skips the overlay at the top of the frame, whose clock changes on every frame
+DEDUP_TOP = 0.15
+
+_thread_local = threading.local()
+_gray_pool = None
+_gray_pool_lock = threading.Lock()
+_catalog = None
+_catalog_lock = threading.Lock()
+_governor = None
+_scheduler = None
 
 
 def duration_to_seconds(duration_str):
@@ -73,22 +158,115 @@ def duration_to_seconds(duration_str):
         raise ValueError("Invalid duration string format")
 
 
-def generate_chunks(response):
+class FrameParser:
     """
-    Splits the response content into chunks based on a specific delimiter. Each chunk represents a frame or segment.
+    Incremental parser for the multipart timelapse stream. Bytes are fed as they arrive and
+    complete JPEG frames are returned as soon as the next "--frame" boundary is seen, so at
+    most one frame is buffered at a time.
 
     Args:
-        response (requests.Response): The HTTP response containing the content to be split.
+        max_frame_size (int): The size in bytes beyond which a frame is rejected.
+        captured (list, optional): Receives the capture time found in the part headers of every
+            frame, or None.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, captured=None):
+        self.buffer = bytearray()
+        self.search_from = 0
+        self.max_frame_size = max_frame_size
+        self.captured = captured
+
+    def feed(self, data):
+        """
+        Append data to the buffer and extract every frame completed by it.
+
+        Args:
+            data (bytes): The next piece of the response body.
+
+        Returns:
+            list: The JPEG frames completed by this piece, in stream order.
+
+        Raises:
+            ValueError: If a single frame grows beyond the maximum frame size.
+        """
+        self.buffer += data
+        frames = []
+        while True:
+            idx = self.buffer.find(FRAME_BOUNDARY, self.search_from)
+            if idx == -1:
+                # The boundary may straddle two pieces, rescan only its possible start
+                self.search_from = max(0, len(self.buffer) - len(FRAME_BOUNDARY) + 1)
+                break
+            frame = self._extract_jpeg(idx)
+            del self.buffer[: idx + len(FRAME_BOUNDARY)]
+            self.search_from = 0
+            if frame is not None:
+                frames.append(frame)
+
+        if len(self.buffer) > self.max_frame_size:
+            raise ValueError(f"Frame larger than {self.max_frame_size} bytes")
+        return frames
+
+    def close(self):
+        """
+        Flush the last frame, which is not followed by a boundary.
+
+        Returns:
+            list: The remaining frame, if any.
+        """
+        frame = self._extract_jpeg(len(self.buffer))
+        self.buffer = bytearray()
+        self.search_from = 0
+        return [frame] if frame is not None else []
+
+    def _extract_jpeg(self, end):
+        """
+        Cut the JPEG image between its SOI and EOI markers out of the first `end` buffered bytes.
+
+        Args:
+            end (int): The position of the end of the current part in the buffer.
+
+        Returns:
+            bytes: The JPEG frame, or None if the part is too small or has no SOI marker.
+        """
+        if end <= 100:
+            return None
+        start = self.buffer.find(JPEG_SOI, 0, end)
+        if start == -1:
+            return None
+        stop = self.buffer.rfind(JPEG_EOI, start, end)
+        stop = stop + len(JPEG_EOI) if stop != -1 else end
+        if self.captured is not None:
+            # The part headers sit between the boundary and the image
+            self.captured.append(part_header_time(bytes(self.buffer[:start])))
+        return bytes(self.buffer[start:stop])
+
+
+def generate_chunks(response, chunk_size=CHUNK_SIZE, deadline=None, captured=None):
+    """
+    Stream the response content and yield each frame as soon as it is complete.
+
+    Args:
+        response (requests.Response): The streamed HTTP response containing the frames.
+        chunk_size (int): The size of the pieces read from the network.
+        deadline (float, optional): The time.monotonic() value after which the download is aborted.
+        captured (list, optional): Receives the capture time found in the part headers of every
+            frame, see FrameParser.
 
     Yields:
-        bytes: A chunk of the response content.
+        bytes: A JPEG frame.
+
+    Raises:
+        requests.exceptions.Timeout: If the deadline is reached before the end of the stream.
     """
 
-    chunks = response.content.split(b"--frame\r\n")
-    for chunk in chunks:
-        if len(chunk) > 100:
-            start = chunk.find(b"\xff\xd8")
-            yield chunk[start:]
+    parser = FrameParser(captured=captured)
+    for data in response.iter_content(chunk_size=chunk_size):
+        if deadline is not None and time.monotonic() > deadline:
+            raise requests.exceptions.Timeout("Camera deadline reached")
+        if data:
+            yield from parser.feed(data)
+    yield from parser.close()
 
 
 def get_camera_local_time(state):
@@ -102,33 +280,273 @@ def get_camera_local_time(state):
         datetime: The current local time for the given state.
     """
     timezone_str = STATE_TIMEZONES.get(
-        state, "America/Phoenix"
+        state, DEFAULT_TIMEZONE
     )  # Default to America/Phoenix if state not found
     timezone = pytz.timezone(timezone_str)
     return datetime.now(timezone)
 
 
+def get_session():
+    """
+    Get the HTTP session of the current thread, so that connections are kept alive and reused
+    across the cameras downloaded by a worker.
+
+    Returns:
+        requests.Session: The session of the calling thread.
+    """
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.headers.update(HEADERS)
+        _thread_local.session = session
+    return session
+
+
+def retry_delay(attempt):
+    """
+    Compute the delay before a retry using exponential backoff with full jitter.
+
+    Args:
+        attempt (int): The number of the attempt that just failed, starting at 0.
+
+    Returns:
+        float: The number of seconds to wait before the next attempt.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+def is_retryable_status(status):
+    """
+    Tell whether an HTTP error status is worth retrying.
+
+    Args:
+        status (int): The HTTP status code.
+
+    Returns:
+        bool: True for throttling and server errors.
+    """
+    return status == 429 or status >= 500
+
+
+def timelapse_url(source, duration=DURATION):
+    """
+    Build the timelapse URL of a camera.
+
+    Args:
+        source (str): The camera source identifier.
+        duration (str): The timelapse preset.
+
+    Returns:
+        str: The URL of the timelapse covering the duration.
+    """
+    return TIMELAPSE_URL.format(source=source, duration=duration)
+
+
+def frame_hash(frame):
+    """
+    Compute the content hash used to recognize frames that were already downloaded.
+
+    Args:
+        frame (bytes): The JPEG frame.
+
+    Returns:
+        str: The hexadecimal digest of the frame.
+    """
+    return hashlib.blake2b(frame, digest_size=16).hexdigest()
+
+
+def load_camera_state(source):
+    """
+    Load the scraping state of a camera, as saved after its last successful download.
+
+    Args:
+        source (str): The camera source identifier.
+
+    Returns:
+        dict: The time of the last successful scrape ("last_success", epoch seconds), the name of the
+            last frame ("last_frame") and the hashes of the most recent frames ("hashes"). Empty if the
+            camera was never scraped or if its state cannot be read.
+    """
+    try:
+        with open(os.path.join(STATE_PATH, f"{source}.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.error(f"Error loading state of {source}: {e}")
+        return {}
+
+
+def save_camera_state(source, cam_state):
+    """
+    Atomically save the scraping state of a camera.
+
+    Args:
+        source (str): The camera source identifier.
+        cam_state (dict): The state to save.
+    """
+    os.makedirs(STATE_PATH, exist_ok=True)
+    state_file = os.path.join(STATE_PATH, f"{source}.json")
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(cam_state, f)
+    os.replace(tmp_file, state_file)
+
+
+def choose_preset(cam_state, since=None):
+    """
+    Pick the shortest preset covering the time elapsed since the last successful scrape.
+
+    Args:
+        cam_state (dict): The scraping state of the camera.
+        since (float, optional): The epoch seconds before which frames are not wanted, e.g. the
+            end of the night.
+
+    Returns:
+        str: The preset to download, DURATION if the camera was never scraped.
+    """
+    last_success = cam_state.get("last_success")
+    if since is not None:
+        last_success = max(last_success or since, since)
+    if last_success is None:
+        return DURATION
+    gap = time.time() - last_success + PRESET_MARGIN
+    presets = sorted(PRESETS, key=duration_to_seconds)
+    for preset in presets:
+        if duration_to_seconds(preset) >= gap:
+            return preset
+    return presets[-1]
+
+
 def download_and_process_camera(cam_properties):
     """
-    Download and process camera images based on the camera properties. Handles errors such as timeouts.
+    Download and process camera images based on the camera properties. Handles errors such as timeouts,
+    retries transient failures and gives up once the camera deadline is reached.
 
     Args:
         cam_properties (dict): A dictionary containing properties of a camera, including its state and ID.
     """
+    start = time.perf_counter()
+    result = "error"
     try:
         state = cam_properties.get("state")
         source = cam_properties.get("id").lower()
-
-        url = f"https://ts1.alertwildfire.org/text/timelapse/?source={source}&preset={DURATION}"
-        response = requests.get(url, headers=HEADERS, timeout=MAX_TIME)
-        process_camera_images(response, state, source)
+        deadline = time.monotonic() + CAMERA_DEADLINE
+        if not get_governor().admit():
+            result = "skipped"
+            logging.info(f"Skipping {source}, the frame store is full")
+            return
+        cam_state = load_camera_state(source)
+        duration = choose_preset(cam_state, daylight_start(state))
+
+        url = timelapse_url(source, duration)
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                with get_session().get(url, timeout=MAX_TIME, stream=True) as response:
+                    response.raise_for_status()
+                    captured = []
+                    process_camera_images(
+                        generate_chunks(response, deadline=deadline, captured=captured),
+                        state,
+                        source,
+                        duration,
+                        cam_state,
+                        captured,
+                    )
+                result = "ok"
+                return
+            except requests.exceptions.RequestException as e:
+                status = getattr(e.response, "status_code", None)
+                retryable = status is None or is_retryable_status(status)
+                delay = retry_delay(attempt)
+                if (
+                    not retryable
+                    or attempt == MAX_RETRIES
+                    or time.monotonic() + delay > deadline
+                ):
+                    raise
+                logging.info(f"Retrying {source} in {delay:.1f}s after: {e}")
+                metrics.inc("download_retries_total", camera=source)
+                time.sleep(delay)
     except requests.exceptions.Timeout:
+        result = "timeout"
         logging.error(f"Timeout processing {source}")
     except Exception as e:
         logging.error(f"Error processing {source}: {e}")
+    finally:
+        record_camera_download(cam_properties, result, start)
+
+
+def record_camera_download(cam_properties, result, start):
+    """
+    Record the outcome and the wall time of a camera download, retries included.
+
+    Args:
+        cam_properties (dict): The properties of the camera.
+        result (str): "ok", "timeout", "error" or "skipped".
+        start (float): The time.perf_counter() value at the start of the download.
+    """
+    source = str(cam_properties.get("id")).lower()
+    seconds = time.perf_counter() - start
+    metrics.inc("camera_downloads_total", camera=source, result=result)
+    metrics.observe("stage_seconds", seconds, stage="download", camera=source)
+    if result == "skipped":
+        return
+    try:
+        get_catalog().record_download(source, result != "ok", seconds, time.time())
+    except Exception as e:
+        logging.error(f"Error recording download stats of {source}: {e}")
+
+
+def get_scheduler():
+    """
+    Get the camera scheduler, creating it on first use.
+
+    Returns:
+        CameraScheduler: The camera scheduler.
+    """
+    global _scheduler
+    catalog = get_catalog()
+    with _catalog_lock:
+        if _scheduler is None:
+            # The presets cover the frames of a camera scraped less often
+            max_interval = max(map(duration_to_seconds, PRESETS)) - PRESET_MARGIN
+            _scheduler = CameraScheduler(
+                catalog, STATE_TIMEZONES, DEFAULT_TIMEZONE, max_interval
+            )
+        return _scheduler
+
+
+def schedule_cameras(cameras_features):
+    """
+    Select and order the cameras of a download run, see CameraScheduler.
+
+    Args:
+        cameras_features (list): A list of camera features, each containing camera properties.
+
+    Returns:
+        list: The camera features to download, in download order.
+    """
+    if not CAMERA_SCHEDULING:
+        return cameras_features
+    return get_scheduler().plan(cameras_features)
+
+
+def daylight_start(state):
+    """
+    Get the time before which the frames of a camera are not wanted, the end of its last night.
+
+    Args:
+        state (str): The state of the camera.
+
+    Returns:
+        float: The epoch seconds, or None if all the frames are wanted.
+    """
+    if not CAMERA_SCHEDULING:
+        return None
+    return get_scheduler().night_end(state)
 
 
-# Modify the download_and_process_images function
 def download_and_process_images(cameras_features):
     """
     Download and process images for a list of cameras concurrently.
@@ -136,7 +554,8 @@ def download_and_process_images(cameras_features):
     Args:
         cameras_features (list): A list of camera features, each containing camera properties.
     """
-    with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor, tqdm(
+    cameras_features = schedule_cameras(cameras_features)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor, tqdm(
         total=len(cameras_features)
     ) as pbar:
         futures = []
@@ -153,181 +572,949 @@ def download_and_process_images(cameras_features):
                 logging.error(result)
 
 
-def process_camera_images(response, state, source):
+async def iter_frames_async(response, deadline, captured=None):
     """
-    Process and save camera images from an HTTP response into a specified path,
-    based on the camera's state and source information.
+    Asynchronous counterpart of generate_chunks for aiohttp responses.
+
+    Args:
+        response (aiohttp.ClientResponse): The HTTP response containing the frames.
+        deadline (float): The time.monotonic() value after which the download is aborted.
+        captured (list, optional): Receives the capture time found in the part headers of every
+            frame, see FrameParser.
+
+    Yields:
+        bytes: A JPEG frame.
+    """
+    parser = FrameParser(captured=captured)
+    async for data in response.content.iter_chunked(CHUNK_SIZE):
+        if time.monotonic() > deadline:
+            raise asyncio.TimeoutError()
+        for frame in parser.feed(data):
+            yield frame
+    for frame in parser.close():
+        yield frame
+
+
+async def download_and_process_camera_async(session, host_limits, cam_properties):
+    """
+    Asynchronous counterpart of download_and_process_camera. The number of requests in flight
+    to each host is bounded by its semaphore, and frames are written from a worker thread so the
+    event loop keeps serving the other cameras.
+
+    Args:
+        session (aiohttp.ClientSession): The shared session holding the connection pool.
+        host_limits (dict): A semaphore per host name.
+        cam_properties (dict): A dictionary containing properties of a camera, including its state and ID.
+    """
+    start = time.perf_counter()
+    result = "error"
+    try:
+        state = cam_properties.get("state")
+        source = cam_properties.get("id").lower()
+        # Started once a slot of the host is acquired, the wait for it is not the camera's
+        deadline = None
+        if not await asyncio.to_thread(get_governor().admit):
+            result = "skipped"
+            logging.info(f"Skipping {source}, the frame store is full")
+            return
+        cam_state = await asyncio.to_thread(load_camera_state, source)
+        duration = choose_preset(cam_state, daylight_start(state))
+
+        url = timelapse_url(source, duration)
+        host = urlparse(url).hostname
+        limit = host_limits.setdefault(
+            host, asyncio.Semaphore(DEFAULT_HOST_MAX_IN_FLIGHT)
+        )
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                async with limit:
+                    if deadline is None:
+                        deadline = time.monotonic() + CAMERA_DEADLINE
+                    remaining = deadline - time.monotonic()
+                    timeout = aiohttp.ClientTimeout(total=remaining, sock_read=MAX_TIME)
+                    async with session.get(url, timeout=timeout) as response:
+                        response.raise_for_status()
+                        captured = []
+                        await process_camera_images_async(
+                            iter_frames_async(response, deadline, captured),
+                            state,
+                            source,
+                            duration,
+                            cam_state,
+                            captured,
+                        )
+                result = "ok"
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = getattr(e, "status", None)
+                retryable = status is None or is_retryable_status(status)
+                delay = retry_delay(attempt)
+                if (
+                    not retryable
+                    or attempt == MAX_RETRIES
+                    or time.monotonic() + delay > deadline
+                ):
+                    raise
+                logging.info(f"Retrying {source} in {delay:.1f}s after: {e}")
+                metrics.inc("download_retries_total", camera=source)
+                await asyncio.sleep(delay)
+    except asyncio.TimeoutError:
+        result = "timeout"
+        logging.error(f"Timeout processing {source}")
+    except Exception as e:
+        logging.error(f"Error processing {source}: {e}")
+    finally:
+        record_camera_download(cam_properties, result, start)
+
+
+async def download_and_process_images_async(cameras_features):
+    """
+    Download and process images for a list of cameras on a single event loop, sharing one
+    keep-alive connection pool between all of them.
+
+    Args:
+        cameras_features (list): A list of camera features, each containing camera properties.
+    """
+    cameras_features = await asyncio.to_thread(schedule_cameras, cameras_features)
+    host_limits = {
+        host: asyncio.Semaphore(limit) for host, limit in HOST_MAX_IN_FLIGHT.items()
+    }
+    connector = aiohttp.TCPConnector(
+        limit=sum(HOST_MAX_IN_FLIGHT.values()), keepalive_timeout=MAX_TIME
+    )
+    async with aiohttp.ClientSession(headers=HEADERS, connector=connector) as session:
+        tasks = [
+            download_and_process_camera_async(
+                session, host_limits, cameras_feature["properties"]
+            )
+            for cameras_feature in cameras_features
+        ]
+        with tqdm(total=len(tasks)) as pbar:
+            for task in asyncio.as_completed(tasks):
+                await task
+                pbar.update(1)
+
+
+def prepare_camera_folder(state, source):
+    """
+    Open the final folder of a camera for a new download. The commit marker flags the folder as
+    incomplete until all its frames have been renamed to their final names.
 
     Args:
-        response (requests.Response): The HTTP response containing the camera images.
         state (str): The state of the camera.
         source (str): The camera source identifier.
 
-    Logs:
-        Error messages if any exception occurs during the processing.
+    Returns:
+        tuple: The folder path and the local time of the camera.
     """
-
     local_time = get_camera_local_time(state)
-    output_path = os.path.join(
-        OUTPUT_BASE_PATH, "temp", local_time.strftime("%Y_%m_%d")
-    )
+    output_path = os.path.join(FRAMES_PATH, local_time.strftime("%Y_%m_%d"))
     source_path = os.path.join(output_path, source)
     os.makedirs(source_path, exist_ok=True)
+    open(os.path.join(source_path, INCOMPLETE_MARKER), "w").close()
+    return source_path, local_time
 
-    try:
-        for i, chunk in enumerate(generate_chunks(response)):
-            output_path = os.path.join(source_path, f"{str(i).zfill(8)}.jpg")
-            with open(output_path, "wb") as f:
-                f.write(chunk)
 
-        # Sort and rename images
-        sort_and_rename_images(source_path, local_time)
-    except Exception as e:
-        logging.error(f"Error in processing images for {source_path}: {e}")
+def part_path(source_path, i):
+    """
+    Get the path a frame is written to until it is committed. Parts are hidden files so that the
+    other stages never pick them up.
+
+    Args:
+        source_path (str): The folder of the camera.
+        i (int): The index of the frame in the stream.
 
+    Returns:
+        str: The path of the part file.
+    """
+    return os.path.join(source_path, f".{str(i).zfill(8)}.part")
 
-def sort_and_rename_images(source_path, local_time):
+
+def write_frame(source_path, i, frame):
     """
-    Sort and rename images in a directory based on their timestamps relative to the local time.
+    Write a frame under its stream index.
 
     Args:
-        source_path (str): The directory containing the images.
-        local_time (datetime): The local time of the camera when the first image was captured.
+        source_path (str): The folder of the camera.
+        i (int): The index of the frame in the stream.
+        frame (bytes): The JPEG frame.
+    """
+    with open(part_path(source_path, i), "wb") as f:
+        f.write(frame)
 
-    Logs:
-        Error messages if any exception occurs during the sorting and renaming process.
+
+def abort_camera_folder(source_path):
     """
+    Remove the uncommitted frames of a camera folder along with its commit marker, and the folder
+    itself if nothing else is left in it.
 
-    try:
-        imgs = glob.glob(os.path.join(source_path, "*"))
-        imgs.sort()
-        nb_imgs = len(imgs)
-
-        if nb_imgs > 0:
-            dt = (
-                duration_to_seconds(DURATION) / nb_imgs
-            )  # Total duration divided by the number of images
-            local_time = local_time - timedelta(
-                hours=duration_to_seconds(DURATION) / 3600
-            )
+    Args:
+        source_path (str): The folder of the camera.
+    """
+    for file in glob.glob(os.path.join(source_path, ".*.part")):
+        os.remove(file)
+    marker = os.path.join(source_path, INCOMPLETE_MARKER)
+    if os.path.exists(marker):
+        os.remove(marker)
+    if os.path.isdir(source_path) and not os.listdir(source_path):
+        os.rmdir(source_path)
 
-            for i, file in enumerate(imgs):
-                frame_time = local_time + timedelta(seconds=dt * i)
-                frame_name = frame_time.strftime("%Y_%m_%dT%H_%M_%S") + ".jpg"
-                new_file = os.path.join(source_path, frame_name)
-                shutil.move(file, new_file)
-    except Exception as e:
-        logging.error(f"Error in sorting and renaming images in {source_path}: {e}")
+
+def commit_frames(source_path, local_time, duration, nb_frames, written, captured=None):
+    """
+    Give the written frames their final timestamp names, each with a single atomic rename, then
+    remove the commit marker. A frame whose name is taken, by a frame of the same second from the
+    stream or from a previous run, gets a numbered suffix rather than replacing it.
+
+    Args:
+        source_path (str): The folder of the camera.
+        local_time (datetime): The local time of the camera when the download started.
+        duration (str): The timelapse preset the frames cover.
+        nb_frames (int): The number of frames in the stream.
+        written (list): The stream indices of the written frames.
+        captured (list, optional): The capture times of the frames, see frame_times.
+
+    Returns:
+        list: The final paths of the written frames.
+    """
+    times = frame_times(local_time, duration, nb_frames, captured)
+    paths = []
+    for i in written:
+        frame_name = times[i].strftime(FRAME_TIME_FORMAT)
+        path = os.path.join(source_path, f"{frame_name}.jpg")
+        suffix = 0
+        while os.path.exists(path):
+            suffix += 1
+            path = os.path.join(source_path, f"{frame_name}_{suffix}.jpg")
+        paths.append(path)
+        os.replace(part_path(source_path, i), path)
+    abort_camera_folder(source_path)
+    return paths
+
+
+def recover_incomplete_cameras():
+    """
+    Discard the uncommitted frames left by an interrupted run.
+    """
+    markers = glob.glob(os.path.join(FRAMES_PATH, "*", "*", INCOMPLETE_MARKER))
+    for marker in markers:
+        source_path = os.path.dirname(marker)
+        logging.info(f"Discarding incomplete download in {source_path}")
+        abort_camera_folder(source_path)
 
 
-def remove_if_gray(file):
+def process_camera_images(
+    frames, state, source, duration=DURATION, cam_state=None, captured=None
+):
     """
-    Remove an image file if it is determined to be grayscale.
+    Process and save camera images into their final folder,
+    based on the camera's state and source information.
+    Frames already downloaded by a previous run are recognized by their hash and skipped, and gray
+    frames are rejected before reaching the disk.
 
     Args:
-        file (str): The path to the image file.
+        frames (iterable): The JPEG frames of the timelapse, in stream order.
+        state (str): The state of the camera.
+        source (str): The camera source identifier.
+        duration (str): The timelapse preset the frames cover.
+        cam_state (dict, optional): The scraping state of the camera, updated on success.
+        captured (list, optional): The capture times read from the stream for the frames, filled
+            in from the frames themselves.
 
-    Logs:
-        Error messages if any exception occurs. The file is removed in case of exceptions.
+    Raises:
+        Exception: Any error raised while streaming the frames, after the partial download is removed.
     """
 
+    cam_state = {} if cam_state is None else cam_state
+    captured = [] if captured is None else captured
+    seen = set(cam_state.get("hashes", []))
+    hashes = []
+    written = []
+    rejected = []
+    recent = [list(entry) for entry in cam_state.get("phashes", [])]
+    phashes = {}
+    duplicates = set()
+    source_path, local_time = prepare_camera_folder(state, source)
     try:
-        im = cv2.imread(file)
-        h = im.shape[0]
-        im_half = im[h // 2 :, :, :]
-        d = np.max(im_half[:, :, 0] - im_half[:, :, 1])
-        if d == 0:
-            os.remove(file)
-    except Exception as e:
-        logging.error(f"Error processing file {file}: {e}")
-        os.remove(file)
+        new_frames = iter_new_frames(frames, seen, hashes, source, captured)
+        color_frames = filter_gray_frames(new_frames, rejected)
+        for i, chunk in mark_duplicates(color_frames, recent, phashes, duplicates):
+            write_frame(source_path, i, chunk)
+            written.append(i)
+        paths = commit_frames(
+            source_path, local_time, duration, len(hashes), written, captured
+        )
+    except Exception:
+        abort_camera_folder(source_path)
+        raise
+
+    catalog_frames(
+        source,
+        local_time,
+        duration,
+        hashes,
+        written,
+        paths,
+        rejected,
+        phashes,
+        duplicates,
+        captured,
+    )
+    cam_state["phashes"] = recent
+    count_frames(source, written, rejected, duplicates)
+    update_camera_state(source, cam_state, hashes, local_time, duration, captured)
 
 
-def remove_grayscale_images():
+async def process_camera_images_async(
+    frames, state, source, duration=DURATION, cam_state=None, captured=None
+):
     """
-    Remove grayscale images from the temporary directory using threading.
+    Asynchronous counterpart of process_camera_images, the file operations run in worker threads.
 
-    Logs:
-        Error messages if any exception occurs during the removal process.
+    Args:
+        frames (async iterable): The JPEG frames of the timelapse, in stream order.
+        state (str): The state of the camera.
+        source (str): The camera source identifier.
+        duration (str): The timelapse preset the frames cover.
+        cam_state (dict, optional): The scraping state of the camera, updated on success.
+        captured (list, optional): The capture times read from the stream for the frames, filled
+            in from the frames themselves.
     """
+
+    cam_state = {} if cam_state is None else cam_state
+    captured = [] if captured is None else captured
+    seen = set(cam_state.get("hashes", []))
+    hashes = []
+    source_path, local_time = await asyncio.to_thread(
+        prepare_camera_folder, state, source
+    )
+    written = []
+    rejected = []
+    recent = [list(entry) for entry in cam_state.get("phashes", [])]
+    phashes = {}
+    duplicates = set()
     try:
-        temp_dir = os.path.join(OUTPUT_BASE_PATH, "temp")
-        imgs = glob.glob(os.path.join(temp_dir, "**/*.jpg"), recursive=True)
-        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-            # Wrap with tqdm for progress feedback
-            results = list(tqdm(executor.map(remove_if_gray, imgs), total=len(imgs)))
-    except Exception as e:
-        logging.error(f"Error in removing grayscale images: {e}")
+        new_frames = iter_new_frames_async(frames, seen, hashes, source, captured)
+        color_frames = filter_gray_frames_async(new_frames, rejected)
+        async for i, chunk in mark_duplicates_async(
+            color_frames, recent, phashes, duplicates
+        ):
+            await asyncio.to_thread(write_frame, source_path, i, chunk)
+            written.append(i)
+        paths = await asyncio.to_thread(
+            commit_frames,
+            source_path,
+            local_time,
+            duration,
+            len(hashes),
+            written,
+            captured,
+        )
+    except BaseException:
+        abort_camera_folder(source_path)
+        raise
+
+    await asyncio.to_thread(
+        catalog_frames,
+        source,
+        local_time,
+        duration,
+        hashes,
+        written,
+        paths,
+        rejected,
+        phashes,
+        duplicates,
+        captured,
+    )
+    cam_state["phashes"] = recent
+    count_frames(source, written, rejected, duplicates)
+    await asyncio.to_thread(
+        update_camera_state, source, cam_state, hashes, local_time, duration, captured
+    )
+
+
+def count_frames(source, written, rejected, duplicates):
+    """
+    Record the frames of a committed camera download.
+
+    Args:
+        source (str): The camera source identifier.
+        written (list): The stream indices of the written frames.
+        rejected (list): The stream indices of the gray frames.
+        duplicates (set): The stream indices of the near duplicate frames.
+    """
+    metrics.inc("frames_written_total", len(written), camera=source)
+    metrics.inc("frames_rejected_total", len(rejected), camera=source, reason="gray")
+    metrics.inc(
+        "frames_rejected_total",
+        len(duplicates.difference(written)),
+        camera=source,
+        reason="duplicate",
+    )
+
+
+def capture_time(captured, i, frame):
+    """
+    Complete the capture time of a frame with the one embedded in its EXIF data or comment when
+    its part headers held none.
+
+    Args:
+        captured (list): The capture times of the frames of the stream, extended up to the frame.
+        i (int): The index of the frame in the stream.
+        frame (bytes): The JPEG frame.
+    """
+    captured.extend([None] * (i + 1 - len(captured)))
+    if captured[i] is None:
+        captured[i] = jpeg_capture_time(frame)
+
+
+def iter_new_frames(frames, seen, hashes, source=None, captured=None):
+    """
+    Number the frames of a stream and skip those whose hash was already seen.
+
+    Args:
+        frames (iterable): The JPEG frames of the timelapse, in stream order.
+        seen (set): The hashes of the frames downloaded by previous runs.
+        hashes (list): Receives the hash of every frame of the stream.
+        source (str, optional): The camera source identifier the downloaded frames are counted
+            under.
+        captured (list, optional): The capture times read from the stream, completed with the
+            time embedded in each frame whose part headers had none.
+
+    Yields:
+        tuple: The index of the frame in the stream and the frame.
+    """
+    for i, chunk in enumerate(frames):
+        metrics.inc("frames_downloaded_total", camera=source)
+        metrics.inc("bytes_downloaded_total", len(chunk), camera=source)
+        if captured is not None:
+            capture_time(captured, i, chunk)
+        digest = frame_hash(chunk)
+        hashes.append(digest)
+        if digest not in seen:
+            yield i, chunk
+
+
+async def iter_new_frames_async(frames, seen, hashes, source=None, captured=None):
+    """
+    Asynchronous counterpart of iter_new_frames.
 
+    Args:
+        frames (async iterable): The JPEG frames of the timelapse, in stream order.
+        seen (set): The hashes of the frames downloaded by previous runs.
+        hashes (list): Receives the hash of every frame of the stream.
+        source (str, optional): The camera source identifier the downloaded frames are counted
+            under.
+        captured (list, optional): The capture times read from the stream, completed with the
+            time embedded in each frame whose part headers had none.
 
-def cleanup_empty_folders():
+    Yields:
+        tuple: The index of the frame in the stream and the frame.
+    """
+    i = 0
+    async for chunk in frames:
+        metrics.inc("frames_downloaded_total", camera=source)
+        metrics.inc("bytes_downloaded_total", len(chunk), camera=source)
+        if captured is not None:
+            capture_time(captured, i, chunk)
+        digest = frame_hash(chunk)
+        hashes.append(digest)
+        if digest not in seen:
+            yield i, chunk
+        i += 1
+
+
+def decode_reduced(frame):
     """
-    Remove empty folders within the temporary directory.
+    Decode a JPEG frame at 1/8 resolution, which the decoder does at a fraction of the cost of a
+    full decode.
 
-    Logs:
-        Error messages if any exception occurs during the cleanup process.
+    Args:
+        frame (bytes): The JPEG frame.
+
+    Returns:
+        np.ndarray: The reduced BGR image.
+
+    Raises:
+        ValueError: If the frame cannot be decoded.
     """
+    reduced = cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_REDUCED_COLOR_8)
+    if reduced is None:
+        raise ValueError("Cannot decode frame")
+    return reduced
 
+
+def is_gray_frame(frame, reduced=None):
+    """
+    Tell whether a JPEG frame is grayscale, i.e. whether its blue and green channels are identical
+    on the bottom half of the image. A decode at 1/8 resolution settles most color frames, only the
+    frames that look gray are fully decoded to check the exact criterion.
+
+    Args:
+        frame (bytes): The JPEG frame.
+        reduced (np.ndarray, optional): The frame decoded by decode_reduced, decoded if not given.
+
+    Returns:
+        bool: True if the frame is gray.
+
+    Raises:
+        ValueError: If the frame cannot be decoded.
+    """
+    buf = np.frombuffer(frame, np.uint8)
+    if reduced is None:
+        reduced = decode_reduced(frame)
+    # Skip the reduced rows whose chroma may be interpolated from the top half
+    reduced_half = reduced[reduced.shape[0] // 2 + 3 :, :, :]
+    if (
+        reduced_half.size
+        and np.max(cv2.absdiff(reduced_half[:, :, 0], reduced_half[:, :, 1]))
+        > GRAY_FAST_MARGIN
+    ):
+        return False
+
+    im = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+    if im is None:
+        raise ValueError("Cannot decode frame")
+    h = im.shape[0]
+    im_half = im[h // 2 :, :, :]
+    d = np.max(im_half[:, :, 0] - im_half[:, :, 1])
+    return d == 0
+
+
+def perceptual_hash(reduced):
+    """
+    Compute the difference hash of a frame: the sign of the horizontal gradients of a 9x8
+    grayscale thumbnail of the scene below the overlay. Near identical frames have hashes a few
+    bits apart.
+
+    Args:
+        reduced (np.ndarray): The frame decoded by decode_reduced.
+
+    Returns:
+        int: The 64 bit hash.
+    """
+    scene = reduced[int(reduced.shape[0] * DEDUP_TOP) :]
+    gray = cv2.cvtColor(scene, cv2.COLOR_BGR2GRAY)
+    thumb = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (thumb[:, 1:] > thumb[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def check_frame(frame):
+    """
+    Gray check run in the worker processes, undecodable frames are rejected like gray ones. The
+    perceptual hash of the kept frames is computed from the same reduced decode.
+
+    Args:
+        frame (bytes): The JPEG frame.
+
+    Returns:
+        tuple: True if the frame must be kept, and its perceptual hash or None.
+    """
     try:
-        temp_dir = os.path.join(OUTPUT_BASE_PATH, "temp")
-        scrap_folders = glob.glob(os.path.join(temp_dir, "**/*"))
-        for scrap_folder in tqdm(scrap_folders, desc="Clean empty folders"):
-            if not os.listdir(scrap_folder):
-                shutil.rmtree(scrap_folder)
+        reduced = decode_reduced(frame)
+        if is_gray_frame(frame, reduced):
+            return False, None
+        return True, perceptual_hash(reduced)
     except Exception as e:
-        logging.error(f"Error cleaning up empty folders: {e}")
+        logging.error(f"Error checking frame: {e}")
+        return False, None
 
 
-def merge_folders(src, dst):
+def check_frame_timed(frame):
     """
-    Merge two folders, overwriting files in the destination folder if they already exist.
+    check_frame timed in the worker process, for the gray check latency to leave out the time
+    spent waiting for a worker.
 
     Args:
-        src (str): The path to the source folder.
-        dst (str): The path to the destination folder.
+        frame (bytes): The JPEG frame.
+
+    Returns:
+        tuple: The result of check_frame and the seconds it took.
     """
-    if not os.path.exists(dst):
-        shutil.move(src, dst)
-    else:
-        for src_dir, dirs, files in os.walk(src):
-            dst_dir = src_dir.replace(src, dst, 1)
-            if not os.path.exists(dst_dir):
-                os.makedirs(dst_dir)
-            for file_ in files:
-                src_file = os.path.join(src_dir, file_)
-                dst_file = os.path.join(dst_dir, file_)
-                if os.path.exists(dst_file):
-                    os.remove(dst_file)
-                shutil.move(src_file, dst_dir)
-        os.rmdir(src)  # Optionally remove the source directory after merge
+    start = time.perf_counter()
+    return check_frame(frame), time.perf_counter() - start
 
 
-def move_processed_directory():
+def checked(result):
     """
-    Move processed directories from a temporary location to the final destination, merging folders as needed.
+    Unpack the result of check_frame_timed and record its latency.
+
+    Args:
+        result (tuple): The result of check_frame_timed.
+
+    Returns:
+        tuple: The result of check_frame.
     """
+    result, seconds = result
+    metrics.observe("stage_seconds", seconds, stage="gray")
+    return result
 
-    temp_dir = os.path.join(OUTPUT_BASE_PATH, "temp")
-    scrap_folders = glob.glob(os.path.join(temp_dir, "**/*"))
-    for folder in tqdm(scrap_folders, desc="Move processed directory"):
-        merge_folders(folder, folder.replace("temp", "dl_frames"))
+
+def get_gray_pool():
+    """
+    Get the process pool shared by all cameras for the gray check, creating it on first use.
+    Workers are spawned rather than forked since the download threads may already be running.
+
+    Returns:
+        ProcessPoolExecutor: The gray check pool.
+    """
+    global _gray_pool
+    with _gray_pool_lock:
+        if _gray_pool is None:
+            _gray_pool = ProcessPoolExecutor(
+                max_workers=GRAY_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _gray_pool
+
+
+def filter_gray_frames(frames, rejected=None):
+    """
+    Run the gray check of the frames in the process pool and yield the color ones in stream order.
+    At most MAX_PENDING_FRAMES frames wait for their result, which bounds the memory per camera.
+
+    Args:
+        frames (iterable): The indexed frames to check.
+        rejected (list, optional): Receives the index of every rejected frame.
+
+    Yields:
+        tuple: The index of the frame in the stream, the frame and its perceptual hash.
+    """
+    rejected = [] if rejected is None else rejected
+    pool = get_gray_pool()
+    pending = deque()
+    for i, chunk in frames:
+        pending.append((i, chunk, pool.submit(check_frame_timed, chunk)))
+        while len(pending) >= MAX_PENDING_FRAMES:
+            i, chunk, future = pending.popleft()
+            keep, phash = checked(future.result())
+            if keep:
+                yield i, chunk, phash
+            else:
+                rejected.append(i)
+    while pending:
+        i, chunk, future = pending.popleft()
+        keep, phash = checked(future.result())
+        if keep:
+            yield i, chunk, phash
+        else:
+            rejected.append(i)
+
+
+async def filter_gray_frames_async(frames, rejected=None):
+    """
+    Asynchronous counterpart of filter_gray_frames.
+
+    Args:
+        frames (async iterable): The indexed frames to check.
+        rejected (list, optional): Receives the index of every rejected frame.
+
+    Yields:
+        tuple: The index of the frame in the stream, the frame and its perceptual hash.
+    """
+    rejected = [] if rejected is None else rejected
+    loop = asyncio.get_running_loop()
+    pool = get_gray_pool()
+    pending = deque()
+    async for i, chunk in frames:
+        pending.append((i, chunk, loop.run_in_executor(pool, check_frame_timed, chunk)))
+        while len(pending) >= MAX_PENDING_FRAMES:
+            i, chunk, future = pending.popleft()
+            keep, phash = checked(await future)
+            if keep:
+                yield i, chunk, phash
+            else:
+                rejected.append(i)
+    while pending:
+        i, chunk, future = pending.popleft()
+        keep, phash = checked(await future)
+        if keep:
+            yield i, chunk, phash
+        else:
+            rejected.append(i)
+
+
+def is_duplicate(phash, recent):
+    """
+    Tell whether a frame is a near duplicate of a recently kept frame, and update the history of
+    the kept frames. A frame matching a kept frame for the DEDUP_KEEP_EVERY-th time is kept anyway
+    and replaces it, so that long static runs stay sampled.
+
+    Args:
+        phash (int): The perceptual hash of the frame.
+        recent (list): The recently kept frames as [hash, number of duplicates] lists, most recent
+            last, updated in place.
+
+    Returns:
+        bool: True if the frame is a duplicate.
+    """
+    if DEDUP_MODE != "off":
+        for entry in reversed(recent):
+            if bin(phash ^ entry[0]).count("1") <= DEDUP_DISTANCE:
+                entry[1] += 1
+                if entry[1] < DEDUP_KEEP_EVERY:
+                    return True
+                recent.remove(entry)
+                break
+    recent.append([phash, 0])
+    del recent[:-DEDUP_HISTORY]
+    return False
+
+
+def mark_duplicates(frames, recent, phashes, duplicates):
+    """
+    Find the near duplicate frames of a stream, and drop them in "drop" mode.
+
+    Args:
+        frames (iterable): The color frames with their perceptual hash, in stream order.
+        recent (list): The recently kept frames of the camera, see is_duplicate.
+        phashes (dict): Receives the perceptual hash of each frame index.
+        duplicates (set): Receives the index of every duplicate frame.
+
+    Yields:
+        tuple: The index of the frame in the stream and the frame.
+    """
+    for i, chunk, phash in frames:
+        phashes[i] = phash
+        if is_duplicate(phash, recent):
+            duplicates.add(i)
+            if DEDUP_MODE == "drop":
+                continue
+        yield i, chunk
+
+
+async def mark_duplicates_async(frames, recent, phashes, duplicates):
+    """
+    Asynchronous counterpart of mark_duplicates.
+
+    Args:
+        frames (async iterable): The color frames with their perceptual hash, in stream order.
+        recent (list): The recently kept frames of the camera, see is_duplicate.
+        phashes (dict): Receives the perceptual hash of each frame index.
+        duplicates (set): Receives the index of every duplicate frame.
+
+    Yields:
+        tuple: The index of the frame in the stream and the frame.
+    """
+    async for i, chunk, phash in frames:
+        phashes[i] = phash
+        if is_duplicate(phash, recent):
+            duplicates.add(i)
+            if DEDUP_MODE == "drop":
+                continue
+        yield i, chunk
+
+
+def frame_times(local_time, duration, nb_frames, captured=None):
+    """
+    Compute the timestamps of the frames of a timelapse, in the local time of the camera. The
+    capture times read from the stream are used as they are, the other frames are interpolated
+    between them, or evenly spread over the duration of the timelapse if none is known.
+
+    Args:
+        local_time (datetime): The local time of the camera when the download started.
+        duration (str): The timelapse preset the frames cover.
+        nb_frames (int): The number of frames in the timelapse.
+        captured (list, optional): The capture time of each frame, or None when it is unknown.
+
+    Returns:
+        list: The timestamp of each frame, in stream order.
+    """
+    if nb_frames == 0:
+        return []
+    dt = (
+        duration_to_seconds(duration) / nb_frames
+    )  # Total duration divided by the number of images
+    start_time = local_time - timedelta(seconds=duration_to_seconds(duration))
+    indices, times = known_capture_times(local_time, duration, captured or [])
+    if not indices:
+        return [start_time + timedelta(seconds=dt * i) for i in range(nb_frames)]
+    seconds = interpolate_times(indices, times, nb_frames, dt)
+    return [LOCAL_EPOCH + timedelta(seconds=float(s)) for s in seconds]
+
+
+def known_capture_times(local_time, duration, captured):
+    """
+    Keep the plausible capture times of a timelapse, converted to the local time of the camera:
+    those within its duration, with a margin for clock drift, and increasing in stream order.
+
+    Args:
+        local_time (datetime): The local time of the camera when the download started.
+        duration (str): The timelapse preset the frames cover.
+        captured (list): The capture time of each frame, or None when it is unknown.
+
+    Returns:
+        tuple: The stream indices of the kept times and the times, as local epoch seconds.
+    """
+    end = local_time.replace(tzinfo=None)
+    start = end - timedelta(seconds=duration_to_seconds(duration))
+    indices, times = [], []
+    for i, value in enumerate(captured):
+        if value is None:
+            continue
+        if value.tzinfo is not None:
+            value = value.astimezone(local_time.tzinfo).replace(tzinfo=None)
+        if not start - CAPTURE_MARGIN <= value <= end + CAPTURE_MARGIN:
+            continue
+        seconds = (value - LOCAL_EPOCH).total_seconds()
+        if times and seconds <= times[-1]:
+            continue
+        indices.append(i)
+        times.append(seconds)
+    return indices, times
+
+
+def get_catalog():
+    """
+    Get the frame catalog shared by all cameras, opening it on first use.
+
+    Returns:
+        FrameCatalog: The frame catalog.
+    """
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = FrameCatalog(CATALOG_PATH)
+        return _catalog
+
+
+def get_governor():
+    """
+    Get the storage governor admitting the downloads, creating it on first use.
+
+    Returns:
+        StorageGovernor: The storage governor.
+    """
+    global _governor
+    catalog = get_catalog()
+    with _catalog_lock:
+        if _governor is None:
+            _governor = StorageGovernor(catalog, OUTPUT_BASE_PATH)
+        return _governor
+
+
+def catalog_frames(
+    source,
+    local_time,
+    duration,
+    hashes,
+    written,
+    paths,
+    rejected,
+    phashes=None,
+    duplicates=(),
+    captured=None,
+):
+    """
+    Record the written frames of a download in the catalog, along with the gray and near
+    duplicate frames it did not write.
+
+    Args:
+        source (str): The camera source identifier.
+        local_time (datetime): The local time of the camera when the download started.
+        duration (str): The timelapse preset the frames cover.
+        hashes (list): The hashes of the downloaded frames, in stream order.
+        written (list): The stream indices of the written frames.
+        paths (list): The final paths of the written frames.
+        rejected (list): The stream indices of the gray frames.
+        phashes (dict, optional): The perceptual hash of each color frame index.
+        duplicates (set): The stream indices of the near duplicate frames.
+        captured (list, optional): The capture times of the frames, see frame_times.
+
+    Raises:
+        sqlite3.Error: If the catalog cannot record them. The camera state is not updated then,
+            so that the next run downloads and records the frames again.
+    """
+    phashes = {} if phashes is None else phashes
+    times = frame_times(local_time, duration, len(hashes), captured)
+    day = local_time.strftime("%Y_%m_%d")
+    frames = [
+        dict(
+            path=path,
+            camera=source,
+            day=day,
+            timestamp=calendar.timegm(times[i].timetuple()),
+            size=os.path.getsize(path),
+            hash=hashes[i],
+            phash=f"{phashes[i]:016x}" if i in phashes else None,
+            stage="downloaded",
+            gray=0,
+            duplicate=int(i in duplicates),
+        )
+        for i, path in zip(written, paths)
+    ]
+    dropped = duplicates.difference(written)
+    frames += [
+        dict(
+            camera=source,
+            day=day,
+            timestamp=calendar.timegm(times[i].timetuple()),
+            hash=hashes[i],
+            phash=f"{phashes[i]:016x}",
+            stage="rejected",
+            gray=0,
+            duplicate=1,
+        )
+        for i in sorted(dropped)
+    ]
+    frames += [
+        dict(
+            camera=source,
+            day=day,
+            timestamp=calendar.timegm(times[i].timetuple()),
+            hash=hashes[i],
+            stage="rejected",
+            gray=1,
+        )
+        for i in rejected
+    ]
+    get_catalog().add_frames(frames)
+
+
+def update_camera_state(source, cam_state, hashes, local_time, duration, captured=None):
+    """
+    Record a successful download in the scraping state of a camera.
+
+    Args:
+        source (str): The camera source identifier.
+        cam_state (dict): The scraping state of the camera before the download.
+        hashes (list): The hashes of the downloaded frames, in stream order.
+        local_time (datetime): The local time of the camera when the download started.
+        duration (str): The timelapse preset the frames cover.
+        captured (list, optional): The capture times of the frames, see frame_times.
+    """
+    try:
+        new_hashes = set(hashes)
+        recent = [h for h in cam_state.get("hashes", []) if h not in new_hashes]
+        cam_state["hashes"] = (recent + hashes)[-RECENT_HASHES:]
+        cam_state["last_success"] = time.time()
+        if hashes:
+            last_time = frame_times(local_time, duration, len(hashes), captured)[-1]
+            cam_state["last_frame"] = last_time.strftime(FRAME_TIME_FORMAT)
+        save_camera_state(source, cam_state)
+    except Exception as e:
+        logging.error(f"Error saving state of {source}: {e}")
 
 
 # Main Script
 if __name__ == "__main__":
+    metrics.start("dl_images", os.path.join(OUTPUT_BASE_PATH, "reports"))
     try:
-        response = requests.get(CAMERAS_URL, headers=HEADERS)
-        cameras_data = response.json()
+        # Discard the frames of downloads interrupted by a crash
+        recover_incomplete_cameras()
 
-        download_and_process_images(cameras_data["features"])
-        # Remove grayscale images
-        remove_grayscale_images()
-
-        # Cleanup empty folders
-        cleanup_empty_folders()
+        response = get_session().get(CAMERAS_URL, timeout=MAX_TIME)
+        cameras_data = response.json()
 
-        # Move processed folders
-        move_processed_directory()
+        if DOWNLOAD_ENGINE == "async":
+            asyncio.run(download_and_process_images_async(cameras_data["features"]))
+        else:
+            download_and_process_images(cameras_data["features"])
 
     except Exception as e:
         logging.error(f"Failed to fetch camera data: {e}")
+    finally:
+        if _gray_pool is not None:
+            _gray_pool.shutdown()
@@ -0,0 +1,100 @@
+import mmap
+import os
+import threading
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+import metrics
+
+
+@contextmanager
+def frame_bytes(path):
+    """
+    Map a frame file read-only, so that hashing, decoding or archiving it reads the page cache
+    instead of a copy of the file.
+
+    Args:
+        path (str): The path to the frame.
+
+    Yields:
+        memoryview: The content of the file, valid until the block exits.
+    """
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            # Empty files cannot be mapped
+            yield memoryview(b"")
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+
+
+def decode_frame(path, flags=cv2.IMREAD_COLOR):
+    """
+    Decode a frame straight from its mapped file, as cv2.imread does but without reading the file
+    into a buffer first.
+
+    Args:
+        path (str): The path to the frame.
+        flags (int): The cv2.IMREAD_* mode, e.g. a reduced one.
+
+    Returns:
+        np.ndarray: The image, or None if the frame cannot be read or decoded.
+    """
+    try:
+        with frame_bytes(path) as data:
+            buf = np.frombuffer(data, np.uint8)
+            im = cv2.imdecode(buf, flags) if buf.size else None
+            # The mapping cannot be closed while an array still refers to it
+            del buf
+    except OSError:
+        return None
+    metrics.inc("frames_decoded_total")
+    return im
+
+
+class BufferPool:
+    """
+    Arrays of a fixed shape handed out and taken back, so that the per frame and per batch
+    buffers of a stage are allocated once rather than for every frame.
+
+    Args:
+        shape (tuple): The shape of the arrays.
+        dtype (np.dtype): The type of the arrays.
+        name (str): The name of the pool in the metrics.
+    """
+
+    def __init__(self, shape, dtype, name):
+        self.shape = shape
+        self.dtype = dtype
+        self.name = name
+        self.free = []
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        Get an array, with the content it had when it was given back.
+
+        Returns:
+            np.ndarray: The array.
+        """
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        metrics.inc("frame_buffers_allocated_total", pool=self.name)
+        return np.empty(self.shape, self.dtype)
+
+    def give(self, array):
+        """
+        Give an array back once it is no longer used.
+
+        Args:
+            array (np.ndarray): An array taken from the pool.
+        """
+        with self.lock:
+            self.free.append(array)
@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+
+import metrics
+
+
+class Journal:
+    """
+    Append-only checkpoints of the units of work of a stage, such as the camera folders of the
+    detection. Each unit has its own journal file, to which the stage appends a line as each
+    step completes, synced to the disk before the next step starts. The file is removed once
+    the unit is done, so the journals left at startup are exactly the interrupted units, and
+    their steps tell where each one stopped.
+
+    Args:
+        folder (str): The folder of the journals of the stage.
+        stage (str): The name of the stage in the metrics.
+    """
+
+    def __init__(self, folder, stage):
+        self.folder = folder
+        self.stage = stage
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, unit):
+        return os.path.join(self.folder, f"{unit}.jsonl")
+
+    def read(self, unit):
+        """
+        Read the steps completed by a unit.
+
+        Args:
+            unit (str): The name of the unit.
+
+        Returns:
+            dict: The data recorded with each completed step, empty if the unit has no journal.
+        """
+        steps = {}
+        try:
+            with open(self.path(unit)) as f:
+                lines = [line for line in f if line.endswith("\n")]
+        except FileNotFoundError:
+            return steps
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Cut by a crash, the step it recorded is run again
+                continue
+            steps[entry.pop("step")] = entry
+        return steps
+
+    def checkpoint(self, unit, step, **data):
+        """
+        Durably record that a step of a unit is complete.
+
+        Args:
+            unit (str): The name of the unit.
+            step (str): The completed step.
+            **data: What later steps or the recovery need to know about it.
+        """
+        with open(self.path(unit), "a") as f:
+            f.write(json.dumps(dict(data, step=step)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def begin(self, unit, **data):
+        """
+        Start a unit, or resume it if an interrupted run left its journal.
+
+        Args:
+            unit (str): The name of the unit.
+            **data: Recorded with the "started" step of a new unit, e.g. its folder.
+
+        Returns:
+            dict: The steps the unit already completed, see read.
+        """
+        steps = self.read(unit)
+        if steps:
+            logging.info(f"Resuming {unit} after {list(steps)[-1]}")
+            metrics.inc("units_resumed_total", stage=self.stage)
+            return steps
+        self.checkpoint(unit, "started", **data)
+        return {"started": data}
+
+    def commit(self, unit):
+        """
+        Record that a unit is done by removing its journal.
+
+        Args:
+            unit (str): The name of the unit.
+        """
+        try:
+            os.remove(self.path(unit))
+        except FileNotFoundError:
+            pass
+
+    def pending(self):
+        """
+        List the units interrupted before they were done.
+
+        Returns:
+            dict: The steps completed by each unit, see read.
+        """
+        units = sorted(
+            name[: -len(".jsonl")]
+            for name in os.listdir(self.folder)
+            if name.endswith(".jsonl")
+        )
+        return {unit: self.read(unit) for unit in units}
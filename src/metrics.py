@@ -0,0 +1,255 @@
+import atexit
+import bisect
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local port of the Prometheus text endpoint, 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_run = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """
+    Increase a counter.
+
+    Args:
+        name (str): The name of the counter.
+        value (float): The increment.
+        **labels: The labels of the series, e.g. stage or camera.
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """
+    Set a gauge, such as a queue depth.
+
+    Args:
+        name (str): The name of the gauge.
+        value (float): The current value.
+        **labels: The labels of the series.
+    """
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """
+    Record a latency in a histogram.
+
+    Args:
+        name (str): The name of the histogram.
+        value (float): The observed value in seconds.
+        **labels: The labels of the series.
+    """
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.setdefault(
+            key, {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0}
+        )
+        idx = bisect.bisect_left(BUCKETS, value)
+        if idx < len(BUCKETS):
+            histogram["buckets"][idx] += 1
+        histogram["count"] += 1
+        histogram["sum"] += value
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Record the wall time of a block in a histogram.
+
+    Args:
+        name (str): The name of the histogram.
+        **labels: The labels of the series.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def _format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render():
+    """
+    Render all the series in the Prometheus text format.
+
+    Returns:
+        str: The exposition text.
+    """
+    lines = []
+    with _lock:
+        for kind, series in (("counter", _counters), ("gauge", _gauges)):
+            for name in sorted({name for name, _ in series}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (n, labels), value in sorted(series.items()):
+                    if n == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in _histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), histogram in sorted(_histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram["buckets"]):
+                    cumulative += count
+                    le = _format_labels(labels, le=bound)
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                le = _format_labels(labels, le="+Inf")
+                lines.append(f"{name}_bucket{le} {histogram['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+                lines.append(
+                    f"{name}_count{_format_labels(labels)} {histogram['count']}"
+                )
+    return "\n".join(lines) + "\n"
+
+
+def snapshot():
+    """
+    Copy all the series into plain data, as used by the run report and by merge.
+
+    Returns:
+        dict: The counters, gauges and histograms as lists of [name, labels, value].
+    """
+    with _lock:
+        return {
+            "counters": [[n, dict(l), v] for (n, l), v in _counters.items()],
+            "gauges": [[n, dict(l), v] for (n, l), v in _gauges.items()],
+            "histograms": [
+                [n, dict(l), dict(h, buckets=list(h["buckets"]))]
+                for (n, l), h in _histograms.items()
+            ],
+        }
+
+
+def reset():
+    """
+    Clear all the series, e.g. in a forked worker process which inherits those of its parent.
+    """
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def drain():
+    """
+    Take the series recorded by a worker process since its last drain, for its parent to merge
+    them.
+
+    Returns:
+        dict: The snapshot of the series.
+    """
+    with _lock:
+        data = {
+            "counters": [[n, dict(l), v] for (n, l), v in _counters.items()],
+            "gauges": [],
+            "histograms": [[n, dict(l), h] for (n, l), h in _histograms.items()],
+        }
+        _counters.clear()
+        _histograms.clear()
+    return data
+
+
+def merge(data):
+    """
+    Add the series drained from a worker process to those of this process.
+
+    Args:
+        data (dict): The series returned by drain.
+    """
+    for name, labels, value in data.get("counters", []):
+        inc(name, value, **labels)
+    with _lock:
+        for name, labels, value in data.get("gauges", []):
+            _gauges[_key(name, labels)] = value
+        for name, labels, other in data.get("histograms", []):
+            histogram = _histograms.setdefault(
+                _key(name, labels),
+                {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0},
+            )
+            histogram["buckets"] = [
+                a + b for a, b in zip(histogram["buckets"], other["buckets"])
+            ]
+            histogram["count"] += other["count"]
+            histogram["sum"] += other["sum"]
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def write_report():
+    """
+    Write the JSON summary of the run: its name, start and end times and all the series.
+    """
+    data = dict(_run, end=datetime.now().isoformat(), **snapshot())
+    path = os.path.join(
+        _run["folder"], f"{_run['name']}_{_run['start'].replace(':', '_')}.json"
+    )
+    try:
+        os.makedirs(_run["folder"], exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1)
+        logging.info(f"Run report written to {path}")
+    except Exception as e:
+        logging.error(f"Error writing run report: {e}")
+
+
+def start(name, report_folder, port=METRICS_PORT):
+    """
+    Instrument a run: serve the metrics on a local port if one is set, and write the run report
+    at exit, SIGTERM included.
+
+    Args:
+        name (str): The name of the run, e.g. the script name.
+        report_folder (str): The folder of the run reports.
+        port (int): The port of the Prometheus endpoint, 0 to disable it.
+    """
+    _run.update(name=name, folder=report_folder, pid=os.getpid())
+    _run["start"] = datetime.now().isoformat()
+    atexit.register(write_report)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    if port:
+        server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Metrics served on http://127.0.0.1:{port}/metrics")
@@ -0,0 +1,227 @@
+import errno
+import glob
+import json
+import logging
+import os
+import shutil
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+MOVE_WORKERS = int(os.getenv("MOVE_WORKERS", 8))
+
+
+def write_manifest(manifest_path, operations):
+    """
+    Durably record the operations of a move before running them.
+
+    Args:
+        manifest_path (str): The path to the manifest.
+        operations (list): The operations, as [kind, src, dst] lists where kind is "file" for a
+            file move, "dir" for a folder move and "rmtree" for the removal of src.
+    """
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps({"plan": operations}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, manifest_path)
+
+
+def read_manifest(manifest_path):
+    """
+    Read a manifest back.
+
+    Args:
+        manifest_path (str): The path to the manifest.
+
+    Returns:
+        tuple: The planned operations and the set of completed destination groups.
+    """
+    with open(manifest_path) as f:
+        lines = [json.loads(line) for line in f if line.endswith("\n")]
+    operations = lines[0]["plan"] if lines else []
+    done = {line["done"] for line in lines[1:]}
+    return operations, done
+
+
+def mark_done(manifest_path, group):
+    """
+    Record that all the operations of a destination group are complete.
+
+    Args:
+        manifest_path (str): The path to the manifest.
+        group (str): The destination folder of the group.
+    """
+    with open(manifest_path, "a") as f:
+        f.write(json.dumps({"done": group}) + "\n")
+
+
+def move_file(src, dst):
+    """
+    Move a file with a rename, or with a copy and a removal across devices. Moves that already
+    happened are skipped, which makes replaying a manifest safe.
+
+    Args:
+        src (str): The source path.
+        dst (str): The destination path.
+
+    Returns:
+        bool: True if the file must be copied because the rename crosses devices.
+    """
+    if not os.path.exists(src):
+        return False
+    try:
+        os.replace(src, dst)
+        return False
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        return True
+
+
+def copy_file(src, dst):
+    """
+    Copy a file across devices through a temporary name, then remove the source.
+
+    Args:
+        src (str): The source path.
+        dst (str): The destination path.
+    """
+    tmp_path = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.part")
+    shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+    os.remove(src)
+
+
+def expand_operations(operations):
+    """
+    Turn folder moves into file moves when they cannot be a single rename: when the destination
+    already exists or is on another device.
+
+    Args:
+        operations (list): The planned operations.
+
+    Returns:
+        list: The operations, where each folder move is either kept or replaced by file moves and
+            a removal.
+    """
+    expanded = []
+    for kind, src, dst in operations:
+        if kind != "dir" or not os.path.isdir(src):
+            expanded.append([kind, src, dst])
+            continue
+        parent = os.path.dirname(dst)
+        os.makedirs(parent, exist_ok=True)
+        same_device = os.stat(src).st_dev == os.stat(parent).st_dev
+        if not os.path.exists(dst) and same_device:
+            expanded.append([kind, src, dst])
+            continue
+        for file in sorted(os.listdir(src)):
+            expanded.append(["file", os.path.join(src, file), os.path.join(dst, file)])
+        expanded.append(["rmtree", src, None])
+    return expanded
+
+
+def run_operations(manifest_path, operations, done=(), after=None):
+    """
+    Run the operations of a manifest, one destination group at a time. Renames are done in the
+    calling thread, only the files crossing devices are copied by a pool of threads.
+
+    Args:
+        manifest_path (str): The path to the manifest.
+        operations (list): The planned operations.
+        done (set): The destination groups already completed.
+        after (callable, optional): Called with the operations once they all ran, before the
+            manifest is removed so that it is called again if the batch is resumed.
+    """
+    groups = defaultdict(list)
+    removals = []
+    for kind, src, dst in operations:
+        if kind == "rmtree":
+            removals.append(src)
+        elif kind == "file":
+            groups[os.path.dirname(dst)].append((src, dst))
+        else:
+            groups[dst].append((src, dst))
+
+    with ThreadPoolExecutor(max_workers=MOVE_WORKERS) as executor:
+        for group, moves in groups.items():
+            if group in done:
+                continue
+            os.makedirs(os.path.dirname(moves[0][1]), exist_ok=True)
+            copies = [(src, dst) for src, dst in moves if move_file(src, dst)]
+            for future in [executor.submit(copy_file, *move) for move in copies]:
+                future.result()
+            mark_done(manifest_path, group)
+
+    for folder in removals:
+        shutil.rmtree(folder, ignore_errors=True)
+    if after is not None:
+        after(operations)
+    os.remove(manifest_path)
+
+
+def move_batch(manifest_path, operations, after=None):
+    """
+    Record a batch of moves in a manifest, then run it. An interrupted batch can be completed with
+    resume or undone with rollback.
+
+    Args:
+        manifest_path (str): The path to the manifest.
+        operations (list): The operations, see write_manifest.
+        after (callable, optional): Called with the operations once they all ran.
+    """
+    operations = expand_operations(operations)
+    write_manifest(manifest_path, operations)
+    run_operations(manifest_path, operations, after=after)
+
+
+def resume(manifest_folder, after=None):
+    """
+    Complete the batches interrupted before the end of their manifest.
+
+    Args:
+        manifest_folder (str): The folder holding the manifests.
+        after (callable, optional): Called with the operations of each batch once they all ran.
+    """
+    for manifest_path in sorted(glob.glob(os.path.join(manifest_folder, "*.jsonl"))):
+        logging.info(f"Resuming moves of {manifest_path}")
+        operations, done = read_manifest(manifest_path)
+        run_operations(manifest_path, operations, done, after)
+
+
+def rollback(manifest_folder):
+    """
+    Undo the interrupted batches, moving their files back to where they were. Folders already
+    removed by a batch cannot be restored, they only hold the frames the split discards.
+
+    Args:
+        manifest_folder (str): The folder holding the manifests.
+    """
+    for manifest_path in sorted(glob.glob(os.path.join(manifest_folder, "*.jsonl"))):
+        logging.info(f"Rolling back moves of {manifest_path}")
+        operations, _ = read_manifest(manifest_path)
+        for kind, src, dst in reversed(operations):
+            if kind == "rmtree":
+                continue
+            if os.path.exists(dst) and not os.path.exists(src):
+                os.makedirs(os.path.dirname(src), exist_ok=True)
+                shutil.move(dst, src)
+            # The batch creates the folders of the file moves before moving anything
+            folder = os.path.dirname(dst)
+            if kind == "file" and os.path.isdir(folder) and not os.listdir(folder):
+                os.rmdir(folder)
+        os.remove(manifest_path)
+
+
+# Main Script
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 3 or sys.argv[1] not in ("resume", "rollback"):
+        sys.exit("Usage: python moves.py resume|rollback <manifest folder>")
+    if sys.argv[1] == "resume":
+        resume(sys.argv[2])
+    else:
+        rollback(sys.argv[2])
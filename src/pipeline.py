@@ -0,0 +1,317 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import partial
+from multiprocessing import Pool
+
+from dotenv import load_dotenv
+
+import dl_images
+import metrics
+import process_awf
+import split_cams
+from catalog import CATALOG_PATH, FrameCatalog
+from moves import resume
+from storage import StorageGovernor
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+OUTPUT_BASE_PATH = os.getenv("OUTPUT_PATH", "AWF_scrap")
+DL_FRAMES_FOLDER = os.path.join(OUTPUT_BASE_PATH, "dl_frames")
+SPLIT_FOLDER = os.path.join(OUTPUT_BASE_PATH, "dl_frames_splited")
+DONE_FOLDER = os.path.join(OUTPUT_BASE_PATH, "done")
+# Seconds between the starts of two download rounds over all the cameras
+DOWNLOAD_INTERVAL = float(os.getenv("DOWNLOAD_INTERVAL", 3600))
+# "1" splits the folders of the past days into presets before their detection, "0" runs the
+# detection on the downloaded folders as process_awf.py does
+PIPELINE_SPLIT = os.getenv("PIPELINE_SPLIT", "1") == "1"
+# Threads running the OCR of the split, and processes running the detection
+SPLIT_WORKERS = int(os.getenv("SPLIT_WORKERS", 1))
+DETECT_WORKERS = int(os.getenv("DETECT_WORKERS", 4))
+# Folders waiting between two stages, a full queue blocks the stage feeding it
+QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 8))
+POLL_INTERVAL = 60
+
+
+class Pipeline:
+    """
+    Single long running process chaining the download, with its inline gray filter, the split
+    and the detection. The download hands folders over through the catalog, the other stages
+    through bounded queues: a stage that falls behind blocks the one feeding it instead of piling
+    up work, so all the stages run around the clock without blackout windows.
+
+    Each folder is tracked from the moment it is queued until its stage completes, so that the
+    feeder, which re-reads the catalog at every wake up, never queues it twice.
+    """
+
+    def __init__(self):
+        self.catalog = None
+        self.governor = None
+        self.split_queue = queue.Queue(QUEUE_SIZE)
+        self.detect_queue = queue.Queue(QUEUE_SIZE)
+        # Batched detection keeps several folders per worker in flight
+        self.detect_slots = threading.Semaphore(
+            DETECT_WORKERS
+            * (process_awf.FOLDERS_PER_WORKER if process_awf.BATCHED_DETECTION else 1)
+        )
+        self.in_flight = set()
+        self.failures = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    @staticmethod
+    def remove_empty_parents(folder, levels):
+        """
+        Remove the parents of a processed folder that it left empty.
+
+        Args:
+            folder (str): The processed folder.
+            levels (int): The number of parents to try.
+        """
+        for _ in range(levels):
+            folder = os.path.dirname(folder)
+            try:
+                os.rmdir(folder)
+            except OSError:
+                return
+
+    def claim(self, folder):
+        """
+        Mark a folder as in flight.
+
+        Args:
+            folder (str): The folder.
+
+        Returns:
+            bool: False if the folder is already in flight or failed before.
+        """
+        with self.lock:
+            if folder in self.in_flight or folder in self.failures:
+                return False
+            self.in_flight.add(folder)
+            metrics.set_gauge("folders_in_flight", len(self.in_flight))
+            return True
+
+    def release(self, folder, error=None):
+        """
+        Mark a folder as done with its stage. A failed folder is left aside until the next
+        restart instead of being retried in a loop.
+
+        Args:
+            folder (str): The folder.
+            error (Exception, optional): The error that made the stage fail.
+        """
+        with self.lock:
+            self.in_flight.discard(folder)
+            metrics.set_gauge("folders_in_flight", len(self.in_flight))
+            if error is not None:
+                logging.error(f"Error processing {folder}: {error}")
+                self.failures.add(folder)
+                metrics.inc("folders_failed_total")
+        self.wakeup.set()
+
+    def download_loop(self):
+        """
+        Download all the cameras every DOWNLOAD_INTERVAL seconds, waking the feeder up as each
+        camera is committed.
+        """
+        while True:
+            start = time.monotonic()
+            try:
+                response = dl_images.get_session().get(
+                    dl_images.CAMERAS_URL, timeout=dl_images.MAX_TIME
+                )
+                features = response.json()["features"]
+                if dl_images.DOWNLOAD_ENGINE == "async":
+                    asyncio.run(dl_images.download_and_process_images_async(features))
+                    self.wakeup.set()
+                else:
+                    features = dl_images.schedule_cameras(features)
+                    with ThreadPoolExecutor(dl_images.DOWNLOAD_WORKERS) as executor:
+                        futures = [
+                            executor.submit(
+                                dl_images.download_and_process_camera,
+                                feature["properties"],
+                            )
+                            for feature in features
+                        ]
+                        for _ in as_completed(futures):
+                            self.wakeup.set()
+            except Exception as e:
+                logging.error(f"Failed to fetch camera data: {e}")
+            time.sleep(max(0, DOWNLOAD_INTERVAL - (time.monotonic() - start)))
+
+    def ready_folders(self):
+        """
+        List the folders the catalog holds pending frames of, with their stage.
+
+        Returns:
+            list: The (folder, stage) pairs, oldest day first, or next evicted first when the
+                frame store is under pressure.
+        """
+        ready = []
+        for folder in self.catalog.pending_folders("downloaded", DL_FRAMES_FOLDER):
+            # A folder with committed frames may be receiving a new download
+            if os.path.exists(os.path.join(folder, dl_images.INCOMPLETE_MARKER)):
+                continue
+            # The folders of today are still receiving downloads, whether split or not
+            if split_cams.is_past_day(folder):
+                ready.append((folder, "downloaded"))
+        if PIPELINE_SPLIT:
+            for folder in self.catalog.pending_folders("split", SPLIT_FOLDER):
+                ready.append((folder, "split"))
+        stages = dict(ready)
+        return [
+            (folder, stages[folder])
+            for folder in self.governor.prioritize(list(stages))
+            if os.path.isdir(folder)
+        ]
+
+    def record_queues(self):
+        """
+        Record the depth of the queues between the stages.
+        """
+        metrics.set_gauge("queue_depth", self.split_queue.qsize(), stage="split")
+        metrics.set_gauge("queue_depth", self.detect_queue.qsize(), stage="detect")
+
+    def feed_loop(self):
+        """
+        Queue the ready folders for their next stage, blocking while that stage is saturated.
+        """
+        while True:
+            self.wakeup.clear()
+            for folder, stage in self.ready_folders():
+                if not self.claim(folder):
+                    continue
+                if stage == "downloaded" and PIPELINE_SPLIT:
+                    self.split_queue.put(folder)
+                else:
+                    self.detect_queue.put((folder, stage))
+                self.record_queues()
+            self.record_queues()
+            self.wakeup.wait(POLL_INTERVAL)
+
+    def split_worker(self):
+        """
+        Split the queued camera folders and queue their preset folders for detection.
+        """
+        while True:
+            folder = self.split_queue.get()
+            try:
+                preset_folders = split_cams.split_folder(self.catalog, folder)
+            except Exception as e:
+                self.release(folder, e)
+                continue
+            self.remove_empty_parents(folder, 1)
+            for preset_folder in preset_folders:
+                if self.claim(preset_folder):
+                    self.detect_queue.put((preset_folder, "split"))
+            self.record_queues()
+            self.release(folder)
+
+    def detected(self, folder, stage, result):
+        """
+        Pool callback of a completed detection, removing the camera and day folders left empty.
+        The day folder of the downloads is kept while the day is not over.
+
+        Args:
+            folder (str): The processed folder.
+            stage (str): The stage of the frames of the folder.
+            result: The return value of the task, the metrics it recorded.
+        """
+        if result:
+            metrics.merge(result)
+        if stage == "split":
+            self.remove_empty_parents(folder, 2)
+        elif split_cams.is_past_day(folder):
+            self.remove_empty_parents(folder, 1)
+        self.detect_slots.release()
+        self.release(folder)
+
+    def detect_failed(self, folder, error):
+        """
+        Pool callback of a failed detection.
+
+        Args:
+            folder (str): The folder that failed.
+            error (Exception): The error raised by the task.
+        """
+        self.detect_slots.release()
+        self.release(folder, error)
+
+    def run(self):
+        if process_awf.BATCHED_DETECTION:
+            workers = nullcontext()
+        else:
+            # The pool is forked before any thread or database connection exists
+            workers = Pool(
+                DETECT_WORKERS,
+                initializer=process_awf.init_worker,
+                initargs=(CATALOG_PATH,),
+            )
+        with workers as pool:
+            self.catalog = FrameCatalog(CATALOG_PATH)
+            if pool is None:
+                pool = process_awf.BatchedDetection(
+                    DETECT_WORKERS,
+                    process_awf.WEIGHT,
+                    process_awf.CONF_MODEL,
+                    DONE_FOLDER,
+                    self.catalog,
+                )
+            # Shared with the downloads, the folders in flight are never evicted
+            self.governor = StorageGovernor(
+                self.catalog, OUTPUT_BASE_PATH, exclude=self.in_flight
+            )
+            dl_images._governor = self.governor
+            dl_images.recover_incomplete_cameras()
+            resume(
+                split_cams.SPLIT_MANIFESTS,
+                partial(split_cams.catalog_moves, self.catalog),
+            )
+            process_awf.recover_interrupted_folders(DONE_FOLDER, self.catalog)
+
+            workers = [self.download_loop, self.feed_loop]
+            if PIPELINE_SPLIT:
+                workers += [self.split_worker] * SPLIT_WORKERS
+            for worker in workers:
+                threading.Thread(target=worker, daemon=True).start()
+
+            process = partial(
+                process_awf.process_camera_folder,
+                weight=process_awf.WEIGHT,
+                conf_model=process_awf.CONF_MODEL,
+                DONE_FOLDER=DONE_FOLDER,
+            )
+            while True:
+                folder, stage = self.detect_queue.get()
+                self.record_queues()
+                self.detect_slots.acquire()
+                callback = partial(self.detected, folder, stage)
+                error_callback = partial(self.detect_failed, folder)
+                if process_awf.BATCHED_DETECTION:
+                    pool.submit(folder, stage, callback, error_callback)
+                else:
+                    pool.apply_async(
+                        process,
+                        (folder,),
+                        {"stage": stage},
+                        callback=callback,
+                        error_callback=error_callback,
+                    )
+
+
+# Main Script
+if __name__ == "__main__":
+    metrics.start("pipeline", os.path.join(OUTPUT_BASE_PATH, "reports"))
+    try:
+        Pipeline().run()
+    finally:
+        if dl_images._gray_pool is not None:
+            dl_images._gray_pool.shutdown()
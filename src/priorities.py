@@ -0,0 +1,183 @@
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytz
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+# "0" downloads every camera at every run, in the order of the camera list
+CAMERA_SCHEDULING = os.getenv("CAMERA_SCHEDULING", "1") == "1"
+# Local hours (start-end) during which a camera is not downloaded, empty to download at night
+NIGHT_HOURS = os.getenv("NIGHT_HOURS", "21-5")
+# Days of frames the yield of a camera is measured on
+STATS_DAYS = 7
+# Cameras with fewer frames in the stats are scraped as useful ones until they have more
+MIN_FRAMES = 100
+# Share of the score kept by a camera that never yields a kept detection
+YIELD_FLOOR = 0.25
+# Kept frames with detections at which a camera gets half of the rest of the yield score
+YIELD_HALF = 5
+
+
+def parse_night_hours(spec):
+    """
+    Parse the night hours of the cameras.
+
+    Args:
+        spec (str): The local hours as "start-end", e.g. "21-5", or an empty string.
+
+    Returns:
+        tuple: The start and end hours, or None if the cameras are downloaded at night.
+    """
+    if not spec.strip():
+        return None
+    start, end = spec.split("-")
+    return int(start), int(end)
+
+
+def camera_score(stats):
+    """
+    Score the usefulness of a camera from its stats: its share of color frames, of successful
+    downloads, and its kept detections.
+
+    Args:
+        stats (dict): The stats of the camera, see FrameCatalog.camera_stats, or None.
+
+    Returns:
+        float: The score between 0 and 1, 1 for a camera with too few frames to judge.
+    """
+    if stats is None or stats["frames"] < MIN_FRAMES:
+        return 1.0
+    color = 1 - stats["gray"] / stats["frames"]
+    success = 1 - stats["failure_rate"]
+    # A camera none of whose frames went through the detection yet is given the benefit of the doubt
+    useful = stats["kept"] / (stats["kept"] + YIELD_HALF) if stats["detected"] else 1
+    return color * success * (YIELD_FLOOR + (1 - YIELD_FLOOR) * useful)
+
+
+class CameraScheduler:
+    """
+    Choose the cameras of a download run and their order from their history, so that bandwidth
+    and CPU go to the cameras yielding useful frames. Cameras in local night are skipped, the
+    others are downloaded at an interval growing as their score falls, up to max_interval, and
+    the best scores come first. Since a timelapse preset covers the hours elapsed since the last
+    download, a camera scraped less often loses no frames as long as max_interval stays within
+    the longest preset.
+
+    Args:
+        catalog (FrameCatalog): The frame catalog holding the camera stats.
+        timezones (dict): The timezone name of each camera state.
+        default_timezone (str): The timezone of the cameras of other states.
+        max_interval (float): The seconds between two downloads of a camera with a score of 0.
+    """
+
+    def __init__(self, catalog, timezones, default_timezone, max_interval):
+        self.catalog = catalog
+        self.timezones = timezones
+        self.default_timezone = default_timezone
+        self.max_interval = max_interval
+        self.night = parse_night_hours(NIGHT_HOURS)
+
+    def local_time(self, state, now=None):
+        """
+        Get the local time of a camera state.
+
+        Args:
+            state (str): The state of the camera.
+            now (float, optional): The epoch seconds, the current time if not given.
+
+        Returns:
+            datetime: The local time.
+        """
+        timezone = pytz.timezone(self.timezones.get(state, self.default_timezone))
+        return datetime.fromtimestamp(time.time() if now is None else now, timezone)
+
+    def is_night(self, state, now=None):
+        """
+        Tell whether it is night for the cameras of a state.
+
+        Args:
+            state (str): The state of the camera.
+            now (float, optional): The epoch seconds, the current time if not given.
+
+        Returns:
+            bool: True during the night hours.
+        """
+        if self.night is None:
+            return False
+        start, end = self.night
+        hour = self.local_time(state, now).hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def night_end(self, state, now=None):
+        """
+        Get the end of the last night of a camera, before which its frames are not worth
+        downloading.
+
+        Args:
+            state (str): The state of the camera.
+            now (float, optional): The epoch seconds, the current time if not given.
+
+        Returns:
+            float: The epoch seconds of the end of the last night, or None without night hours.
+        """
+        if self.night is None:
+            return None
+        local = self.local_time(state, now)
+        end = local.replace(hour=self.night[1], minute=0, second=0, microsecond=0)
+        if end > local:
+            end -= timedelta(days=1)
+        return end.timestamp()
+
+    def plan(self, cameras_features, now=None):
+        """
+        Select the cameras to download now and order them.
+
+        Args:
+            cameras_features (list): The camera features of the camera list.
+            now (float, optional): The epoch seconds, the current time if not given.
+
+        Returns:
+            list: The camera features to download, best score first.
+        """
+        now = time.time() if now is None else now
+        since = datetime.fromtimestamp(now) - timedelta(days=STATS_DAYS)
+        since_day = since.strftime("%Y_%m_%d")
+        try:
+            stats = self.catalog.camera_stats(since_day)
+        except Exception as e:
+            logging.error(f"Error reading camera stats: {e}")
+            stats = {}
+
+        planned = []
+        skipped = {"night": 0, "interval": 0}
+        for feature in cameras_features:
+            properties = feature["properties"]
+            source = str(properties.get("id")).lower()
+            camera_stats = stats.get(source)
+            score = camera_score(camera_stats)
+            last_download = camera_stats and camera_stats["last_download"]
+            interval = self.max_interval * (1 - score)
+            if self.is_night(properties.get("state"), now):
+                skipped["night"] += 1
+            elif last_download and now - last_download < interval:
+                skipped["interval"] += 1
+            else:
+                latency = camera_stats and camera_stats["latency"]
+                planned.append((-score, latency or 0, feature))
+
+        for reason, count in skipped.items():
+            metrics.inc("cameras_skipped_total", count, reason=reason)
+        logging.info(
+            f"Downloading {len(planned)} cameras, skipping {skipped['night']} at night "
+            f"and {skipped['interval']} scraped recently for their yield"
+        )
+        # The most useful cameras first, the fastest first among equals
+        planned.sort(key=lambda item: item[:2])
+        return [feature for _, _, feature in planned]
@@ -1,132 +1,1072 @@
 import glob
+import logging
 import multiprocessing
 import os
-import re
+import queue
 import shutil
 import subprocess
+import threading
 import time
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime, timedelta
+from contextlib import nullcontext
+from datetime import datetime
 from functools import partial  # Make sure to import partial
-from multiprocessing import Manager, Pool
+from multiprocessing import Pool
+from zipfile import ZIP_DEFLATED, ZipFile
 
-from tqdm import tqdm
+import numpy as np
+from dotenv import load_dotenv
 
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # Not available outside Linux, the folders are polled instead
+    INotify = None
 
-def filter_by_windows(cam_folder, labels):
-    labels.sort()
-    keep_labels = set()
-    current_list = []
-    for idx, file in enumerate(labels):
-        match = re.search(r"(\d{4}_\d{2}_\d{2}T\d{2}_\d{2}_\d{2})", file)
-        t = datetime.strptime(match.group(), "%Y_%m_%dT%H_%M_%S")
-        if len(current_list) == 0:
-            last_time = t
-            current_list.append(file)
-        else:
-            if abs((t - last_time).total_seconds()) < 60 * 15:  # 15mn windows
-                current_list.append(file)
-                last_time = t
-            else:
-                if len(current_list) > 1:  # min 2 detection on the windows
-                    keep_labels = keep_labels.union(set(current_list))
-
-                current_list = [file]
-                last_time = t
-
-    if len(current_list) > 1:
-        keep_labels = keep_labels.union(set(current_list))
-
-    time_windows = []
-    for file in keep_labels:
-        match = re.search(r"(\d{4}_\d{2}_\d{2}T\d{2}_\d{2}_\d{2})", file)
-        t = datetime.strptime(match.group(), "%Y_%m_%dT%H_%M_%S")
-        t_min = t - timedelta(minutes=15)
-        t_max = t + timedelta(minutes=15)
-        time_windows.append((t_min, t_max))
-
-    imgs = glob.glob(cam_folder + "/*")
-    imgs.sort()
-    keep_imgs = set()
-    for file in imgs:
-        match = re.search(r"(\d{4}_\d{2}_\d{2}T\d{2}_\d{2}_\d{2})", file)
-        t = datetime.strptime(match.group(), "%Y_%m_%dT%H_%M_%S")
-        for t_min, t_max in time_windows:
-            if t > t_min and t < t_max:
-                keep_imgs.add(file)
-                break
+import metrics
+from catalog import PROCESSING_MARKER, FrameCatalog
+from detector import Detector, format_labels
+from journal import Journal
+from shards import ShardWriter, read_index
+from storage import StorageGovernor
+from timestamps import group_detections, in_windows, merge_windows, parse_frame_times
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+DL_FRAMES_FOLDER = os.getenv("DL_FRAMES_FOLDER", "/mnt/T7/AWF_scrap/dl_frames")
+DONE_FOLDER = DL_FRAMES_FOLDER.replace("dl_frames", "done")
+WEIGHT = os.getenv("MODEL_PATH", "/home/pi/pyro-scrapper/data/model.onnx")
+CONF_MODEL = 0.2
+POOL_SIZE = int(os.getenv("DETECT_WORKERS", 4))
+# No folder is dispatched during these local time windows (HH:MM-HH:MM), which leave the
+# machine to the downloads
+BLACKOUT_WINDOWS = os.getenv("BLACKOUT_WINDOWS", "19:00-20:00,01:00-02:00,07:00-08:00")
+POLL_INTERVAL = 60
+# Frame catalog shared with dl_images.py, next to the dl_frames folder by default
+CATALOG_PATH = os.getenv(
+    "CATALOG_PATH", os.path.join(os.path.dirname(DL_FRAMES_FOLDER), "catalog.sqlite")
+)
+
+# Present in a camera folder while dl_images.py is writing frames to it
+INCOMPLETE_MARKER = ".incomplete"
+# "onnx" runs the model in process, "yolo" shells out to `yolo predict` for each folder
+INFERENCE_ENGINE = os.getenv("INFERENCE_ENGINE", "onnx")
+IMGSZ = (384, 640)
+BATCH_SIZE = 8
+# "batched" pools the frames of many folders into the inference batches of all the workers,
+# "folder" runs the detection of each folder as one task of a worker. The "yolo" engine always
+# works per folder.
+DETECT_MODE = os.getenv("DETECT_MODE", "batched")
+BATCHED_DETECTION = DETECT_MODE == "batched" and INFERENCE_ENGINE == "onnx"
+# Folders in flight per worker in batched mode, so that the workers are kept busy while the
+# folders are filtered and archived
+FOLDERS_PER_WORKER = 4
+# Seconds a worker waits for more frames to fill a batch, and batches queued per worker
+BATCH_WAIT = 0.05
+QUEUED_BATCHES = 2
+ARCHIVE_WORKERS = 2
+# Times in a row the frames of a folder held by dead workers are fed again, without any of its
+# frames inferred in between, before the folder is failed as one of them kills the workers
+WORKER_RETRIES = 2
+# "zip" archives the kept frames of each camera day in a zip, "tar" appends them to an
+# uncompressed tar shard with an offset index, readable with shards.iter_samples
+ARCHIVE_FORMAT = os.getenv("ARCHIVE_FORMAT", "zip")
+# Journals of the folders being processed, inside the archive folder
+JOURNAL_FOLDER = ".journal"
+# Detections need a confirmation within this window, frames are kept this close to them
+DETECTION_WINDOW = 15 * 60
+
+# Loaded once per worker process
+detector = None
+catalog = None
+
+
+def filter_by_windows(cam_folder, labels, imgs=None):
+    """
+    Keep the detections confirmed by another one less than DETECTION_WINDOW apart, and the frames
+    less than DETECTION_WINDOW away from a kept detection.
+
+    Args:
+        cam_folder (str): The folder of the frames.
+        labels (list): The frames or label files with detections.
+        imgs (list, optional): The frames of the folder, listed from the folder if not given.
+
+    Returns:
+        tuple: The set of kept frames and the set of kept labels.
+    """
+    labels = sorted(labels)
+    label_times = parse_frame_times(labels)
+    order = np.argsort(label_times, kind="stable")
+    keep = order[group_detections(label_times[order], DETECTION_WINDOW)]
+    keep_labels = {labels[idx] for idx in keep}
+
+    # Frames strictly within the window of a kept detection, timestamps are whole seconds
+    starts, ends = merge_windows(np.sort(label_times[keep]), DETECTION_WINDOW - 1)
+
+    if imgs is None:
+        imgs = glob.glob(cam_folder + "/*")
+    imgs = sorted(imgs)
+    mask = in_windows(parse_frame_times(imgs), starts, ends)
+    keep_imgs = {file for file, kept in zip(imgs, mask) if kept}
 
     return keep_imgs, keep_labels
 
 
-def process_camera_folder(cam_folder, weight, conf_model, DONE_FOLDER):
-    current_hour = datetime.now().hour
-    if current_hour in (19, 1, 7):  # dl times
-        print("Main task paused for restricted hours...")
+def get_detector(weight, conf_model):
+    """
+    Get the detector of the current process, loading the model on first use.
+
+    Args:
+        weight (str): The path to the ONNX model.
+        conf_model (float): The confidence threshold.
+
+    Returns:
+        Detector: The detector of the process.
+    """
+    global detector
+    if detector is None:
+        detector = Detector(weight, conf=conf_model, imgsz=IMGSZ, batch_size=BATCH_SIZE)
+    return detector
+
+
+def get_catalog():
+    """
+    Get the frame catalog connection of the current process, opening it on first use.
 
-        time.sleep(600)  # sleep 10 mn
-    else:
-        name = cam_folder.split("/")[-2] + "_" + cam_folder.split("/")[-1]
+    Returns:
+        FrameCatalog: The frame catalog.
+    """
+    global catalog
+    if catalog is None:
+        catalog = FrameCatalog(CATALOG_PATH)
+    return catalog
 
-        cmd = f"yolo predict task=detect model={weight} conf={conf_model} source={cam_folder} save=False save_txt imgsz='(384, 640)' save_conf name={name} project=runs_awf verbose=False"
-        print(f"* Command:\n{cmd}")
+
+def init_worker(catalog_path):
+    """
+    Pool initializer opening the frame catalog of a worker process at a given path.
+
+    Args:
+        catalog_path (str): The path to the frame catalog.
+    """
+    global catalog
+    catalog = FrameCatalog(catalog_path)
+    # The series forked from the parent are its own
+    metrics.reset()
+
+
+def predict_with_yolo(cam_folder, weight, conf_model, name):
+    """
+    Run the detection of a folder with the ultralytics CLI.
+
+    Args:
+        cam_folder (str): The folder of the frames.
+        weight (str): The path to the ONNX model.
+        conf_model (float): The confidence threshold.
+        name (str): The name of the run.
+
+    Returns:
+        dict: The label lines of each frame with at least one detection.
+    """
+    # Left by an interrupted run, yolo would write the labels to another folder
+    shutil.rmtree(f"runs_awf/{name}", ignore_errors=True)
+    cmd = f"yolo predict task=detect model={weight} conf={conf_model} source={cam_folder} save=False save_txt imgsz='{IMGSZ}' save_conf name={name} project=runs_awf verbose=False"
+    print(f"* Command:\n{cmd}")
+    with metrics.timer("inference_batch_seconds"):
         subprocess.call(cmd, shell=True)
-        labels = glob.glob(f"runs_awf/{name}/labels/*")
-        keep_imgs, keep_labels = filter_by_windows(cam_folder, labels)
-        if len(keep_imgs):
-            save_folder = os.path.join(DONE_FOLDER, name)
-            new_img_folder = os.path.join(save_folder, "images")
-            os.makedirs(new_img_folder, exist_ok=True)
-            new_label_folder = os.path.join(save_folder, "labels")
-            os.makedirs(new_label_folder, exist_ok=True)
-            for file in keep_imgs:
-                new_file = os.path.join(new_img_folder, os.path.basename(file))
-                shutil.copy(file, new_file)
-            for file in keep_labels:
-                new_file = os.path.join(new_label_folder, os.path.basename(file))
-                shutil.copy(file, new_file)
-            shutil.make_archive(save_folder, "zip", save_folder)
-            shutil.rmtree(save_folder)
-
-        shutil.rmtree(cam_folder)
-        if len(labels):
-            shutil.rmtree(labels[0].split("labels")[0])
+    labels = glob.glob(f"runs_awf/{name}/labels/*")
+    detections = {}
+    for label in labels:
+        stem = os.path.splitext(os.path.basename(label))[0]
+        with open(label) as f:
+            detections[os.path.join(cam_folder, f"{stem}.jpg")] = f.read()
+    shutil.rmtree(f"runs_awf/{name}", ignore_errors=True)
+    return detections
 
 
-def main():
-    DL_FRAMES_FOLDER = "/mnt/T7/AWF_scrap/dl_frames"
-    DONE_FOLDER = DL_FRAMES_FOLDER.replace("dl_frames", "done")
-    weight = "/home/pi/pyro-scrapper/data/model.onnx"
-    conf_model = 0.2
-    pool_size = 4
-
-    while True:
-        folders = glob.glob(f"{DL_FRAMES_FOLDER}/*")
-        folders.sort()
-
-        if len(folders):
-            cam_folders = glob.glob(f"{folders[0]}/*")
-
-            with Manager() as manager:
-                queue = manager.Queue()
-                for cam_folder in cam_folders:
-                    queue.put(cam_folder)
-
-                # Prepare the partial function with preconfigured arguments
-                partial_process = partial(
-                    process_camera_folder,
-                    weight=weight,
-                    conf_model=conf_model,
-                    DONE_FOLDER=DONE_FOLDER,
+def predict_folder(cam_folder, weight, conf_model, name, imgs=None):
+    """
+    Run the detection of a folder with the configured inference engine.
+
+    Args:
+        cam_folder (str): The folder of the frames.
+        weight (str): The path to the ONNX model.
+        conf_model (float): The confidence threshold.
+        name (str): The name of the run.
+        imgs (list, optional): The frames of the folder, listed from the folder if not given.
+
+    Returns:
+        dict: The label lines of each frame with at least one detection.
+    """
+    if INFERENCE_ENGINE == "yolo":
+        return predict_with_yolo(cam_folder, weight, conf_model, name)
+    if imgs is None:
+        imgs = sorted(glob.glob(cam_folder + "/*"))
+    detections = get_detector(weight, conf_model).predict(imgs)
+    return {file: format_labels(boxes) for file, boxes in detections.items()}
+
+
+def archive_zip(save_folder, keep_imgs, keep_labels, detections):
+    """
+    Zip the kept frames, streamed from their files, and their labels in the images and labels
+    folders of the archive.
+
+    Args:
+        save_folder (str): The path of the archive, without its extension.
+        keep_imgs (set): The kept frames.
+        keep_labels (set): The kept frames with detections.
+        detections (dict): The label lines of each frame with detections.
+    """
+    os.makedirs(os.path.dirname(save_folder), exist_ok=True)
+    # Renamed once complete, a crash never leaves a partial zip under the final name
+    with ZipFile(f"{save_folder}.part.zip", "w", ZIP_DEFLATED) as archive:
+        archive.writestr("images/", "")
+        archive.writestr("labels/", "")
+        for file in sorted(keep_imgs):
+            archive.write(file, f"images/{os.path.basename(file)}")
+        # Label files are only written for the kept frames
+        for file in sorted(keep_labels):
+            stem = os.path.splitext(os.path.basename(file))[0]
+            archive.writestr(f"labels/{stem}.txt", detections[file])
+    os.replace(f"{save_folder}.part.zip", f"{save_folder}.zip")
+
+
+def archive_tar(save_folder, keep_imgs, keep_labels, detections, members=None):
+    """
+    Append the kept frames and their labels to the tar shard of the camera day, as samples named
+    after the frame timestamp.
+
+    Args:
+        save_folder (str): The path of the shard, without its extension.
+        keep_imgs (set): The kept frames.
+        keep_labels (set): The kept frames with detections.
+        detections (dict): The label lines of each frame with detections.
+        members (int, optional): The number of members the shard had before this folder, those
+            appended by an interrupted attempt are dropped.
+    """
+    os.makedirs(os.path.dirname(save_folder), exist_ok=True)
+    with ShardWriter(f"{save_folder}.tar", members) as writer:
+        for file in sorted(keep_imgs):
+            stem = os.path.splitext(os.path.basename(file))[0]
+            writer.add_file(f"{stem}.jpg", file)
+            if file in keep_labels:
+                writer.add(f"{stem}.txt", detections[file].encode())
+
+
+def folder_name(cam_folder, stage):
+    """
+    Name a folder after its day and camera, and its preset for split folders.
+
+    Args:
+        cam_folder (str): The folder of the frames.
+        stage (str): The stage of the frames of the folder.
+
+    Returns:
+        tuple: The name of the folder and its camera.
+    """
+    depth = 3 if stage == "split" else 2
+    parts = cam_folder.split("/")
+    return "_".join(parts[-depth:]), parts[1 - depth]
+
+
+def get_journal(DONE_FOLDER):
+    """
+    Get the journal of the folders being processed, kept next to their archives.
+
+    Args:
+        DONE_FOLDER (str): The folder of the archives.
+
+    Returns:
+        Journal: The journal of the detect stage.
+    """
+    return Journal(os.path.join(DONE_FOLDER, JOURNAL_FOLDER), "detect")
+
+
+def claim_folder(cam_folder):
+    """
+    Mark a folder as being processed, so that the storage governor of the downloads does not
+    evict it. The marker is removed along with the frames by archive_folder, or at the next start
+    by recover_interrupted_folders.
+
+    Args:
+        cam_folder (str): The folder of the frames.
+    """
+    open(os.path.join(cam_folder, PROCESSING_MARKER), "w").close()
+
+
+def resume_detections(steps, imgs, distinct):
+    """
+    Take over the detections of an interrupted attempt at a folder.
+
+    Args:
+        steps (dict): The steps of the folder in its journal.
+        imgs (list): The frames of the folder.
+        distinct (list): The frames of the folder to infer.
+
+    Returns:
+        tuple: The frames left to infer, those downloaded since the attempt included, the set of
+            frames already inferred and the label lines of those with detections.
+    """
+    detected = steps.get("detected", {"frames": [], "detections": {}})
+    imgs = set(imgs)
+    inferred = {file for file in detected["frames"] if file in imgs}
+    detections = {
+        file: label for file, label in detected["detections"].items() if file in imgs
+    }
+    return [file for file in distinct if file not in inferred], inferred, detections
+
+
+def near_duplicates(imgs, inferred, detections):
+    """
+    List the near duplicates less than DETECTION_WINDOW away from a detection that are not
+    inferred yet. The frames of a plume growing in a still scene hash alike, so a detection is
+    often confirmed by one of them rather than by the next distinct frame.
+
+    Args:
+        imgs (list): The frames of the folder.
+        inferred (set): The frames of the folder already inferred.
+        detections (dict): The label lines of each frame with detections.
+
+    Returns:
+        list: The frames to infer next.
+    """
+    if not detections:
+        return []
+    todo = sorted(file for file in imgs if file not in inferred)
+    starts, ends = merge_windows(
+        np.sort(parse_frame_times(list(detections))), DETECTION_WINDOW - 1
+    )
+    mask = in_windows(parse_frame_times(todo), starts, ends)
+    return [file for file, near in zip(todo, mask) if near]
+
+
+def process_camera_folder(
+    cam_folder, weight, conf_model, DONE_FOLDER, stage="downloaded"
+):
+    name, camera = folder_name(cam_folder, stage)
+    journal = get_journal(DONE_FOLDER)
+    steps = journal.begin(name, folder=cam_folder, stage=stage)
+    claim_folder(cam_folder)
+    imgs = get_catalog().folder_frames(cam_folder, stage)
+    # Near duplicates are only inferred around the detections, see near_duplicates
+    distinct = get_catalog().folder_frames(cam_folder, stage, duplicate=False)
+    todo, inferred, detections = resume_detections(steps, imgs, distinct)
+    if todo or "detected" not in steps:
+        with metrics.timer("stage_seconds", stage="detect", camera=camera):
+            while todo:
+                detections.update(
+                    predict_folder(cam_folder, weight, conf_model, name, todo)
                 )
+                # YOLO infers the whole folder whatever the frames asked for
+                inferred.update(imgs if INFERENCE_ENGINE == "yolo" else todo)
+                todo = near_duplicates(imgs, inferred, detections)
+        steps["detected"] = dict(frames=sorted(inferred), detections=detections)
+        journal.checkpoint(name, "detected", **steps["detected"])
+    archive_folder(
+        cam_folder, stage, imgs, inferred, detections, DONE_FOLDER, steps=steps
+    )
+    # Handed over to the parent process, which serves and reports them
+    return metrics.drain()
+
+
+def archive_folder(
+    cam_folder,
+    stage,
+    imgs,
+    inferred,
+    detections,
+    DONE_FOLDER,
+    catalog=None,
+    steps=None,
+):
+    """
+    Archive the frames of a folder kept around its confirmed detections, record the fate of all
+    its frames in the catalog and remove them, along with the folder once it is empty. Each step is journaled, so that a folder interrupted
+    by a crash is neither archived twice nor left behind.
+
+    Args:
+        cam_folder (str): The folder of the frames.
+        stage (str): The stage of the frames of the folder.
+        imgs (list): The frames of the folder.
+        inferred (collection): The frames of the folder that went through the detection.
+        detections (dict): The label lines of each frame with detections.
+        DONE_FOLDER (str): The folder of the archives.
+        catalog (FrameCatalog, optional): The frame catalog, the one of the process if not given.
+        steps (dict, optional): The steps of the folder in its journal, read from it if not given.
+    """
+    catalog = get_catalog() if catalog is None else catalog
+    name, camera = folder_name(cam_folder, stage)
+    journal = get_journal(DONE_FOLDER)
+    steps = journal.read(name) if steps is None else steps
+    # Once recorded in the catalog, the frames of the folder are no longer listed in their stage
+    imgs = steps.get("recording", {}).get("frames", imgs)
+    labels = list(detections)
+    keep_imgs, keep_labels = filter_by_windows(cam_folder, labels, imgs)
+    if len(keep_imgs) and "archived" not in steps:
+        save_folder = os.path.join(DONE_FOLDER, name)
+        archive = archive_zip
+        if ARCHIVE_FORMAT == "tar":
+            # The shard is cut back to where it was before the first attempt
+            members = steps.get("archiving", {}).get("members")
+            if members is None:
+                members = len(read_index(f"{save_folder}.tar"))
+                journal.checkpoint(name, "archiving", members=members)
+            archive = partial(archive_tar, members=members)
+        else:
+            journal.checkpoint(name, "archiving")
+        with metrics.timer("stage_seconds", stage="archive", camera=camera):
+            archive(save_folder, keep_imgs, keep_labels, detections)
+        journal.checkpoint(name, "archived")
+    metrics.inc("frames_inferred_total", len(inferred), camera=camera)
+    metrics.inc("frames_archived_total", len(keep_imgs), camera=camera)
+
+    if "recording" not in steps:
+        journal.checkpoint(name, "recording", frames=list(imgs))
+    catalog.update_frames(
+        {
+            file: dict(
+                detections=detections.get(file),
+                stage="archived" if file in keep_imgs else "removed",
+            )
+            for file in imgs
+        }
+    )
+    # Frames committed since the folder was listed are left to the next pass, the folder may
+    # also hold the part files of a download in progress
+    for file in [*imgs, os.path.join(cam_folder, PROCESSING_MARKER)]:
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+    try:
+        os.rmdir(cam_folder)
+    except OSError:
+        pass
+    journal.commit(name)
+
+
+def recover_interrupted_folders(DONE_FOLDER, catalog=None):
+    """
+    Clean up after a crash in a single pass, before any folder is dispatched: remove the label
+    folders of the yolo CLI and the zips being written, finish the folders whose archive was
+    complete or whose frames were being recorded, and drop the journals of the folders that are gone. The other interrupted folders
+    are still pending in the catalog, they resume from their journal when dispatched again.
+
+    Args:
+        DONE_FOLDER (str): The folder of the archives.
+        catalog (FrameCatalog, optional): The frame catalog, the one of the process if not given.
+    """
+    catalog = get_catalog() if catalog is None else catalog
+    journal = get_journal(DONE_FOLDER)
+    orphans = glob.glob("runs_awf/*") + glob.glob(f"{DONE_FOLDER}/*.part.zip")
+    # Folders the zips were staged in by earlier versions, the journals are hidden
+    orphans += [path for path in glob.glob(f"{DONE_FOLDER}/*") if os.path.isdir(path)]
+    for path in orphans:
+        logging.info(f"Removing {path} left by an interrupted run")
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+    metrics.inc("orphans_removed_total", len(orphans), stage="detect")
+
+    for name, steps in journal.pending().items():
+        started = steps.get("started", {})
+        folder, stage = started.get("folder"), started.get("stage")
+        if ("archived" in steps or "recording" in steps) and folder is not None:
+            logging.info(f"Finishing {folder}, archived before the crash")
+            archive_folder(
+                folder,
+                stage,
+                catalog.folder_frames(folder, stage),
+                [],
+                steps["detected"]["detections"],
+                DONE_FOLDER,
+                catalog,
+                steps,
+            )
+        elif folder is not None and os.path.isdir(folder):
+            # Claimed again when dispatched
+            try:
+                os.remove(os.path.join(folder, PROCESSING_MARKER))
+            except FileNotFoundError:
+                pass
+        else:
+            if "members" in steps.get("archiving", {}):
+                # Cut the members appended to the shard before the crash
+                path = os.path.join(DONE_FOLDER, f"{name}.tar")
+                ShardWriter(path, steps["archiving"]["members"]).close()
+            journal.commit(name)
 
-                # Pool of worker processes
-                with Pool(pool_size) as pool:
-                    # Process the folders as they are available in the queue
-                    while not queue.empty():
-                        pool.apply_async(partial_process, (queue.get(),))
-                    pool.close()  # No more tasks will be submitted to the pool
-                    pool.join()  # Wait for the worker processes to exit
+
+def batch_worker(frames, results, weight, conf_model):
+    """
+    Worker process of BatchedDetection: take frames from the shared queue as soon as it is free,
+    up to a full batch, and send their labels back. None in the queue stops the worker.
+
+    Args:
+        frames (multiprocessing.Queue): The (folder, frame) pairs to infer.
+        results (multiprocessing.Queue): Receives the (folder, frame, labels or None) triples of
+            each batch along with the metrics recorded since the previous one.
+        weight (str): The path to the ONNX model.
+        conf_model (float): The confidence threshold.
+    """
+    detector = get_detector(weight, conf_model)
+    running = True
+    while running:
+        batch = [frames.get()]
+        if batch[0] is None:
+            break
+        # A partial batch is inferred rather than waiting for the next folders
+        while len(batch) < detector.batch_size:
+            try:
+                item = frames.get(timeout=BATCH_WAIT)
+            except queue.Empty:
+                break
+            if item is None:
+                running = False
+                break
+            batch.append(item)
+        detections = detector.predict([file for _, file in batch])
+        labels = [
+            (folder, file, format_labels(detections.get(file, [])) or None)
+            for folder, file in batch
+        ]
+        results.put((labels, metrics.drain()))
+
+
+class BatchedDetection:
+    """
+    Detect stage pooling the frames of many folders into fixed size inference batches. The frames
+    of the submitted folders are fed round robin, a batch of each folder at a time, to a queue
+    shared by the worker processes. Each worker takes the next frames as soon as it is free, so a
+    large folder is spread over all the workers instead of pinning one of them, and the small
+    folders do not wait behind it. The labels are routed back to their folder, which is filtered
+    and archived in this process once all its frames are inferred.
+
+    The workers are spawned, this process may already run threads and hold database connections.
+
+    Args:
+        workers (int): The number of worker processes.
+        weight (str): The path to the ONNX model.
+        conf_model (float): The confidence threshold.
+        DONE_FOLDER (str): The folder of the archives.
+        catalog (FrameCatalog): The frame catalog listing and recording the frames.
+    """
+
+    def __init__(self, workers, weight, conf_model, DONE_FOLDER, catalog):
+        self.weight = weight
+        self.conf_model = conf_model
+        self.DONE_FOLDER = DONE_FOLDER
+        self.catalog = catalog
+        self.journal = get_journal(DONE_FOLDER)
+        self.context = multiprocessing.get_context("spawn")
+        self.frames = self.context.Queue(workers * BATCH_SIZE * QUEUED_BATCHES)
+        self.results = self.context.Queue()
+        self.folders = {}
+        # Folders with frames left to feed, in round robin order
+        self.backlog = deque()
+        self.lock = threading.Lock()
+        self.fed = threading.Condition(self.lock)
+        self.closing = False
+        self.processes = [self.start_worker() for _ in range(workers)]
+        self.archiver = ThreadPoolExecutor(ARCHIVE_WORKERS)
+        threading.Thread(target=self.feed_loop, daemon=True).start()
+        self.collector = threading.Thread(target=self.collect_loop, daemon=True)
+        self.collector.start()
+
+    def start_worker(self):
+        process = self.context.Process(
+            target=batch_worker,
+            args=(self.frames, self.results, self.weight, self.conf_model),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def submit(self, folder, stage, callback, error_callback):
+        """
+        Queue the frames of a folder for detection.
+
+        Args:
+            folder (str): The folder of the frames.
+            stage (str): The stage of the frames of the folder.
+            callback (callable): Called without a result once the folder is archived.
+            error_callback (callable): Called with the error if the folder fails.
+        """
+        try:
+            name, _ = folder_name(folder, stage)
+            steps = self.journal.begin(name, folder=folder, stage=stage)
+            claim_folder(folder)
+            imgs = self.catalog.folder_frames(folder, stage)
+            # Near duplicates are only inferred around the detections, see near_duplicates
+            distinct = self.catalog.folder_frames(folder, stage, duplicate=False)
+        except Exception as e:
+            error_callback(e)
+            return
+        todo, inferred, detections = resume_detections(steps, imgs, distinct)
+        inferred.update(todo)
+        state = dict(
+            stage=stage,
+            name=name,
+            steps=steps,
+            imgs=imgs,
+            inferred=inferred,
+            queued=deque(todo),
+            # Fed to the workers and not inferred yet
+            outstanding=set(),
+            retries=0,
+            updated=bool(todo),
+            detections=detections,
+            callback=callback,
+            error_callback=error_callback,
+            start=time.perf_counter(),
+        )
+        with self.lock:
+            self.folders[folder] = state
+            if todo:
+                self.backlog.append(folder)
+                self.fed.notify()
+        if not todo:
+            self.archiver.submit(self.finish, folder)
+
+    def feed_loop(self):
+        """
+        Feed the frames of the folders to the workers, a batch of each folder in turn, blocking
+        while the workers are saturated.
+        """
+        while True:
+            with self.lock:
+                while not self.backlog:
+                    self.fed.wait()
+                folder = self.backlog.popleft()
+                queued = self.folders[folder]["queued"]
+                chunk = [queued.popleft() for _ in range(min(BATCH_SIZE, len(queued)))]
+                self.folders[folder]["outstanding"].update(chunk)
+                if queued:
+                    self.backlog.append(folder)
+            for file in chunk:
+                self.frames.put((folder, file))
+
+    def collect_loop(self):
+        """
+        Route the labels sent by the workers to their folders, and archive the folders whose
+        frames are all inferred. None from the queue stops the loop.
+        """
+        while True:
+            try:
+                result = self.results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                result = ()
+            if result is None:
+                break
+            done = []
+            if result:
+                labels, worker_metrics = result
+                metrics.merge(worker_metrics)
+                with self.lock:
+                    for folder, file, label in labels:
+                        state = self.folders.get(folder)
+                        # Fed again after a worker died, or its folder failed meanwhile
+                        if state is None or file not in state["outstanding"]:
+                            continue
+                        state["outstanding"].discard(file)
+                        state["retries"] = 0
+                        if label:
+                            state["detections"][file] = label
+                        if self.is_done(folder) and not self.requeue_near(folder):
+                            done.append(folder)
+            for folder in done:
+                self.archiver.submit(self.finish, folder)
+            self.check_workers()
+
+    def is_done(self, folder):
+        """
+        Tell whether all the queued frames of a folder are inferred, with the lock held.
+
+        Args:
+            folder (str): The folder of the frames.
+
+        Returns:
+            bool: Whether no frame of the folder is left to feed or to infer.
+        """
+        state = self.folders[folder]
+        return not state["queued"] and not state["outstanding"]
+
+    def requeue_near(self, folder):
+        """
+        Queue the near duplicates around the detections of a folder whose frames are all
+        inferred, with the lock held.
+
+        Args:
+            folder (str): The folder of the frames.
+
+        Returns:
+            bool: Whether frames were queued, in which case the folder is not done yet.
+        """
+        state = self.folders[folder]
+        near = near_duplicates(state["imgs"], state["inferred"], state["detections"])
+        if not near:
+            return False
+        state["inferred"].update(near)
+        state["queued"].extend(near)
+        if folder not in self.backlog:
+            self.backlog.append(folder)
+        self.fed.notify()
+        return True
+
+    def check_workers(self):
+        """
+        Replace the workers that died. The frames they were inferring cannot be told apart from
+        those still in the shared queue, so all the frames fed and not inferred yet are fed
+        again, the duplicate labels are ignored. The folders whose frames were fed again
+        WORKER_RETRIES times in a row already are failed instead.
+        """
+        dead = [i for i, process in enumerate(self.processes) if not process.is_alive()]
+        if not dead or self.closing:
+            return
+        for i in dead:
+            logging.error(
+                f"Detection worker exited with code {self.processes[i].exitcode}"
+            )
+            self.processes[i] = self.start_worker()
+        failed = []
+        with self.lock:
+            for folder, state in list(self.folders.items()):
+                if not state["outstanding"]:
+                    continue
+                if state["retries"] >= WORKER_RETRIES:
+                    del self.folders[folder]
+                    if folder in self.backlog:
+                        self.backlog.remove(folder)
+                    failed.append(state)
+                    continue
+                state["retries"] += 1
+                state["queued"].extendleft(sorted(state["outstanding"], reverse=True))
+                state["outstanding"].clear()
+                if folder not in self.backlog:
+                    self.backlog.appendleft(folder)
+            self.fed.notify()
+        for state in failed:
+            state["error_callback"](
+                RuntimeError(f"Detection workers died {WORKER_RETRIES + 1} times")
+            )
+
+    def finish(self, folder):
+        """
+        Filter and archive a folder whose frames are all inferred, then report it.
+
+        Args:
+            folder (str): The folder of the frames.
+        """
+        state = self.folders[folder]
+        _, camera = folder_name(folder, state["stage"])
+        steps = state["steps"]
+        try:
+            if state["updated"] or "detected" not in steps:
+                steps["detected"] = dict(
+                    frames=sorted(state["inferred"]), detections=state["detections"]
+                )
+                self.journal.checkpoint(state["name"], "detected", **steps["detected"])
+            archive_folder(
+                folder,
+                state["stage"],
+                state["imgs"],
+                state["inferred"],
+                state["detections"],
+                self.DONE_FOLDER,
+                self.catalog,
+                steps,
+            )
+        except Exception as e:
+            with self.lock:
+                del self.folders[folder]
+            state["error_callback"](e)
+            return
+        with self.lock:
+            del self.folders[folder]
+        seconds = time.perf_counter() - state["start"]
+        metrics.observe("stage_seconds", seconds, stage="detect", camera=camera)
+        state["callback"](None)
+
+    def close(self):
+        """
+        Stop the workers once the queued frames are inferred, and wait for the archives.
+        """
+        self.closing = True
+        for _ in self.processes:
+            self.frames.put(None)
+        for process in self.processes:
+            process.join()
+        # The last labels are routed before the archiver stops taking folders
+        self.results.put(None)
+        self.collector.join()
+        self.archiver.shutdown()
+
+
+def parse_blackout_windows(spec):
+    """
+    Parse blackout windows written as comma separated "HH:MM-HH:MM" ranges.
+
+    Args:
+        spec (str): The windows, a window may wrap around midnight.
+
+    Returns:
+        list: The (start, end) minutes of the day of each window.
+    """
+    windows = []
+    for window in filter(None, spec.replace(" ", "").split(",")):
+        start, end = (
+            int(hours) * 60 + int(minutes)
+            for hours, minutes in (bound.split(":") for bound in window.split("-"))
+        )
+        windows.append((start, end))
+    return windows
+
+
+def seconds_until_open(now, windows):
+    """
+    Compute how long dispatch stays paused by the blackout windows.
+
+    Args:
+        now (datetime): The current local time.
+        windows (list): The (start, end) minutes of the day of each window.
+
+    Returns:
+        float: 0 outside the windows, else the number of seconds until the current window ends.
+    """
+    minute = now.hour * 60 + now.minute + now.second / 60
+    for start, end in windows:
+        if start <= end and start <= minute < end:
+            return (end - minute) * 60
+        if start > end and (minute >= start or minute < end):
+            return ((end - minute) % (24 * 60)) * 60
+    return 0
+
+
+class FolderWatcher:
+    """
+    Wake the scheduler up when the download tree changes. inotify reports new day and camera
+    folders, and the removal of the commit marker of a camera; without it the tree is polled.
+
+    Args:
+        root (str): The dl_frames folder.
+        wakeup (threading.Event): Set on every change.
+        poll_interval (float): The polling period when inotify is not available.
+    """
+
+    def __init__(self, root, wakeup, poll_interval=POLL_INTERVAL):
+        self.root = root
+        self.wakeup = wakeup
+        self.poll_interval = poll_interval
+        self.watched = set()
+        self.inotify = INotify() if INotify is not None else None
+        if self.inotify is None:
+            logging.info("inotify not available, polling the download folder")
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def watch(self, folder):
+        """
+        Add a folder to the watched ones.
+
+        Args:
+            folder (str): The day or camera folder to watch.
+        """
+        if self.inotify is None or folder in self.watched:
+            return
+        mask = flags.CREATE | flags.MOVED_TO | flags.DELETE | flags.DELETE_SELF
+        try:
+            self.inotify.add_watch(folder, mask)
+            self.watched.add(folder)
+        except OSError as e:
+            logging.error(f"Cannot watch {folder}: {e}")
+
+    def forget(self, folder):
+        """
+        Drop a removed folder, its watch is released by the kernel.
+
+        Args:
+            folder (str): The removed folder.
+        """
+        self.watched.discard(folder)
+
+    def run(self):
+        if self.inotify is None:
+            while True:
+                time.sleep(self.poll_interval)
+                self.wakeup.set()
+        while True:
+            if self.inotify.read():
+                self.wakeup.set()
+
+
+class FolderScheduler:
+    """
+    Dispatch the ready camera folders to a persistent pool of workers, oldest day first, or to
+    the batched detection. Dispatch is paused during the blackout windows while running tasks
+    complete, and the scheduler sleeps until a folder changes, a task completes or a window ends.
+
+    Args:
+        root (str): The dl_frames folder.
+        process (callable): The task run on each camera folder.
+        pool_size (int): The number of worker processes.
+        blackout_windows (list): The (start, end) minutes of the day during which nothing is dispatched.
+    """
+
+    def __init__(self, root, process, pool_size, blackout_windows):
+        self.root = root
+        self.process = process
+        self.pool_size = pool_size
+        self.blackout_windows = blackout_windows
+        self.wakeup = threading.Event()
+        self.watcher = FolderWatcher(root, self.wakeup)
+        self.in_flight = set()
+        self.failures = set()
+        self.lock = threading.Lock()
+        self.catalog = FrameCatalog(CATALOG_PATH)
+        self.governor = StorageGovernor(self.catalog, os.path.dirname(root))
+
+    def scan(self):
+        """
+        List the camera folders ready for processing and remove past empty day folders. The ready
+        folders are the ones the catalog holds downloaded frames of, the folder tree is only
+        walked to watch the downloads in progress.
+
+        Returns:
+            list: The ready camera folders, oldest day first, or next evicted first when the frame
+                store is under pressure.
+        """
+        self.watcher.watch(self.root)
+        today = datetime.now().strftime("%Y_%m_%d")
+        for day_folder in sorted(glob.glob(f"{self.root}/*")):
+            cam_folders = glob.glob(f"{day_folder}/*")
+            if not cam_folders and os.path.basename(day_folder) < today:
+                self.watcher.forget(day_folder)
+                os.rmdir(day_folder)
+                continue
+            self.watcher.watch(day_folder)
+            for cam_folder in cam_folders:
+                if os.path.exists(os.path.join(cam_folder, INCOMPLETE_MARKER)):
+                    # Woken up when the marker is removed
+                    self.watcher.watch(cam_folder)
+                else:
+                    self.watcher.forget(cam_folder)
+        # The folders of today are still receiving downloads, and one with committed frames
+        # of a past day may be receiving a late one
+        return self.governor.prioritize(
+            [
+                cam_folder
+                for cam_folder in self.catalog.pending_folders("downloaded", self.root)
+                if os.path.isdir(cam_folder)
+                and os.path.basename(os.path.dirname(cam_folder)) < today
+                and not os.path.exists(os.path.join(cam_folder, INCOMPLETE_MARKER))
+            ]
+        )
+
+    def finished(self, cam_folder, result):
+        """
+        Pool callback releasing the worker slot of a completed task.
+
+        Args:
+            cam_folder (str): The processed folder.
+            result: The return value of the task, the metrics it recorded.
+        """
+        if result:
+            metrics.merge(result)
+        with self.lock:
+            self.in_flight.discard(cam_folder)
+            metrics.set_gauge("folders_in_flight", len(self.in_flight), stage="detect")
+        self.wakeup.set()
+
+    def failed(self, cam_folder, error):
+        """
+        Pool callback releasing the worker slot of a failed task. The folder is left aside until
+        the next restart instead of being retried in a loop.
+
+        Args:
+            cam_folder (str): The folder that failed.
+            error (Exception): The error raised by the task.
+        """
+        logging.error(f"Error processing {cam_folder}: {error}")
+        with self.lock:
+            self.failures.add(cam_folder)
+        self.finished(cam_folder, None)
+
+    def dispatch(self, pool, cam_folder):
+        """
+        Start the processing of a folder, as a pool task or in the batched detection.
+
+        Args:
+            pool (Pool or BatchedDetection): The workers.
+            cam_folder (str): The folder to process.
+        """
+        callback = partial(self.finished, cam_folder)
+        error_callback = partial(self.failed, cam_folder)
+        if isinstance(pool, BatchedDetection):
+            pool.submit(cam_folder, "downloaded", callback, error_callback)
+        else:
+            pool.apply_async(
+                self.process,
+                (cam_folder,),
+                callback=callback,
+                error_callback=error_callback,
+            )
+
+    def run(self):
+        recover_interrupted_folders(DONE_FOLDER, self.catalog)
+        if BATCHED_DETECTION:
+            workers = nullcontext(
+                BatchedDetection(
+                    self.pool_size, WEIGHT, CONF_MODEL, DONE_FOLDER, self.catalog
+                )
+            )
+            max_in_flight = self.pool_size * FOLDERS_PER_WORKER
+        else:
+            # The series forked from the parent are its own
+            workers = Pool(self.pool_size, initializer=metrics.reset)
+            max_in_flight = self.pool_size
+        with workers as pool:
+            while True:
+                self.wakeup.clear()
+                timeout = None
+                paused = seconds_until_open(datetime.now(), self.blackout_windows)
+                if paused:
+                    logging.info(f"Dispatch paused for {paused / 60:.0f} mn")
+                    timeout = paused
+                else:
+                    for cam_folder in self.scan():
+                        with self.lock:
+                            if len(self.in_flight) >= max_in_flight:
+                                break
+                            if cam_folder in self.in_flight | self.failures:
+                                continue
+                            self.in_flight.add(cam_folder)
+                            metrics.set_gauge(
+                                "folders_in_flight", len(self.in_flight), stage="detect"
+                            )
+                        self.dispatch(pool, cam_folder)
+                self.wakeup.wait(timeout)
+
+
+def main():
+    # Prepare the partial function with preconfigured arguments
+    partial_process = partial(
+        process_camera_folder,
+        weight=WEIGHT,
+        conf_model=CONF_MODEL,
+        DONE_FOLDER=DONE_FOLDER,
+    )
+    os.makedirs(DL_FRAMES_FOLDER, exist_ok=True)
+    metrics.start(
+        "process_awf", os.path.join(os.path.dirname(DL_FRAMES_FOLDER), "reports")
+    )
+    scheduler = FolderScheduler(
+        DL_FRAMES_FOLDER,
+        partial_process,
+        POOL_SIZE,
+        parse_blackout_windows(BLACKOUT_WINDOWS),
+    )
+    scheduler.run()
 
 
 if __name__ == "__main__":
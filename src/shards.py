@@ -0,0 +1,234 @@
+import glob
+import json
+import os
+import tarfile
+import time
+
+from frames import frame_bytes
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+INDEX_SUFFIX = ".idx"
+
+
+def padded(size):
+    """
+    Round a size up to a whole number of tar blocks.
+
+    Args:
+        size (int): The size in bytes.
+
+    Returns:
+        int: The padded size.
+    """
+    return -(-size // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def scan_shard(path):
+    """
+    Rebuild the index of a shard from its tar headers, stopping at the first damaged member.
+
+    Args:
+        path (str): The path to the shard.
+
+    Returns:
+        list: The members as {"name", "offset", "size"} dicts, offset being the start of the data.
+    """
+    entries = []
+    try:
+        with tarfile.open(path, "r:") as tar:
+            for member in tar:
+                if member.isfile():
+                    entries.append(
+                        {
+                            "name": member.name,
+                            "offset": member.offset_data,
+                            "size": member.size,
+                        }
+                    )
+    except (tarfile.ReadError, EOFError):
+        pass
+    return entries
+
+
+def read_index(path):
+    """
+    Read the offset index of a shard, or rebuild it from the shard when it is missing.
+
+    Args:
+        path (str): The path to the shard.
+
+    Returns:
+        list: The members, see scan_shard.
+    """
+    index_path = path + INDEX_SUFFIX
+    if not os.path.exists(index_path):
+        return scan_shard(path) if os.path.exists(path) else []
+    with open(index_path) as f:
+        # A line cut by a crash is ignored along with its member
+        return [json.loads(line) for line in f if line.endswith("\n")]
+
+
+class ShardWriter:
+    """
+    Append frames and labels to an uncompressed tar shard, in the webdataset layout where the
+    files of a sample share their name up to the extension. Each member is recorded in an offset
+    index next to the shard, written after its data, so that an interrupted writer only loses the
+    members it had not indexed yet: they are overwritten when the shard is reopened.
+
+    Args:
+        path (str): The path to the shard, created if it does not exist.
+        members (int, optional): The number of indexed members to keep, those indexed after them
+            are dropped along with the rest, e.g. when an interrupted append is run again.
+    """
+
+    def __init__(self, path, members=None):
+        self.path = path
+        self.entries = read_index(path)[:members]
+        end = 0
+        if self.entries:
+            last = self.entries[-1]
+            end = last["offset"] + padded(last["size"])
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        # Drop the end of archive blocks and anything written after the last indexed member
+        self.file.seek(end)
+        self.file.truncate()
+        # Rewritten before being appended to, its last line may have been cut by a crash
+        index_path = path + INDEX_SUFFIX
+        with open(f"{index_path}.tmp", "w") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in self.entries)
+        os.replace(f"{index_path}.tmp", index_path)
+        self.index = open(index_path, "a")
+
+    def add(self, name, data):
+        """
+        Append a file to the shard.
+
+        Args:
+            name (str): The name of the file in the shard.
+            data (bytes): The content of the file.
+        """
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.file.write(info.tobuf(tarfile.GNU_FORMAT))
+        offset = self.file.tell()
+        self.file.write(data)
+        self.file.write(b"\0" * (padded(len(data)) - len(data)))
+        self.file.flush()
+        entry = {"name": name, "offset": offset, "size": len(data)}
+        self.entries.append(entry)
+        self.index.write(json.dumps(entry) + "\n")
+        self.index.flush()
+
+    def add_file(self, name, file):
+        """
+        Append a file from the disk to the shard.
+
+        Args:
+            name (str): The name of the file in the shard.
+            file (str): The path to the file.
+        """
+        with frame_bytes(file) as data:
+            self.add(name, data)
+
+    def close(self):
+        """
+        Terminate the shard with the end of archive blocks and sync it to the disk.
+        """
+        self.file.write(b"\0" * 2 * BLOCK_SIZE)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardReader:
+    """
+    Random access to the files of a shard through its offset index.
+
+    Args:
+        path (str): The path to the shard.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {entry["name"]: entry for entry in read_index(path)}
+        self.file = open(path, "rb")
+
+    def names(self):
+        """
+        List the files of the shard.
+
+        Returns:
+            list: The names, in shard order.
+        """
+        return list(self.entries)
+
+    def read(self, name):
+        """
+        Read a file of the shard.
+
+        Args:
+            name (str): The name of the file in the shard.
+
+        Returns:
+            bytes: The content of the file.
+        """
+        entry = self.entries[name]
+        self.file.seek(entry["offset"])
+        return self.file.read(entry["size"])
+
+    def __iter__(self):
+        """
+        Iterate over the samples of the shard, in shard order. The files of a sample are
+        expected next to each other, as ShardWriter users write them.
+
+        Yields:
+            dict: The sample key under "__key__" and the content of each of its files under the
+                file extension, e.g. "jpg" and "txt".
+        """
+        sample = None
+        for name in self.entries:
+            key, _, ext = name.partition(".")
+            if sample is not None and sample["__key__"] != key:
+                yield sample
+                sample = None
+            if sample is None:
+                sample = {"__key__": key}
+            sample[ext] = self.read(name)
+        if sample is not None:
+            yield sample
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_samples(pattern):
+    """
+    Iterate over the samples of all the shards matching a pattern, e.g. for training.
+
+    Args:
+        pattern (str): The glob pattern of the shards, e.g. "done/*.tar".
+
+    Yields:
+        dict: The samples, see ShardReader, with the shard path under "__shard__".
+    """
+    for path in sorted(glob.glob(pattern)):
+        with ShardReader(path) as reader:
+            for sample in reader:
+                sample["__shard__"] = path
+                yield sample
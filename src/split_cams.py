@@ -1,17 +1,27 @@
 import glob
+import hashlib
 import logging
 import os
 import re
 import shutil
+import sqlite3
+import threading
+import time
 from collections import defaultdict
 from datetime import datetime
+from functools import partial
 
+import cv2
+import numpy as np
 import pytz
-from doctr.io import DocumentFile
-from doctr.models import ocr_predictor
 from dotenv import load_dotenv
 from tqdm import tqdm
 
+import metrics
+from catalog import CATALOG_PATH, FrameCatalog
+from frames import decode_frame, frame_bytes
+from moves import move_batch, resume
+
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 
@@ -23,11 +33,223 @@ load_dotenv()
 OUTPUT_BASE_PATH = os.getenv("OUTPUT_PATH", "AWF_scrap")
 DL_FOLDER = os.path.join(OUTPUT_BASE_PATH, "dl_frames")
 TIMEZONE = pytz.timezone("America/Phoenix")
+# Manifests of the moves in progress, replayed at startup after a crash
+SPLIT_MANIFESTS = os.path.join(OUTPUT_BASE_PATH, "split_manifests")
+# Present in a camera folder while dl_images.py is writing frames to it
+INCOMPLETE_MARKER = ".incomplete"
+
+# OCR settings, the model runs on the GPU when there is one unless OCR_DEVICE says otherwise
+OCR_DEVICE = os.getenv("OCR_DEVICE", "auto")
+OCR_BATCH_SIZE = int(os.getenv("OCR_BATCH_SIZE", 16))
+# Region of the frame holding the "X:" overlay, as fractions of the height and width:
+# top,bottom,left,right. "0,1,0,1" runs the OCR on the full frame.
+OCR_CROP = tuple(float(v) for v in os.getenv("OCR_CROP", "0,0.12,0,1").split(","))
+
+# Persistent cache of the x values, keyed by frame content. OCR_CACHE_SIZE=0 disables it.
+OCR_CACHE_PATH = os.getenv(
+    "OCR_CACHE_PATH", os.path.join(OUTPUT_BASE_PATH, "ocr_cache.sqlite")
+)
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", 500000))
+
+# "ocr" reads the x value of every frame of a turning camera, "signature" clusters frames on a
+# thumbnail of the scene below the overlay and only OCRs a few frames per cluster to label it
+SPLIT_MODE = os.getenv("SPLIT_MODE", "ocr")
+SIGNATURE_REGION = (0.15, 1.0, 0.0, 1.0)
+SIGNATURE_SIZE = (32, 18)
+# Maximum correlation distance between a frame and the first frame of its cluster
+SIGNATURE_THRESHOLD = float(os.getenv("SIGNATURE_THRESHOLD", 0.2))
+SIGNATURE_LABEL_FRAMES = 3
+
+# The OCR model, built on first use
+model = None
+ocr_cache = None
+# Guards the lazy creation of the model and the cache, the pipeline splits from several threads
+_lazy_lock = threading.Lock()
+
+
+class OcrCache:
+    """
+    SQLite cache of the x value read on each frame, keyed by the hash of the frame content and
+    the crop settings. The least recently used entries are evicted beyond `max_entries`.
+
+    Args:
+        path (str): The path to the database.
+        max_entries (int): The maximum number of cached values.
+    """
+
+    def __init__(self, path, max_entries):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.suffix = ":" + ",".join(str(v) for v in OCR_CROP)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr (key TEXT PRIMARY KEY, x REAL, used REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ocr_used ON ocr (used)")
+        self.conn.commit()
+
+    def get_many(self, hashes):
+        """
+        Look cached x values up and mark them as recently used.
+
+        Args:
+            hashes (list): The content hashes of the frames.
+
+        Returns:
+            dict: The cached x value of each hash found.
+        """
+        keys = [h + self.suffix for h in hashes]
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, x FROM ocr WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self.conn.executemany(
+                    "UPDATE ocr SET used = ? WHERE key = ?", [(now, k) for k in found]
+                )
+                self.conn.commit()
+        return {key[: -len(self.suffix)]: x for key, x in found.items()}
+
+    def put_many(self, values):
+        """
+        Cache x values and evict the least recently used ones beyond the size limit.
+
+        Args:
+            values (dict): The x value of each content hash.
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO ocr (key, x, used) VALUES (?, ?, ?)",
+                [(h + self.suffix, x, now) for h, x in values.items()],
+            )
+            count = self.conn.execute("SELECT COUNT(*) FROM ocr").fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM ocr WHERE key IN "
+                    "(SELECT key FROM ocr ORDER BY used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self.conn.commit()
+
+
+def get_ocr_cache():
+    """
+    Get the OCR cache, opening it on first use.
+
+    Returns:
+        OcrCache: The cache, or None if it is disabled or cannot be opened.
+    """
+    global ocr_cache
+    with _lazy_lock:
+        if ocr_cache is None and OCR_CACHE_SIZE > 0:
+            try:
+                ocr_cache = OcrCache(OCR_CACHE_PATH, OCR_CACHE_SIZE)
+            except Exception as e:
+                logging.error(f"Error opening OCR cache: {e}")
+        return ocr_cache
+
+
+def file_hash(file):
+    """
+    Hash the content of a file.
+
+    Args:
+        file (str): The path to the file.
 
-# Initialize the OCR model
-model = ocr_predictor(
-    det_arch="db_resnet50", reco_arch="crnn_vgg16_bn", pretrained=True
-).cuda()
+    Returns:
+        str: The hexadecimal digest of the file content.
+    """
+    with frame_bytes(file) as data:
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def get_model(device=None):
+    """
+    Get the OCR model, building it on first use on the requested device.
+
+    Args:
+        device (str, optional): "cpu", "cuda" or "auto", defaults to OCR_DEVICE.
+
+    Returns:
+        doctr.models.predictor.OCRPredictor: The OCR model.
+    """
+    global model
+    with _lazy_lock:
+        if model is None:
+            import torch
+            from doctr.models import ocr_predictor
+
+            device = device or OCR_DEVICE
+            if device == "auto":
+                device = "cuda" if torch.cuda.is_available() else "cpu"
+            model = ocr_predictor(
+                det_arch="db_resnet50", reco_arch="crnn_vgg16_bn", pretrained=True
+            ).to(device)
+            logging.info(f"OCR model loaded on {device}")
+        return model
+
+
+def crop_overlay(page):
+    """
+    Crop a page to the overlay region holding the camera coordinates.
+
+    Args:
+        page (np.ndarray): The page image.
+
+    Returns:
+        np.ndarray: The cropped page.
+    """
+    top, bottom, left, right = OCR_CROP
+    h, w = page.shape[:2]
+    return page[int(h * top) : int(h * bottom), int(w * left) : int(w * right)]
+
+
+def load_overlay(file):
+    """
+    Decode a frame and keep only its overlay region, in RGB as the OCR model expects. The crop is
+    copied out of the frame, so that the full frame is freed before the next one is decoded.
+
+    Args:
+        file (str): The path to the frame.
+
+    Returns:
+        np.ndarray: The RGB overlay.
+
+    Raises:
+        ValueError: If the frame cannot be decoded.
+    """
+    im = decode_frame(file)
+    if im is None:
+        raise ValueError(f"Cannot decode {file}")
+    return cv2.cvtColor(crop_overlay(im), cv2.COLOR_BGR2RGB)
+
+
+def read_x_value(page_result):
+    """
+    Read the x value from the OCR result of a page.
+
+    Args:
+        page_result (doctr.io.elements.Page): The OCR result of the page.
+
+    Returns:
+        float: The x value, or -1000 if it cannot be read.
+    """
+    if len(page_result.blocks) == 0:
+        return -1000
+    text = ""
+    for word in page_result.blocks[-1].lines[0].words:
+        if "Y:" in text or "Z:" in text:
+            break
+        text += word.value.replace("*", "+")
+    return extract_x_value(text)
 
 
 def extract_x_value(text):
@@ -37,30 +259,62 @@ def extract_x_value(text):
     return float(matches[0].lstrip("xX:")) if matches else -1000
 
 
-def extract_x_values_from_images(files, model):
-    """Extract x values from a list of image files using the OCR model."""
+def extract_x_values_from_images(files, model=None, batch_size=None, use_cache=True):
+    """Extract x values from a list of image files using the OCR model.
+
+    Values already in the OCR cache are reused, the OCR only runs on the other files.
+    Files that cannot be processed get -1000, so there is always one value per file.
+    """
+    cache = get_ocr_cache() if use_cache else None
+    if cache is None:
+        return run_ocr(files, model, batch_size)
+
+    try:
+        hashes = [file_hash(file) for file in files]
+        cached = cache.get_many(hashes)
+    except Exception as e:
+        logging.error(f"Error reading OCR cache: {e}")
+        return run_ocr(files, model, batch_size)
+
+    missing = [i for i, h in enumerate(hashes) if h not in cached]
+    metrics.inc("ocr_cache_hits_total", len(files) - len(missing))
+    metrics.inc("ocr_cache_misses_total", len(missing))
+    if missing:
+        values = run_ocr([files[i] for i in missing], model, batch_size, failed=None)
+        new_values = {hashes[i]: x for i, x in zip(missing, values) if x is not None}
+        try:
+            cache.put_many(new_values)
+        except Exception as e:
+            logging.error(f"Error writing OCR cache: {e}")
+        cached.update(new_values)
+    return [cached.get(h, -1000) for h in hashes]
+
+
+def run_ocr(files, model=None, batch_size=None, failed=-1000):
+    """Run the OCR on a list of image files.
+
+    The pages are cropped to the overlay region and sent to the model in batches.
+    Files that cannot be processed get the `failed` value.
+    """
+    model = model or get_model()
+    batch_size = batch_size or OCR_BATCH_SIZE
     x_values = []
     try:
-        # Load the images as a document
-        doc = DocumentFile.from_images(files)
-
-        # Process each page of the document
-        for page in doc:
-            result = model([page])
-            if len(result.pages[0].blocks) == 0:
-                x_values.append(-1000)
-            else:
-                text = ""
-                for word in result.pages[0].blocks[-1].lines[0].words:
-                    if "Y:" in text or "Z:" in text:
-                        break
-                    text += word.value.replace("*", "+")
-                x_values.append(extract_x_value(text))
+        pages = [load_overlay(file) for file in files]
+
+        # Process the pages by batches
+        for i in range(0, len(pages), batch_size):
+            batch = pages[i : i + batch_size]
+            with metrics.timer("ocr_batch_seconds"):
+                result = model(batch)
+            metrics.inc("ocr_calls_total")
+            metrics.inc("ocr_frames_total", len(batch))
+            x_values.extend(read_x_value(page) for page in result.pages)
 
     except Exception as e:
         logging.error(f"Error processing OCR batch: {e}")
-        x_values.append(-1000)
 
+    x_values.extend([failed] * (len(files) - len(x_values)))
     return x_values
 
 
@@ -80,70 +334,222 @@ def group_by_close_values(data, threshold):
     return groups
 
 
-# Main Script
-if __name__ == "__main__":
-    dl_folder = os.path.join(OUTPUT_BASE_PATH, "dl_frames")
-    folders = glob.glob(f"{dl_folder}/**/*")
-    static_cams, turning_cams = [], []
+def group_frames_by_ocr(img_files):
+    """Group the frames of a turning camera on the x value read by the OCR on each of them."""
+    x_values = {}
 
-    timezone = pytz.timezone("America/Phoenix")
-    now = datetime.now(TIMEZONE)
+    for i in range(0, len(img_files), BATCH_SIZE):
+        batch = img_files[i : i + BATCH_SIZE]
+        batch_x_values = extract_x_values_from_images(batch)
 
-    for folder in tqdm(folders, desc="Processing folders"):
-        date_str = folder.split("/")[-2]
-        date_obj = datetime.strptime(date_str, "%Y_%m_%d")
-        if date_obj.date() < now.date():
-            img_files = glob.glob(f"{folder}/*.jpg")[:5]  # only on first 5 images
-            img_files.sort()
-            x_values = extract_x_values_from_images(img_files, model)
-            if len(x_values) > 0:
-                if (
-                    len(x_values) < 2
-                    or (max(x_values) - min(x_values)) % 360 < STATIC_CAM_THRESHOLD
-                ):
-                    static_cams.append(folder)
-                else:
-                    turning_cams.append(folder)
-
-    # Process static cameras
-    for folder in tqdm(static_cams, desc="Processing static cams"):
-        new_folder = os.path.join(
-            folder.replace("dl_frames", "dl_frames_splited"), "cam_00"
-        )
-        shutil.move(folder, new_folder)
+        for file, x_value in zip(batch, batch_x_values):
+            x_values[file] = x_value
 
-    # Process turning cameras
+    return group_by_close_values(x_values, OCR_THRESHOLD) if x_values else {}
 
-    for folder in tqdm(turning_cams, desc="Processing turning cams"):
-        img_files = glob.glob(f"{folder}/*.jpg")
-        x_values = {}
 
-        for i in range(0, len(img_files), BATCH_SIZE):
-            batch = img_files[i : i + BATCH_SIZE]
-            batch_x_values = extract_x_values_from_images(batch, model)
+def frame_signature(file):
+    """Compute the signature of a frame: a small grayscale thumbnail of the scene below the overlay.
 
-            for file, x_value in zip(batch, batch_x_values):
-                x_values[file] = x_value
+    Returns None if the frame cannot be read.
+    """
+    im = decode_frame(file, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if im is None:
+        return None
+    top, bottom, left, right = SIGNATURE_REGION
+    h, w = im.shape
+    im = im[int(h * top) : int(h * bottom), int(w * left) : int(w * right)]
+    return cv2.resize(im, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA).ravel()
 
-        if x_values:
-            grouped = group_by_close_values(x_values, OCR_THRESHOLD)
-            for idx, (_, files) in enumerate(grouped.items()):
-                new_folder = os.path.join(
-                    os.path.dirname(files[0][0]).replace(
-                        "dl_frames", "dl_frames_splited"
-                    ),
-                    f"cam_{str(idx).zfill(2)}",
-                )
-                _, x = files[0]
-                if (
-                    len(files) >= 4 and x != "-1000"
-                ):  # do not take errors and isolated images
-                    os.makedirs(new_folder, exist_ok=True)
-                    for file, _ in files:
-                        shutil.move(
-                            file, os.path.join(new_folder, os.path.basename(file))
-                        )
-            shutil.rmtree(folder)
+
+def normalize_signatures(signatures):
+    """Center and scale each signature so that dot products are correlations, which makes the
+    distances insensitive to the overall brightness of the scene."""
+    signatures = signatures.astype(np.float32)
+    signatures -= signatures.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(signatures, axis=1, keepdims=True)
+    return signatures / np.maximum(norms, 1e-6)
+
+
+def cluster_signatures(signatures, threshold):
+    """Cluster normalized signatures around leaders.
+
+    The first unassigned frame becomes the leader of a new cluster holding all the unassigned
+    frames within `threshold` of it, then every frame is assigned to its closest leader.
+    Returns the cluster of each frame, the distance to its leader and the leader indices.
+    """
+    labels = np.full(len(signatures), -1)
+    leaders = []
+    while (labels == -1).any():
+        leader = np.flatnonzero(labels == -1)[0]
+        dist = 1 - signatures @ signatures[leader]
+        labels[(labels == -1) & (dist <= threshold)] = len(leaders)
+        leaders.append(leader)
+    dist = 1 - signatures @ signatures[leaders].T
+    labels = dist.argmin(axis=1)
+    return labels, dist[np.arange(len(labels)), labels], np.array(leaders)
+
+
+def group_frames_by_signature(img_files):
+    """Group the frames of a camera on their signature, and label each cluster with the x value
+    read by the OCR on the frames closest to its leader.
+
+    Clusters with close x values, such as a preset seen under different lighting, end up in the
+    same group. The groups have the same layout as the ones of group_by_close_values.
+    """
+    signatures = [frame_signature(file) for file in img_files]
+    readable = [i for i, signature in enumerate(signatures) if signature is not None]
+    x_values = {file: -1000 for file in img_files}
+    if not readable:
+        return group_by_close_values(x_values, OCR_THRESHOLD) if x_values else {}
+
+    normalized = normalize_signatures(np.stack([signatures[i] for i in readable]))
+    labels, dist, leaders = cluster_signatures(normalized, SIGNATURE_THRESHOLD)
+
+    # OCR a few representative frames of each cluster in a single batched call
+    representatives = []
+    for cluster in range(len(leaders)):
+        members = np.flatnonzero(labels == cluster)
+        closest = members[np.argsort(dist[members])[:SIGNATURE_LABEL_FRAMES]]
+        representatives.append([img_files[readable[i]] for i in closest])
+    rep_x_values = iter(
+        extract_x_values_from_images([f for files in representatives for f in files])
+    )
+    cluster_x_values = []
+    for files in representatives:
+        values = [x for x in (next(rep_x_values) for _ in files) if x != -1000]
+        cluster_x_values.append(float(np.median(values)) if values else -1000)
+
+    for i, cluster in zip(readable, labels):
+        x_values[img_files[i]] = cluster_x_values[cluster]
+    return group_by_close_values(x_values, OCR_THRESHOLD)
+
+
+def manifest_path(folder):
+    """Get the path to the move manifest of a camera folder."""
+    date_str, source = folder.split("/")[-2:]
+    return os.path.join(SPLIT_MANIFESTS, f"{date_str}_{source}.jsonl")
+
+
+def catalog_moves(catalog, operations):
+    """Record the moves of a completed split in the catalog.
+
+    The moved frames are split into the preset of their destination folder, the frames left
+    behind in a removed folder are removed. The file moves are recorded in a single transaction,
+    before the folder operations that follow them. Replaying the operations of a resumed split
+    is safe.
+    """
+    updates = {}
+    for kind, src, dst in operations:
+        if kind == "file":
+            updates[src] = dict(
+                new_path=dst,
+                preset=os.path.basename(os.path.dirname(dst)),
+                stage="split",
+            )
+            continue
+        if updates:
+            catalog.update_frames(updates)
+            updates = {}
+        if kind == "dir":
+            catalog.move_folder(src, dst, preset=os.path.basename(dst), stage="split")
+        else:
+            catalog.set_folder_stage(src, "removed", from_stage="downloaded")
+    if updates:
+        catalog.update_frames(updates)
+
+
+def is_past_day(folder):
+    """Tell whether a camera folder holds the frames of a day that is over, which can be split."""
+    date_obj = datetime.strptime(folder.split("/")[-2], "%Y_%m_%d")
+    return date_obj.date() < datetime.now(TIMEZONE).date()
+
+
+def plan_split(catalog, folder):
+    """Plan the moves splitting a downloaded camera folder into one folder per preset.
+
+    Static cameras are moved as a whole into cam_00. The frames of turning cameras are grouped on
+    their x value, groups too small or without x value are dropped along with the folder.
+    Returns the operations for move_batch, empty if the folder cannot be split yet.
+    """
+    img_files = catalog.folder_frames(folder, "downloaded")
+    new_folder = folder.replace("dl_frames", "dl_frames_splited")
+    static = [["dir", folder, os.path.join(new_folder, "cam_00")]]
+    if not img_files:
+        return []
+
+    if SPLIT_MODE == "signature":
+        grouped = group_frames_by_signature(img_files)
+        if len(grouped) <= 1:
+            return static
+    else:
+        # only on first 5 images
+        x_values = extract_x_values_from_images(img_files[:5])
+        if (
+            len(x_values) < 2
+            or (max(x_values) - min(x_values)) % 360 < STATIC_CAM_THRESHOLD
+        ):
+            return static
+        grouped = group_frames_by_ocr(img_files)
+
+    if not grouped:
+        return []
+    catalog.update_frames(
+        {
+            file: dict(ocr_x=None if x == -1000 else x)
+            for files in grouped.values()
+            for file, x in files
+        }
+    )
+    operations = []
+    for idx, (_, files) in enumerate(grouped.items()):
+        preset_folder = os.path.join(new_folder, f"cam_{str(idx).zfill(2)}")
+        _, x = files[0]
+        if len(files) >= 4 and x != "-1000":  # do not take errors and isolated images
+            for file, _ in files:
+                new_file = os.path.join(preset_folder, os.path.basename(file))
+                operations.append(["file", file, new_file])
+    # The frames left in the folder are errors and isolated images
+    operations.append(["rmtree", folder, None])
+    return operations
+
+
+def split_folder(catalog, folder):
+    """Split a downloaded camera folder into one folder per preset.
+
+    Returns the preset folders holding the split frames.
+    """
+    camera = os.path.basename(folder)
+    with metrics.timer("stage_seconds", stage="split", camera=camera):
+        operations = plan_split(catalog, folder)
+        if operations:
+            move_batch(
+                manifest_path(folder), operations, partial(catalog_moves, catalog)
+            )
+    metrics.inc("folders_split_total", camera=camera)
+    return sorted(
+        {dst if kind == "dir" else os.path.dirname(dst) for kind, _, dst in operations}
+        - {None}
+    )
+
+
+# Main Script
+if __name__ == "__main__":
+    metrics.start("split_cams", os.path.join(OUTPUT_BASE_PATH, "reports"))
+    catalog = FrameCatalog(CATALOG_PATH)
+
+    # Complete the splits interrupted by a crash
+    resume(SPLIT_MANIFESTS, partial(catalog_moves, catalog))
+
+    # The catalog only lists the camera folders whose download is committed
+    dl_folder = os.path.join(OUTPUT_BASE_PATH, "dl_frames")
+    folders = catalog.pending_folders("downloaded", dl_folder)
+
+    for folder in tqdm(folders, desc="Processing folders"):
+        if is_past_day(folder) and not os.path.exists(
+            os.path.join(folder, INCOMPLETE_MARKER)
+        ):
+            split_folder(catalog, folder)
 
     day_folders = glob.glob(f"{dl_folder}/*")
     for day_folder in day_folders:
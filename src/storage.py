@@ -0,0 +1,226 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import defaultdict
+
+from dotenv import load_dotenv
+
+import metrics
+from catalog import INCOMPLETE_MARKER, PENDING_STAGES, PROCESSING_MARKER
+
+load_dotenv()
+OUTPUT_BASE_PATH = os.getenv("OUTPUT_PATH", "AWF_scrap")
+# Fraction of the disk in use above which the downloads stop and camera days are evicted, and the
+# fraction down to which they are evicted
+STORAGE_HIGH_WATER = float(os.getenv("STORAGE_HIGH_WATER", 0.9))
+STORAGE_LOW_WATER = float(os.getenv("STORAGE_LOW_WATER", 0.8))
+# Optional cap in bytes of the frames waiting for their detection, 0 only watches the disk
+STORAGE_MAX_BYTES = int(os.getenv("STORAGE_MAX_BYTES", 0))
+# "oldest" evicts the oldest camera days first, "largest" the largest ones, "off" evicts nothing
+# and only stops the downloads
+EVICTION_POLICY = os.getenv("EVICTION_POLICY", "oldest")
+# Seconds during which a measure of the usage is reused
+REFRESH_INTERVAL = 30
+
+
+class StorageGovernor:
+    """
+    Keep the frame store below its high-water mark. The size of the frames waiting for their
+    detection comes from the catalog, which every stage updates as it writes, moves or removes
+    frames, and the disk usage from a single statvfs call, so the frame tree is never walked.
+
+    Above the high-water mark, downloads are refused and the pending camera days are evicted in
+    the order of the policy until the usage is back under the low-water mark. While the store is
+    under pressure, the detection is told to process first the folders next in line for eviction.
+
+    Args:
+        catalog (FrameCatalog): The frame catalog.
+        root (str): The folder holding the frame tree.
+        exclude (set, optional): Folders never evicted, such as those being processed. The set is
+            read at each eviction, so its owner can keep updating it.
+    """
+
+    def __init__(self, catalog, root=OUTPUT_BASE_PATH, exclude=None):
+        self.catalog = catalog
+        self.root = root
+        self.exclude = set() if exclude is None else exclude
+        self.lock = threading.Lock()
+        self.measured = None
+        self.measured_at = 0
+        self.high = False
+        os.makedirs(root, exist_ok=True)
+
+    def camera_days(self):
+        """
+        List the camera days with frames waiting for their detection.
+
+        Returns:
+            list: The camera days as dicts with their "camera", "day", "folders", "bytes" and
+                "frames".
+        """
+        groups = defaultdict(lambda: {"folders": [], "bytes": 0, "frames": 0})
+        for folder, camera, day, size, count in self.catalog.folder_sizes(
+            PENDING_STAGES, self.root
+        ):
+            group = groups[camera, day]
+            group["folders"].append(folder)
+            group["bytes"] += size
+            group["frames"] += count
+        return [
+            dict(group, camera=camera, day=day)
+            for (camera, day), group in groups.items()
+        ]
+
+    def usage(self, refresh=False):
+        """
+        Measure the usage of the frame store, reusing a recent measure unless asked not to.
+
+        Returns:
+            dict: The "disk_used" and "disk_total" bytes of the disk, the "pending_bytes" of the
+                frames waiting for their detection, and the "ratio" compared with the watermarks.
+        """
+        fresh = time.monotonic() - self.measured_at < REFRESH_INTERVAL
+        # The monotonic clock may start at boot, when nothing has been measured yet
+        if not refresh and self.measured is not None and fresh:
+            return self.measured
+        disk = shutil.disk_usage(self.root)
+        pending = sum(
+            row[3] for row in self.catalog.folder_sizes(PENDING_STAGES, self.root)
+        )
+        ratio = disk.used / disk.total
+        if STORAGE_MAX_BYTES:
+            ratio = max(ratio, pending / STORAGE_MAX_BYTES)
+        self.measured = {
+            "disk_used": disk.used,
+            "disk_total": disk.total,
+            "pending_bytes": pending,
+            "ratio": ratio,
+        }
+        self.measured_at = time.monotonic()
+        metrics.set_gauge("storage_used_ratio", ratio)
+        metrics.set_gauge("pending_frames_bytes", pending)
+        return self.measured
+
+    def pressure(self, refresh=False):
+        """
+        Tell whether the store is under pressure: from the moment the usage reaches the
+        high-water mark until it is back under the low-water mark.
+
+        Returns:
+            bool: True if the store is under pressure.
+        """
+        ratio = self.usage(refresh)["ratio"]
+        if ratio >= STORAGE_HIGH_WATER:
+            self.high = True
+        elif ratio <= STORAGE_LOW_WATER:
+            self.high = False
+        metrics.set_gauge("storage_pressure", int(self.high))
+        return self.high
+
+    def eviction_order(self, camera_days=None):
+        """
+        Sort the pending camera days in the order the policy evicts them.
+
+        Args:
+            camera_days (list, optional): The camera days, listed from the catalog if not given.
+
+        Returns:
+            list: The camera days, first evicted first.
+        """
+        camera_days = self.camera_days() if camera_days is None else camera_days
+        if EVICTION_POLICY == "largest":
+            return sorted(camera_days, key=lambda group: -group["bytes"])
+        return sorted(camera_days, key=lambda group: (group["day"], group["camera"]))
+
+    def evict(self):
+        """
+        Remove the pending camera days in the order of the policy until the usage is back under
+        the low-water mark. Camera days with a folder being written or processed are skipped,
+        processed folders being those in the exclude set or marked by the detection of another
+        process.
+
+        Returns:
+            int: The number of bytes evicted.
+        """
+        if EVICTION_POLICY == "off":
+            return 0
+        evicted = 0
+        exclude = set(self.exclude)
+        for group in self.eviction_order():
+            if self.usage(refresh=True)["ratio"] <= STORAGE_LOW_WATER:
+                break
+            if any(
+                folder in exclude
+                or os.path.exists(os.path.join(folder, INCOMPLETE_MARKER))
+                or os.path.exists(os.path.join(folder, PROCESSING_MARKER))
+                for folder in group["folders"]
+            ):
+                continue
+            for folder in group["folders"]:
+                shutil.rmtree(folder, ignore_errors=True)
+                for stage in PENDING_STAGES:
+                    self.catalog.set_folder_stage(folder, "evicted", stage)
+                try:
+                    os.rmdir(os.path.dirname(folder))
+                except OSError:
+                    pass
+            evicted += group["bytes"]
+            logging.info(
+                f"Evicted {group['frames']} frames of {group['camera']} on "
+                f"{group['day']} ({group['bytes'] / 2**20:.0f} MiB)"
+            )
+            metrics.inc("frames_evicted_total", group["frames"], camera=group["camera"])
+            metrics.inc("bytes_evicted_total", group["bytes"])
+        return evicted
+
+    def admit(self):
+        """
+        Decide whether a download may start, evicting camera days first if the store is under
+        pressure.
+
+        Returns:
+            bool: False if the store is still under pressure and the download must be skipped.
+        """
+        if not self.pressure():
+            return True
+        with self.lock:
+            if self.pressure(refresh=True):
+                self.evict()
+            return not self.pressure(refresh=True)
+
+    def prioritize(self, folders):
+        """
+        Order the folders waiting for their detection. Under pressure, the folders next in line
+        for eviction go first so that they are processed rather than lost, otherwise the order
+        is kept.
+
+        Args:
+            folders (list): The folders, in their default order.
+
+        Returns:
+            list: The folders in processing order.
+        """
+        if not self.pressure():
+            return folders
+        rank = {}
+        for i, group in enumerate(self.eviction_order()):
+            for folder in group["folders"]:
+                rank[folder] = i
+        return sorted(folders, key=lambda folder: rank.get(folder, len(rank)))
+
+    def state(self):
+        """
+        Describe the state of the store, e.g. for the detection to size its backlog.
+
+        Returns:
+            dict: The usage, see usage, the "pressure" flag, the "policy" and the pending
+                "camera_days" in eviction order.
+        """
+        return dict(
+            self.usage(),
+            pressure=self.pressure(),
+            policy=EVICTION_POLICY,
+            camera_days=self.eviction_order(),
+        )
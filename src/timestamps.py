@@ -0,0 +1,264 @@
+import re
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import numpy as np
+
+FRAME_TIME_FORMAT = "%Y_%m_%dT%H_%M_%S"
+FRAME_TIME_PATTERN = re.compile(r"(\d{4})_(\d{2})_(\d{2})T(\d{2})_(\d{2})_(\d{2})")
+# Dates written in comments and headers, year first or US style
+TEXT_TIME_PATTERNS = (
+    (
+        re.compile(r"(\d{4})[-/:_.](\d{2})[-/:_.](\d{2})[ T_]+(\d{2}):(\d{2}):(\d{2})"),
+        (0, 1, 2),
+    ),
+    (
+        re.compile(r"(\d{2})/(\d{2})/(\d{4})[ ,]+(\d{2}):(\d{2}):(\d{2})"),
+        (2, 0, 1),
+    ),
+)
+# Part headers of the timelapse stream that may hold the capture time of the frame. Date and
+# Last-Modified tell when the server built the response, not when the frame was captured
+TIME_HEADERS = ("x-timestamp", "x-capture-time", "timestamp")
+EXIF_DATETIME = 0x0132
+EXIF_IFD_POINTER = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+
+
+def parse_frame_times(files):
+    """
+    Parse the timestamp embedded in each frame name, once, into epoch seconds.
+
+    Args:
+        files (list): The frame paths or names.
+
+    Returns:
+        np.ndarray: The int64 timestamps, in the order of the files.
+
+    Raises:
+        AttributeError: If a name holds no timestamp.
+    """
+    stamps = [
+        "{}-{}-{}T{}:{}:{}".format(*FRAME_TIME_PATTERN.search(file).groups())
+        for file in files
+    ]
+    return np.array(stamps, dtype="datetime64[s]").astype(np.int64)
+
+
+def group_detections(times, gap, min_size=2):
+    """
+    Split sorted timestamps into runs whose consecutive items are less than `gap` apart, and flag
+    the items of the runs holding at least `min_size` of them.
+
+    Args:
+        times (np.ndarray): The sorted timestamps.
+        gap (int): The gap in seconds closing a run.
+        min_size (int): The minimum size of a kept run.
+
+    Returns:
+        np.ndarray: The boolean mask of the kept items.
+    """
+    if not len(times):
+        return np.zeros(0, bool)
+    run_ids = np.concatenate([[0], np.cumsum(np.diff(times) >= gap)])
+    return np.bincount(run_ids)[run_ids] >= min_size
+
+
+def merge_windows(times, radius):
+    """
+    Merge the closed windows [t - radius, t + radius] around sorted timestamps into disjoint
+    intervals.
+
+    Args:
+        times (np.ndarray): The sorted timestamps.
+        radius (int): The half width of the windows in seconds.
+
+    Returns:
+        tuple: The sorted start and end arrays of the merged intervals.
+    """
+    if not len(times):
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    starts, ends = times - radius, times + radius
+    # A window opens a new interval when it starts after the end of all the previous ones
+    new = np.concatenate([[True], starts[1:] > np.maximum.accumulate(ends)[:-1]])
+    idx = np.flatnonzero(new)
+    return starts[idx], np.maximum.reduceat(ends, idx)
+
+
+def in_windows(times, starts, ends):
+    """
+    Tell which timestamps fall in merged intervals.
+
+    Args:
+        times (np.ndarray): The timestamps, in any order.
+        starts (np.ndarray): The sorted starts of the intervals.
+        ends (np.ndarray): The ends of the intervals.
+
+    Returns:
+        np.ndarray: The boolean mask of the timestamps within an interval.
+    """
+    if not len(starts):
+        return np.zeros(len(times), bool)
+    idx = np.searchsorted(starts, times, side="right") - 1
+    return (idx >= 0) & (times <= ends[np.maximum(idx, 0)])
+
+
+def text_time(text):
+    """
+    Find a date and time in a text, such as a JPEG comment or a header value.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        datetime: The naive date and time, or None if the text holds none.
+    """
+    for pattern, (year, month, day) in TEXT_TIME_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            fields = [int(field) for field in match.groups()]
+            try:
+                return datetime(fields[year], fields[month], fields[day], *fields[3:])
+            except ValueError:
+                continue
+    return None
+
+
+def part_header_time(headers):
+    """
+    Read the capture time of a frame from the headers of its multipart part.
+
+    Args:
+        headers (bytes): The header lines of the part.
+
+    Returns:
+        datetime: The aware time of an epoch or HTTP date header, the naive time of a header
+            holding a local date, or None if no header holds a time.
+    """
+    for line in headers.decode("latin-1").splitlines():
+        name, _, value = line.partition(":")
+        value = value.strip()
+        if name.strip().lower() not in TIME_HEADERS or not value:
+            continue
+        try:
+            seconds = float(value)
+            # Milliseconds since the epoch
+            if seconds > 1e11:
+                seconds /= 1000
+            return datetime.fromtimestamp(seconds, timezone.utc)
+        except ValueError:
+            pass
+        try:
+            return parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            pass
+        found = text_time(value)
+        if found is not None:
+            return found
+    return None
+
+
+def exif_time(tiff):
+    """
+    Read the capture time from the TIFF structure of an EXIF segment, DateTimeOriginal first.
+
+    Args:
+        tiff (bytes): The segment data after its "Exif" header.
+
+    Returns:
+        datetime: The naive local time, or None if the segment holds no valid date.
+    """
+    order = {b"II": "little", b"MM": "big"}.get(tiff[:2])
+    if order is None:
+        return None
+
+    def number(offset, size):
+        return int.from_bytes(tiff[offset : offset + size], order)
+
+    def entries(offset):
+        tags = {}
+        for i in range(number(offset, 2) if offset + 2 <= len(tiff) else 0):
+            entry = offset + 2 + 12 * i
+            if entry + 12 > len(tiff):
+                break
+            tag, kind = number(entry, 2), number(entry + 2, 2)
+            count = number(entry + 4, 4)
+            if kind == 2:
+                start = entry + 8 if count <= 4 else number(entry + 8, 4)
+                tags[tag] = tiff[start : start + count].split(b"\0")[0]
+            elif tag == EXIF_IFD_POINTER:
+                tags[tag] = number(entry + 8, 4)
+        return tags
+
+    tags = entries(number(4, 4))
+    if EXIF_IFD_POINTER in tags:
+        exif = entries(tags[EXIF_IFD_POINTER])
+        tags[EXIF_DATETIME_ORIGINAL] = exif.get(EXIF_DATETIME_ORIGINAL)
+    for tag in (EXIF_DATETIME_ORIGINAL, EXIF_DATETIME):
+        value = tags.get(tag)
+        if value:
+            try:
+                return datetime.strptime(value.decode("ascii"), "%Y:%m:%d %H:%M:%S")
+            except ValueError:
+                continue
+    return None
+
+
+def jpeg_capture_time(frame):
+    """
+    Read the capture time a camera embedded in a JPEG frame, in its EXIF data or its comment
+    segments. Only the segments before the image data are read.
+
+    Args:
+        frame (bytes): The JPEG frame.
+
+    Returns:
+        datetime: The naive local time, or None if the frame holds no date.
+    """
+    pos = 2
+    while pos + 4 <= len(frame) and frame[pos] == 0xFF:
+        marker = frame[pos + 1]
+        # Start of scan, or end of image
+        if marker in (0xDA, 0xD9):
+            break
+        if marker == 0xFF:
+            pos += 1
+            continue
+        length = int.from_bytes(frame[pos + 2 : pos + 4], "big")
+        data = frame[pos + 4 : pos + 2 + length]
+        found = None
+        if marker == 0xE1 and data.startswith(b"Exif\0\0"):
+            found = exif_time(data[6:])
+        elif marker == 0xFE:
+            found = text_time(data.decode("latin-1"))
+        if found is not None:
+            return found
+        pos += 2 + length
+    return None
+
+
+def interpolate_times(indices, times, nb_frames, step):
+    """
+    Fill in the times of the frames of a stream from those known for some of them. The frames
+    between two known ones are spread evenly, the ones before the first and after the last known
+    frame are spaced by the median interval between the known frames, or by `step`.
+
+    Args:
+        indices (list): The increasing stream indices of the frames whose time is known.
+        times (list): Their increasing times in seconds.
+        nb_frames (int): The number of frames in the stream.
+        step (float): The interval between two frames when fewer than two times are known.
+
+    Returns:
+        np.ndarray: The time of each frame in seconds.
+    """
+    x = np.asarray(indices, float)
+    y = np.asarray(times, float)
+    if len(x) > 1:
+        step = float(np.median(np.diff(y) / np.diff(x)))
+    idx = np.arange(nb_frames, dtype=float)
+    filled = np.interp(idx, x, y)
+    before, after = idx < x[0], idx > x[-1]
+    filled[before] = y[0] - (x[0] - idx[before]) * step
+    filled[after] = y[-1] + (idx[after] - x[-1]) * step
+    return filled
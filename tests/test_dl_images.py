@@ -0,0 +1,111 @@
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+import pytest
+
+import dl_images
+
+
+def color_frames(count):
+    rng = np.random.default_rng(0)
+    return [
+        cv2.imencode(".jpg", rng.integers(0, 255, (64, 96, 3), np.uint8))[1].tobytes()
+        for _ in range(count)
+    ]
+
+
+def multipart(frames, preamble=b""):
+    """
+    Build a timelapse body of JPEG frames as the camera server streams it, each part opened by
+    a boundary and none closing the last one.
+    """
+    body = preamble
+    for i, frame in enumerate(frames):
+        body += dl_images.FRAME_BOUNDARY + b"Content-Type: image/jpeg\r\n"
+        body += f"X-Timestamp: {1719835200 + i}\r\n\r\n".encode() + frame + b"\r\n"
+    return body
+
+
+def parse(body, piece_size, **kwargs):
+    """Feed a body to a FrameParser in pieces of the given size."""
+    parser = dl_images.FrameParser(**kwargs)
+    frames = []
+    for start in range(0, len(body), piece_size):
+        frames += parser.feed(body[start : start + piece_size])
+    return frames + parser.close()
+
+
+@pytest.mark.parametrize("piece_size", [1, 3, 7, 1000, 10**6])
+def test_parser_finds_boundaries_split_across_pieces(piece_size):
+    frames = color_frames(3)
+    captured = []
+    assert parse(multipart(frames), piece_size, captured=captured) == frames
+    assert [time.timestamp() for time in captured] == [1719835200 + i for i in range(3)]
+
+
+def test_parser_skips_preamble():
+    frames = color_frames(2)
+    preamble = b"This is a multipart message, the frames follow.\r\n" * 5
+    assert parse(multipart(frames, preamble), 64) == frames
+
+
+def test_parser_flushes_last_frame_without_closing_boundary():
+    frames = color_frames(2)
+    body = multipart(frames)
+    parser = dl_images.FrameParser()
+    assert parser.feed(body) == frames[:1]
+    assert parser.close() == frames[1:]
+
+
+def test_parser_rejects_frames_beyond_max_size():
+    frames = color_frames(2)
+    parser = dl_images.FrameParser(max_frame_size=len(frames[0]) // 2)
+    with pytest.raises(ValueError):
+        parser.feed(multipart(frames)[: len(frames[0])])
+
+
+class BrokenCatalog:
+    def add_frames(self, frames):
+        raise sqlite3.OperationalError("database is locked")
+
+
+def test_catalog_failure_leaves_camera_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(dl_images, "FRAMES_PATH", str(tmp_path / "dl_frames"))
+    monkeypatch.setattr(dl_images, "STATE_PATH", str(tmp_path / "states"))
+    monkeypatch.setattr(dl_images, "get_catalog", BrokenCatalog)
+    cam_state = {}
+
+    with pytest.raises(sqlite3.OperationalError):
+        dl_images.process_camera_images(color_frames(3), "AZ", "cam", "1h", cam_state)
+
+    # The same frames are downloaded again by the next run
+    assert "hashes" not in cam_state
+    assert not (tmp_path / "states").exists()
+
+
+def test_frames_of_the_same_second_are_all_kept(tmp_path):
+    source_path = str(tmp_path)
+    local_time = datetime(2024, 7, 1, 13)
+    frames = color_frames(3)
+    for i, frame in enumerate(frames):
+        dl_images.write_frame(source_path, i, frame)
+    # Frames 0 and 1 were captured within the same second, frame 2 by the previous run
+    captured = [local_time - timedelta(seconds=s) for s in (10, 9.6, 5)]
+    (tmp_path / "2024_07_01T12_59_55.jpg").write_bytes(b"previous run")
+
+    paths = dl_images.commit_frames(
+        source_path, local_time, "1h", 3, [0, 1, 2], captured
+    )
+
+    assert [os.path.basename(path) for path in paths] == [
+        "2024_07_01T12_59_50.jpg",
+        "2024_07_01T12_59_50_1.jpg",
+        "2024_07_01T12_59_55_1.jpg",
+    ]
+    for path, frame in zip(paths, frames):
+        with open(path, "rb") as f:
+            assert f.read() == frame
+    assert (tmp_path / "2024_07_01T12_59_55.jpg").read_bytes() == b"previous run"
@@ -0,0 +1,50 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import dl_images
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "gray")
+# Synthetic 320x180 frames and whether they are gray
+FRAMES = {
+    "gray.jpg": True,
+    "color.jpg": False,
+    # Colored overlay at the top, and right above the bottom half, of a gray scene
+    "gray_overlay.jpg": True,
+    "gray_overlay_middle.jpg": True,
+    # Gray scenes with a slight tint or a small colored speck, which the reduced decode shows
+    # within GRAY_FAST_MARGIN
+    "borderline_tint.jpg": False,
+    "borderline_speck.jpg": False,
+}
+
+
+def read_frame(name):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+def full_decode_is_gray(frame):
+    """
+    The gray criterion on the full decode only: identical blue and green channels on the bottom
+    half of the image.
+    """
+    im = cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_COLOR)
+    im_half = im[im.shape[0] // 2 :, :, :]
+    return np.max(im_half[:, :, 0] - im_half[:, :, 1]) == 0
+
+
+@pytest.mark.parametrize("name", FRAMES)
+def test_fast_path_agrees_with_full_decode(name):
+    frame = read_frame(name)
+    assert dl_images.is_gray_frame(frame) == full_decode_is_gray(frame) == FRAMES[name]
+
+
+@pytest.mark.parametrize("name", [name for name in FRAMES if "borderline" in name])
+def test_borderline_frames_are_fully_decoded(name):
+    reduced = dl_images.decode_reduced(read_frame(name))
+    reduced_half = reduced[reduced.shape[0] // 2 + 3 :, :, :]
+    diff = cv2.absdiff(reduced_half[:, :, 0], reduced_half[:, :, 1])
+    assert 0 < np.max(diff) <= dl_images.GRAY_FAST_MARGIN
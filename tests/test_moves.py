@@ -0,0 +1,151 @@
+import errno
+import os
+
+import pytest
+
+import moves
+
+
+class Crash(BaseException):
+    """Stands for a power loss, nothing catches it."""
+
+
+def snapshot(root):
+    """The content of each file under a folder, by relative path, manifests excluded."""
+    files = {}
+    for folder, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(folder, name)
+            if "manifests" not in path:
+                with open(path, "rb") as f:
+                    files[os.path.relpath(path, root)] = f.read()
+    return files
+
+
+def make_tree(root):
+    """
+    Write the downloaded folders of a turning camera, split into two presets with a frame left
+    behind, and of a static camera, moved as a whole.
+
+    Returns:
+        list: The operations of the split.
+    """
+    turning = root / "dl_frames" / "2024_07_01" / "turning"
+    static = root / "dl_frames" / "2024_07_01" / "static"
+    split = root / "dl_frames_splited" / "2024_07_01"
+    operations = []
+    for folder in (turning, static):
+        folder.mkdir(parents=True)
+        for i in range(9):
+            (folder / f"2024_07_01T12_{i:02d}_00.jpg").write_bytes(
+                f"{folder.name}{i}".encode()
+            )
+    for i in range(8):
+        name = f"2024_07_01T12_{i:02d}_00.jpg"
+        operations.append(
+            [
+                "file",
+                str(turning / name),
+                str(split / "turning" / f"cam_{i % 2:02d}" / name),
+            ]
+        )
+    operations.append(["rmtree", str(turning), None])
+    operations.append(["dir", str(static), str(split / "static" / "cam_00")])
+    return operations
+
+
+def crash_after(monkeypatch, calls):
+    """Make move_file crash once it moved `calls` files or folders."""
+    move_file = moves.move_file
+    moved = []
+
+    def crashing_move_file(src, dst):
+        if len(moved) == calls:
+            raise Crash
+        moved.append(src)
+        return move_file(src, dst)
+
+    monkeypatch.setattr(moves, "move_file", crashing_move_file)
+
+
+@pytest.fixture
+def expected(tmp_path_factory):
+    root = tmp_path_factory.mktemp("uninterrupted")
+    moves.move_batch(str(root / "manifests" / "split.jsonl"), make_tree(root))
+    return snapshot(root)
+
+
+@pytest.mark.parametrize("calls", range(9))
+def test_resume_converges_after_crash(tmp_path, monkeypatch, expected, calls):
+    manifest = str(tmp_path / "manifests" / "split.jsonl")
+    operations = make_tree(tmp_path)
+    with monkeypatch.context() as patch:
+        crash_after(patch, calls)
+        with pytest.raises(Crash):
+            moves.move_batch(manifest, operations)
+    resumed = []
+
+    moves.resume(str(tmp_path / "manifests"), after=resumed.append)
+
+    assert snapshot(tmp_path) == expected
+    assert not os.listdir(tmp_path / "manifests")
+    assert len(resumed) == 1
+
+
+@pytest.mark.parametrize("calls", range(9))
+def test_rollback_restores_sources(tmp_path, monkeypatch, calls):
+    operations = make_tree(tmp_path)
+    before = snapshot(tmp_path)
+    with monkeypatch.context() as patch:
+        crash_after(patch, calls)
+        with pytest.raises(Crash):
+            moves.move_batch(str(tmp_path / "manifests" / "split.jsonl"), operations)
+
+    moves.rollback(str(tmp_path / "manifests"))
+
+    assert snapshot(tmp_path) == before
+    split = tmp_path / "dl_frames_splited" / "2024_07_01"
+    assert not os.path.exists(split / "turning" / "cam_00")
+    assert not os.path.exists(split / "static" / "cam_00")
+    assert not os.listdir(tmp_path / "manifests")
+
+
+class OtherDevice:
+    """The status of a folder as seen from another device."""
+
+    def __init__(self, status):
+        self.status = status
+
+    def __getattr__(self, name):
+        if name == "st_dev":
+            return self.status.st_dev + 1
+        return getattr(self.status, name)
+
+
+def test_moves_across_devices_are_copied(tmp_path, monkeypatch, expected):
+    manifest = str(tmp_path / "manifests" / "split.jsonl")
+    sources = str(tmp_path / "dl_frames") + os.sep
+    stat, replace = os.stat, os.replace
+
+    def other_device_stat(path, *args, **kwargs):
+        status = stat(path, *args, **kwargs)
+        return OtherDevice(status) if str(path).startswith(sources) else status
+
+    def cross_device_replace(src, dst):
+        # The renames out of the download tree cross devices, those of the copies do not
+        if str(src).startswith(sources):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        replace(src, dst)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(os, "stat", other_device_stat)
+        operations = moves.expand_operations(make_tree(tmp_path))
+    # The folder of the static camera cannot be renamed, its frames are copied one by one
+    assert [kind for kind, _, _ in operations].count("dir") == 0
+    moves.write_manifest(manifest, operations)
+    monkeypatch.setattr(os, "replace", cross_device_replace)
+
+    moves.run_operations(manifest, operations)
+
+    assert snapshot(tmp_path) == expected
+    assert not os.path.exists(manifest)
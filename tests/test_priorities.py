@@ -0,0 +1,161 @@
+from datetime import datetime
+
+import pytest
+import pytz
+
+import priorities
+from priorities import CameraScheduler, camera_score
+
+# Noon in UTC, 5 AM in California
+NOW = datetime(2024, 7, 1, 12, tzinfo=pytz.utc).timestamp()
+
+
+class FakeCatalog:
+    def __init__(self, stats):
+        self.stats = stats
+        self.since_days = []
+
+    def camera_stats(self, since_day):
+        self.since_days.append(since_day)
+        return self.stats
+
+
+def make_stats(frames=200, gray=0, failure_rate=0, detected=0, kept=0, **download):
+    stats = dict(
+        downloads=10, failure_rate=failure_rate, latency=None, last_download=None
+    )
+    stats.update(download, frames=frames, gray=gray, detected=detected, kept=kept)
+    return stats
+
+
+def make_feature(camera, state="CA"):
+    return {"properties": {"id": camera, "state": state}}
+
+
+def make_scheduler(monkeypatch, stats, night_hours="21-5"):
+    monkeypatch.setattr(priorities, "NIGHT_HOURS", night_hours)
+    return CameraScheduler(
+        FakeCatalog(stats), {"CA": "America/Los_Angeles"}, "UTC", max_interval=3600
+    )
+
+
+def test_camera_score():
+    # Cameras without enough history are downloaded as useful ones
+    assert camera_score(None) == 1
+    assert camera_score(make_stats(frames=99, gray=99)) == 1
+    # Before any detection, only the gray frames and the failures count
+    assert camera_score(make_stats(gray=100, failure_rate=0.5)) == pytest.approx(0.25)
+    assert camera_score(make_stats(gray=200)) == 0
+    # Once detected, the yield scales the score between the floor and 1
+    never_kept = camera_score(make_stats(detected=200))
+    assert never_kept == pytest.approx(priorities.YIELD_FLOOR)
+    half_kept = camera_score(make_stats(detected=200, kept=priorities.YIELD_HALF))
+    assert half_kept == pytest.approx((1 + priorities.YIELD_FLOOR) / 2)
+    assert never_kept < half_kept < camera_score(make_stats(detected=200, kept=100)) < 1
+
+
+def test_plan_orders_by_score_and_latency(monkeypatch):
+    stats = {
+        "gray": make_stats(gray=100),
+        "slow": make_stats(latency=9.0),
+        "fast": make_stats(latency=1.0),
+    }
+    scheduler = make_scheduler(monkeypatch, stats, night_hours="")
+    features = [make_feature(camera) for camera in ("gray", "slow", "new", "fast")]
+
+    planned = scheduler.plan(features, now=NOW)
+
+    assert [feature["properties"]["id"] for feature in planned] == [
+        "new",
+        "fast",
+        "slow",
+        "gray",
+    ]
+    # The stats window counts back from the given time
+    assert scheduler.catalog.since_days == ["2024_06_24"]
+
+
+def test_plan_skips_cameras_within_their_interval(monkeypatch):
+    # Half the score waits half of max_interval, a score of 1 never waits
+    stats = {
+        "half": make_stats(gray=100, last_download=NOW - 1000),
+        "half_due": make_stats(gray=100, last_download=NOW - 2000),
+        "zero": make_stats(gray=200, last_download=NOW - 3000),
+        "zero_due": make_stats(gray=200, last_download=NOW - 4000),
+        "full": make_stats(last_download=NOW - 1),
+    }
+    scheduler = make_scheduler(monkeypatch, stats, night_hours="")
+
+    planned = scheduler.plan([make_feature(camera) for camera in stats], now=NOW)
+
+    assert [feature["properties"]["id"] for feature in planned] == [
+        "full",
+        "half_due",
+        "zero_due",
+    ]
+
+
+def test_plan_skips_cameras_at_night(monkeypatch):
+    scheduler = make_scheduler(monkeypatch, {})
+    features = [make_feature("california", "CA"), make_feature("europe", "FR")]
+
+    # 4 AM in California and 11 AM in UTC
+    planned = scheduler.plan(features, now=NOW - 3600)
+
+    assert [feature["properties"]["id"] for feature in planned] == ["europe"]
+    assert len(scheduler.plan(features, now=NOW)) == 2
+
+
+@pytest.mark.parametrize(
+    "hour, night",
+    [
+        (20, False),
+        (21, True),
+        (23, True),
+        (0, True),
+        (4, True),
+        (5, False),
+        (12, False),
+    ],
+)
+def test_night_hours_wrap_past_midnight(monkeypatch, hour, night):
+    scheduler = make_scheduler(monkeypatch, {})
+    now = datetime(2024, 7, 1, hour, 30, tzinfo=pytz.utc).timestamp()
+
+    assert scheduler.is_night("FR", now) is night
+
+
+@pytest.mark.parametrize(
+    "hour, night_end",
+    [
+        (3, datetime(2024, 6, 30, 5)),
+        (5, datetime(2024, 7, 1, 5)),
+        (12, datetime(2024, 7, 1, 5)),
+        (23, datetime(2024, 7, 1, 5)),
+    ],
+)
+def test_night_end(monkeypatch, hour, night_end):
+    scheduler = make_scheduler(monkeypatch, {})
+    now = datetime(2024, 7, 1, hour, tzinfo=pytz.utc).timestamp()
+
+    assert scheduler.night_end("FR", now) == pytz.utc.localize(night_end).timestamp()
+
+
+def test_night_end_is_local(monkeypatch):
+    scheduler = make_scheduler(monkeypatch, {})
+    california = pytz.timezone("America/Los_Angeles")
+
+    # Noon in UTC is the 5 AM end of the night in California
+    assert scheduler.night_end("CA", NOW) == NOW
+    assert scheduler.night_end("CA", NOW - 1) == (
+        california.localize(datetime(2024, 6, 30, 5)).timestamp()
+    )
+
+
+def test_no_night_hours(monkeypatch):
+    scheduler = make_scheduler(monkeypatch, {}, night_hours=" ")
+
+    assert priorities.parse_night_hours("21-5") == (21, 5)
+    assert scheduler.night is None
+    assert not scheduler.is_night("CA", NOW)
+    assert scheduler.night_end("CA", NOW) is None
@@ -0,0 +1,172 @@
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import process_awf
+from catalog import FrameCatalog
+
+START = datetime(2024, 7, 1, 12)
+# Two minutes between frames, ten between the distinct ones: the distinct frames of a plume are
+# further apart than the detection window
+FRAME_GAP = timedelta(minutes=2)
+KEEP_EVERY = 10
+PLUME = range(100, 112)
+LABEL = "0 0.5 0.5 0.1 0.1 0.8"
+
+
+@pytest.fixture
+def folder(tmp_path, monkeypatch):
+    """
+    A camera folder of near duplicate frames of a still scene, with a plume growing in frames
+    PLUME, recorded in a catalog of its own.
+    """
+    cam_folder = tmp_path / "dl_frames" / "2024_07_01" / "cam"
+    cam_folder.mkdir(parents=True)
+    catalog = FrameCatalog(str(tmp_path / "catalog.db"))
+    frames = []
+    for idx in range(200):
+        path = cam_folder / f"cam_{(START + idx * FRAME_GAP):%Y_%m_%dT%H_%M_%S}.jpg"
+        path.write_bytes(b"frame")
+        frames.append(
+            dict(
+                path=str(path),
+                camera="cam",
+                day="2024_07_01",
+                stage="downloaded",
+                duplicate=idx % KEEP_EVERY != 0,
+            )
+        )
+    catalog.add_frames(frames)
+    monkeypatch.setattr(process_awf, "catalog", catalog)
+    plume = {frames[idx]["path"] for idx in PLUME}
+
+    def predict_folder(cam_folder, weight, conf_model, name, imgs=None):
+        return {file: LABEL for file in imgs if file in plume}
+
+    monkeypatch.setattr(process_awf, "predict_folder", predict_folder)
+    return str(cam_folder), catalog, sorted(plume)
+
+
+def test_plume_of_near_duplicates_keeps_its_confirmations(folder, tmp_path):
+    cam_folder, catalog, plume = folder
+    done = str(tmp_path / "done")
+    process_awf.process_camera_folder(cam_folder, None, None, done)
+
+    archived = catalog.folder_frames(cam_folder, "archived")
+    assert set(plume) <= set(archived)
+    detections = catalog.execute(
+        "SELECT path FROM frames WHERE detections IS NOT NULL AND stage = 'archived'"
+    )
+    assert sorted(row[0] for row in detections) == plume
+    assert os.path.exists(os.path.join(done, "2024_07_01_cam.zip"))
+
+
+class Worker(threading.Thread):
+    """
+    A thread standing for a worker process of BatchedDetection, inferring a frame at a time.
+    It dies holding any of the poison frames, which are inferred normally once they killed a
+    worker unless `deadly`.
+    """
+
+    def __init__(self, pool, plume, poison, deadly):
+        super().__init__(daemon=True)
+        self.pool = pool
+        self.plume = plume
+        self.poison = poison
+        self.deadly = deadly
+        self.exitcode = None
+
+    def run(self):
+        for folder, file in iter(self.pool.frames.get, None):
+            if file in self.poison:
+                if not self.deadly:
+                    self.poison.discard(file)
+                self.exitcode = -9
+                return
+            label = LABEL if file in self.plume else None
+            self.pool.results.put(([(folder, file, label)], {}))
+        self.exitcode = 0
+
+
+def run_batched(
+    monkeypatch, tmp_path, catalog, cam_folder, plume, poison=(), deadly=False
+):
+    """
+    Run the batched detection of a folder with worker threads.
+
+    Returns:
+        list: The errors the folder failed with.
+    """
+    poison = set(poison)
+
+    def start_worker(self):
+        worker = Worker(self, set(plume), poison, deadly)
+        worker.start()
+        return worker
+
+    monkeypatch.setattr(process_awf.BatchedDetection, "start_worker", start_worker)
+    monkeypatch.setattr(process_awf, "POLL_INTERVAL", 0.05)
+    finished = threading.Event()
+    errors = []
+
+    def failed(error):
+        errors.append(error)
+        finished.set()
+
+    pool = process_awf.BatchedDetection(2, None, None, str(tmp_path / "done"), catalog)
+    pool.submit(cam_folder, "downloaded", lambda _: finished.set(), failed)
+    assert finished.wait(30)
+    pool.close()
+    return errors
+
+
+def test_batched_plume_of_near_duplicates_keeps_its_confirmations(
+    folder, tmp_path, monkeypatch
+):
+    cam_folder, catalog, plume = folder
+    assert not run_batched(monkeypatch, tmp_path, catalog, cam_folder, plume)
+    assert set(plume) <= set(catalog.folder_frames(cam_folder, "archived"))
+
+
+def test_batched_frames_of_dead_worker_are_fed_again(folder, tmp_path, monkeypatch):
+    cam_folder, catalog, plume = folder
+    errors = run_batched(
+        monkeypatch, tmp_path, catalog, cam_folder, plume, poison=plume[::6]
+    )
+    assert not errors
+    assert set(plume) <= set(catalog.folder_frames(cam_folder, "archived"))
+    assert not catalog.folder_frames(cam_folder, "downloaded")
+
+
+def test_batched_folder_killing_workers_fails(folder, tmp_path, monkeypatch):
+    cam_folder, catalog, plume = folder
+    errors = run_batched(
+        monkeypatch, tmp_path, catalog, cam_folder, plume, plume[:1], deadly=True
+    )
+    assert len(errors) == 1
+    # Resumed from its journal at the next start
+    assert catalog.folder_frames(cam_folder, "downloaded")
+
+
+def test_archive_keeps_frames_downloaded_meanwhile(folder, tmp_path):
+    cam_folder, catalog, plume = folder
+    imgs = catalog.folder_frames(cam_folder, "downloaded")
+    late = os.path.join(cam_folder, "cam_2024_07_01T23_59_00.jpg")
+    part = os.path.join(cam_folder, ".0.part")
+    for path in (late, part):
+        with open(path, "wb") as f:
+            f.write(b"frame")
+    detections = {file: LABEL for file in plume}
+    process_awf.archive_folder(
+        cam_folder, "downloaded", imgs, imgs, detections, str(tmp_path / "done")
+    )
+
+    assert sorted(os.listdir(cam_folder)) == [".0.part", os.path.basename(late)]
+    os.remove(late)
+    os.remove(part)
+    process_awf.archive_folder(
+        cam_folder, "downloaded", [], [], {}, str(tmp_path / "done")
+    )
+    assert not os.path.exists(cam_folder)
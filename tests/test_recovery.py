@@ -0,0 +1,192 @@
+import os
+from zipfile import ZipFile
+
+import numpy as np
+import pytest
+
+import process_awf
+from catalog import FrameCatalog
+from journal import Journal
+from shards import ShardWriter, read_index
+
+NAME = "2024_01_01_cam_000"
+FRAMES = 40
+LABEL = "0 0.5 0.5 0.1 0.1 0.9\n"
+
+
+class Crash(BaseException):
+    """Stands for a power loss, nothing catches it."""
+
+
+def crash(*args, **kwargs):
+    raise Crash
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.default_rng(0)
+    return [rng.bytes(10000) for _ in range(FRAMES)]
+
+
+@pytest.fixture
+def inferred(monkeypatch):
+    """
+    The frames inferred by a detection finding a smoke on one frame out of seven.
+    """
+    inferred = []
+
+    def predict_folder(cam_folder, weight, conf_model, name, imgs=None):
+        inferred.extend(imgs)
+        return {file: LABEL for file in imgs[::7]}
+
+    monkeypatch.setattr(process_awf, "predict_folder", predict_folder)
+    monkeypatch.setattr(process_awf, "catalog", None)
+    return inferred
+
+
+def make_scenario(root, frames):
+    """
+    Write a downloaded camera folder and its catalog, and the shard of an earlier download
+    round of the same day in tar mode.
+
+    Returns:
+        str: The camera folder.
+    """
+    folder = root / "dl_frames" / "2024_01_01" / "cam_000"
+    folder.mkdir(parents=True)
+    records = []
+    for i, frame in enumerate(frames):
+        path = folder / f"2024_01_01T12_{i // 6:02d}_{i % 6 * 10:02d}.jpg"
+        path.write_bytes(frame)
+        records.append(
+            dict(path=str(path), camera="cam_000", day="2024_01_01", stage="downloaded")
+        )
+    FrameCatalog(str(root / "catalog.sqlite")).add_frames(records)
+    if process_awf.ARCHIVE_FORMAT == "tar":
+        (root / "done").mkdir()
+        with ShardWriter(str(root / "done" / f"{NAME}.tar")) as writer:
+            writer.add("2024_01_01T06_00_00.jpg", frames[0])
+    return str(folder)
+
+
+def detect(root, folder, recover=False):
+    """
+    Run the detection of a folder in a freshly started process, after the recovery of the
+    interrupted runs if asked. The yolo CLI writes its labels in the working folder.
+    """
+    os.chdir(root)
+    process_awf.catalog = FrameCatalog(str(root / "catalog.sqlite"))
+    done = str(root / "done")
+    if recover:
+        process_awf.recover_interrupted_folders(done)
+        if folder not in process_awf.catalog.pending_folders("downloaded"):
+            return
+    process_awf.process_camera_folder(folder, "", 0.2, done)
+
+
+def outcome(root):
+    """
+    Describe what the detection left behind: the members of the archive in order, the stage of
+    each frame and the files left.
+    """
+    done = root / "done"
+    members = []
+    if (done / f"{NAME}.tar").exists():
+        # Duplicate members included
+        members = [entry["name"] for entry in read_index(str(done / f"{NAME}.tar"))]
+    elif (done / f"{NAME}.zip").exists():
+        with ZipFile(done / f"{NAME}.zip") as archive:
+            members = sorted(archive.namelist())
+    stages = {
+        os.path.relpath(path, root): stage
+        for path, stage in process_awf.catalog.execute("SELECT path, stage FROM frames")
+    }
+    files = sorted(
+        os.path.relpath(os.path.join(folder, file), root)
+        for folder, _, files in os.walk(root)
+        for file in files
+        if not file.startswith("catalog.sqlite")
+    )
+    return dict(members=members, stages=stages, files=files)
+
+
+def crash_after(step):
+    """
+    Journal.checkpoint crashing right after a step is recorded, leaving the labels the yolo
+    CLI was writing when it crashes during the detection.
+    """
+    checkpoint = Journal.checkpoint
+
+    def crashing_checkpoint(self, unit, name, **data):
+        checkpoint(self, unit, name, **data)
+        if name == step:
+            if name == "started":
+                os.makedirs(os.path.join("runs_awf", NAME, "labels"))
+            raise Crash
+
+    return crashing_checkpoint
+
+
+def crashing_zip(frames):
+    """
+    archive_zip crashing while the zip is written, with the staging folder of the earlier
+    versions left next to it.
+    """
+
+    def archive_zip(save_folder, *args):
+        os.makedirs(os.path.join(save_folder, "images"))
+        with open(f"{save_folder}.part.zip", "wb") as f:
+            f.write(frames[1][:5000])
+        raise Crash
+
+    return archive_zip
+
+
+def crashing_tar(frames):
+    """
+    archive_tar crashing once the first sample of the folder is appended, while the second is
+    being written.
+    """
+
+    def archive_tar(save_folder, *args, members=None):
+        with ShardWriter(f"{save_folder}.tar", members) as writer:
+            writer.add("2024_01_01T12_00_00.jpg", frames[0])
+        with open(f"{save_folder}.tar", "ab") as f:
+            f.write(frames[1][:5000])
+        raise Crash
+
+    return archive_tar
+
+
+@pytest.mark.parametrize("archive_format", ["zip", "tar"])
+@pytest.mark.parametrize(
+    "step", ["started", "detected", "archiving", "archived", "recorded"]
+)
+def test_crash_recovery_matches_uninterrupted_run(
+    tmp_path, monkeypatch, frames, inferred, archive_format, step
+):
+    monkeypatch.setattr(process_awf, "ARCHIVE_FORMAT", archive_format)
+    monkeypatch.chdir(tmp_path)
+    expected_root = tmp_path / "uninterrupted"
+    detect(expected_root, make_scenario(expected_root, frames))
+    expected = outcome(expected_root)
+
+    root = tmp_path / "crashed"
+    folder = make_scenario(root, frames)
+    with monkeypatch.context() as patch:
+        if step == "archiving":
+            patch.setattr(process_awf, "archive_zip", crashing_zip(frames))
+            patch.setattr(process_awf, "archive_tar", crashing_tar(frames))
+        elif step == "recorded":
+            # The fate of the frames is in the catalog, the frames are still there
+            patch.setattr(os, "remove", crash)
+        else:
+            patch.setattr(Journal, "checkpoint", crash_after(step))
+        with pytest.raises(Crash):
+            detect(root, folder)
+    inferred.clear()
+    detect(root, folder, recover=True)
+
+    assert outcome(root) == expected
+    # The detections recorded before the crash are not run again
+    assert len(inferred) == (FRAMES if step == "started" else 0)
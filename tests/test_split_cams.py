@@ -0,0 +1,118 @@
+import itertools
+import shutil
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+import split_cams
+from catalog import FrameCatalog
+from split_cams import OcrCache, catalog_moves, extract_x_values_from_images
+
+
+class CountingModel:
+    """Stands for the OCR model, reading the mean level of each page as its x value."""
+
+    def __init__(self):
+        self.calls = 0
+        self.frames = 0
+
+    def __call__(self, pages):
+        self.calls += 1
+        self.frames += len(pages)
+        return SimpleNamespace(pages=[self.read(page) for page in pages])
+
+    @staticmethod
+    def read(page):
+        words = [SimpleNamespace(value=f"X:{page.mean():.1f}")]
+        return SimpleNamespace(
+            blocks=[SimpleNamespace(lines=[SimpleNamespace(words=words)])]
+        )
+
+
+def write_frames(folder, count):
+    folder.mkdir(parents=True)
+    files = []
+    for i in range(count):
+        files.append(str(folder / f"2024_07_01T12_{i:02d}_00.jpg"))
+        cv2.imwrite(files[-1], np.full((64, 96, 3), 40 * i, np.uint8))
+    return files
+
+
+def test_catalog_moves_records_files_in_one_transaction(tmp_path, monkeypatch):
+    catalog = FrameCatalog(str(tmp_path / "catalog.sqlite"))
+    folder = tmp_path / "dl_frames" / "2024_07_01" / "cam"
+    split = tmp_path / "dl_frames_splited" / "2024_07_01" / "cam"
+    frames = [str(folder / f"2024_07_01T12_{i:02d}_00.jpg") for i in range(30)]
+    catalog.add_frames(
+        [
+            dict(path=path, camera="cam", day="2024_07_01", stage="downloaded")
+            for path in frames
+        ]
+    )
+    # The last frame has no preset and is left behind
+    operations = [
+        ["file", path, str(split / f"cam_{i % 2:02d}" / path.split("/")[-1])]
+        for i, path in enumerate(frames[:-1])
+    ]
+    operations.append(["rmtree", str(folder), None])
+    calls = []
+    update_frames = catalog.update_frames
+    monkeypatch.setattr(
+        catalog, "update_frames", lambda updates: calls.append(update_frames(updates))
+    )
+
+    catalog_moves(catalog, operations)
+
+    assert len(calls) == 1
+    assert len(catalog.folder_frames(split / "cam_00", "split")) == 15
+    assert len(catalog.folder_frames(split / "cam_01", "split")) == 14
+    presets = catalog.execute(
+        "SELECT DISTINCT preset FROM frames WHERE stage = 'split'"
+    )
+    assert sorted(row[0] for row in presets) == ["cam_00", "cam_01"]
+    assert catalog.folder_frames(folder, "removed") == frames[-1:]
+
+
+def test_ocr_cache_skips_the_model_on_known_frames(tmp_path, monkeypatch):
+    cache = OcrCache(str(tmp_path / "ocr_cache.sqlite"), 100)
+    monkeypatch.setattr(split_cams, "ocr_cache", cache)
+    files = write_frames(tmp_path / "cam", 4)
+    model = CountingModel()
+
+    x_values = extract_x_values_from_images(files, model, batch_size=2)
+    assert (model.calls, model.frames) == (2, 4)
+    assert len(set(x_values)) == 4 and -1000 not in x_values
+
+    # The same frames, even renamed by the split, are only read from the cache
+    moved = [f"{file}.moved" for file in files]
+    for file, new_file in zip(files, moved):
+        shutil.move(file, new_file)
+    assert extract_x_values_from_images(moved, model, batch_size=2) == x_values
+    assert (model.calls, model.frames) == (2, 4)
+
+
+def test_ocr_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(split_cams.time, "time", lambda: next(clock))
+    cache = OcrCache(str(tmp_path / "ocr_cache.sqlite"), 3)
+    for key, x in [("a", 1.0), ("b", 2.0), ("c", 3.0)]:
+        cache.put_many({key: x})
+    # Reading "a" makes "b" the least recently used
+    assert cache.get_many(["a"]) == {"a": 1.0}
+
+    cache.put_many({"d": 4.0, "e": 5.0})
+
+    assert cache.conn.execute("SELECT COUNT(*) FROM ocr").fetchone()[0] == 3
+    assert cache.get_many(["a", "b", "c", "d", "e"]) == {"a": 1.0, "d": 4.0, "e": 5.0}
+
+
+def test_ocr_cache_stays_at_its_limit(tmp_path, monkeypatch):
+    cache = OcrCache(str(tmp_path / "ocr_cache.sqlite"), 2)
+    monkeypatch.setattr(split_cams, "ocr_cache", cache)
+    model = CountingModel()
+
+    extract_x_values_from_images(write_frames(tmp_path / "cam", 5), model)
+
+    assert model.frames == 5
+    assert cache.conn.execute("SELECT COUNT(*) FROM ocr").fetchone()[0] == 2
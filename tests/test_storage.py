@@ -0,0 +1,39 @@
+import time
+
+import storage
+from catalog import PROCESSING_MARKER, FrameCatalog
+
+
+def test_first_usage_is_measured_right_after_boot(tmp_path, monkeypatch):
+    catalog = FrameCatalog(str(tmp_path / "catalog.sqlite"))
+    governor = storage.StorageGovernor(catalog, str(tmp_path / "frames"))
+    # The monotonic clock counts from boot on Linux
+    monkeypatch.setattr(time, "monotonic", lambda: 12.0)
+
+    usage = governor.usage()
+
+    assert usage is not None and 0 <= usage["ratio"] <= 1
+    assert governor.pressure() in (True, False)
+
+
+def test_evict_skips_folders_being_detected(tmp_path, monkeypatch):
+    catalog = FrameCatalog(str(tmp_path / "catalog.sqlite"))
+    root = tmp_path / "frames"
+    folders = []
+    for day in ("2024_07_01", "2024_07_02"):
+        folder = root / "dl_frames" / day / "cam"
+        folder.mkdir(parents=True)
+        path = folder / f"{day}T12_00_00.jpg"
+        path.write_bytes(b"frame")
+        catalog.add_frames(
+            [dict(path=str(path), camera="cam", day=day, stage="downloaded", size=5)]
+        )
+        folders.append(folder)
+    # The oldest day is being detected by another process
+    (folders[0] / PROCESSING_MARKER).touch()
+    # Any pending frame puts the store under pressure
+    monkeypatch.setattr(storage, "STORAGE_MAX_BYTES", 1)
+    governor = storage.StorageGovernor(catalog, str(root))
+
+    assert governor.evict() == 5
+    assert folders[0].exists() and not folders[1].exists()
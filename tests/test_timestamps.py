@@ -0,0 +1,17 @@
+from datetime import datetime, timezone
+
+from timestamps import part_header_time
+
+
+def test_part_header_time_reads_capture_headers():
+    headers = b"Content-Type: image/jpeg\r\nX-Timestamp: 1719835200\r\n"
+    assert part_header_time(headers) == datetime(2024, 7, 1, 12, tzinfo=timezone.utc)
+
+
+def test_part_header_time_ignores_server_dates():
+    headers = (
+        b"Content-Type: image/jpeg\r\n"
+        b"Date: Mon, 01 Jul 2024 12:00:00 GMT\r\n"
+        b"Last-Modified: Mon, 01 Jul 2024 11:00:00 GMT\r\n"
+    )
+    assert part_header_time(headers) is None
@@ -0,0 +1,130 @@
+import glob
+import re
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from process_awf import DETECTION_WINDOW, filter_by_windows
+
+START = datetime(2024, 7, 1, 6)
+
+
+def reference_filter_by_windows(cam_folder, labels):
+    """
+    The original implementation of process_awf.filter_by_windows, kept to check the output of
+    the current one.
+    """
+    labels.sort()
+    keep_labels = set()
+    current_list = []
+    for idx, file in enumerate(labels):
+        match = re.search(r"(\d{4}_\d{2}_\d{2}T\d{2}_\d{2}_\d{2})", file)
+        t = datetime.strptime(match.group(), "%Y_%m_%dT%H_%M_%S")
+        if len(current_list) == 0:
+            last_time = t
+            current_list.append(file)
+        else:
+            if abs((t - last_time).total_seconds()) < 60 * 15:  # 15mn windows
+                current_list.append(file)
+                last_time = t
+            else:
+                if len(current_list) > 1:  # min 2 detection on the windows
+                    keep_labels = keep_labels.union(set(current_list))
+
+                current_list = [file]
+                last_time = t
+
+    if len(current_list) > 1:
+        keep_labels = keep_labels.union(set(current_list))
+
+    time_windows = []
+    for file in keep_labels:
+        match = re.search(r"(\d{4}_\d{2}_\d{2}T\d{2}_\d{2}_\d{2})", file)
+        t = datetime.strptime(match.group(), "%Y_%m_%dT%H_%M_%S")
+        t_min = t - timedelta(minutes=15)
+        t_max = t + timedelta(minutes=15)
+        time_windows.append((t_min, t_max))
+
+    imgs = glob.glob(cam_folder + "/*")
+    imgs.sort()
+    keep_imgs = set()
+    for file in imgs:
+        match = re.search(r"(\d{4}_\d{2}_\d{2}T\d{2}_\d{2}_\d{2})", file)
+        t = datetime.strptime(match.group(), "%Y_%m_%dT%H_%M_%S")
+        for t_min, t_max in time_windows:
+            if t > t_min and t < t_max:
+                keep_imgs.add(file)
+                break
+
+    return keep_imgs, keep_labels
+
+
+def make_folder(folder, seconds):
+    """
+    Create empty frames taken the given numbers of seconds after START.
+
+    Returns:
+        list: The frame paths, in the order of the seconds.
+    """
+    folder.mkdir(exist_ok=True)
+    paths = []
+    for offset in seconds:
+        path = (
+            folder / f"{(START + timedelta(seconds=int(offset))):%Y_%m_%dT%H_%M_%S}.jpg"
+        )
+        path.touch()
+        paths.append(str(path))
+    return paths
+
+
+def assert_matches_reference(folder, labels):
+    expected = reference_filter_by_windows(str(folder), list(labels))
+    assert filter_by_windows(str(folder), list(labels)) == expected
+    imgs = glob.glob(f"{folder}/*")
+    assert filter_by_windows(str(folder), list(labels), imgs) == expected
+    return expected
+
+
+def test_no_detection(tmp_path):
+    make_folder(tmp_path, range(0, 3600, 30))
+    assert assert_matches_reference(tmp_path, []) == (set(), set())
+
+
+def test_single_detection(tmp_path):
+    frames = make_folder(tmp_path, range(0, 3600, 30))
+    assert assert_matches_reference(tmp_path, frames[60:61]) == (set(), set())
+
+
+@pytest.mark.parametrize("gap", [DETECTION_WINDOW - 1, DETECTION_WINDOW])
+def test_detections_a_window_apart(tmp_path, gap):
+    frames = make_folder(tmp_path, list(range(0, 7200, 60)) + [1800 + gap])
+    keep_imgs, keep_labels = assert_matches_reference(
+        tmp_path, [frames[30], frames[-1]]
+    )
+    assert bool(keep_labels) == (gap < DETECTION_WINDOW)
+
+
+def test_unsorted_filenames(tmp_path):
+    frames = make_folder(tmp_path, range(0, 7200, 60))
+    labels = [frames[70], frames[10], frames[75], frames[12], frames[40]]
+    _, keep_labels = assert_matches_reference(tmp_path, labels)
+    assert keep_labels == {frames[10], frames[12], frames[70], frames[75]}
+
+
+def test_overlapping_windows(tmp_path):
+    frames = make_folder(tmp_path, range(0, 10800, 60))
+    # Chained detections whose windows overlap, and a pair whose window touches theirs
+    labels = [frames[idx] for idx in (20, 30, 40, 50, 80, 90)]
+    keep_imgs, _ = assert_matches_reference(tmp_path, labels)
+    assert keep_imgs == set(frames[6:65] + frames[66:105])
+
+
+def test_random_days(tmp_path):
+    rng = np.random.default_rng(0)
+    for day in range(20):
+        folder = tmp_path / str(day)
+        seconds = np.unique(rng.integers(0, 86400, rng.integers(1, 400)))
+        frames = make_folder(folder, seconds)
+        labels = [file for file in frames if rng.random() < 0.1]
+        assert_matches_reference(folder, labels)